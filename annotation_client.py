@@ -0,0 +1,67 @@
+#!/usr/bin/python
+import argparse
+import json
+import os
+from typing import Any
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+JOB_TASKS = ('annotate', 'filter')
+
+
+def submit_annotation_job(job: dict[str, Any], host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                          wait: bool = True) -> dict[str, Any]:
+    """Queue a job on a running ``annotation_service.py`` and return its status, the final one with ``wait``.
+
+    Only the standard library is imported here, so a submission does not pay the pandas import of the service.
+    """
+    request = Request(f'http://{host}:{port}/jobs{"?wait=1" if wait else ""}', data=json.dumps(job).encode('utf8'),
+                      headers={'Content-Type': 'application/json'}, method='POST')
+    return send_request(request)
+
+
+def get_annotation_job_status(job_id: int, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> dict[str, Any]:
+    return send_request(Request(f'http://{host}:{port}/jobs/{job_id}'))
+
+
+def send_request(request: Request) -> dict[str, Any]:
+    try:
+        with urlopen(request) as response:
+            return json.load(response)
+    except HTTPError as error:
+        # the service explains rejected jobs in the JSON body of the error response
+        return json.load(error)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Submit a GFF annotation job to a running annotation service')
+    parser.add_argument('task', choices=JOB_TASKS,
+                        help='annotate: write _edited.gff and _edited_filtered.gff from a filtered domtblout; '
+                             'filter: write _filtered.gff of an _edited.gff from its _with_names_unique.txt table')
+    parser.add_argument('annotation_file', help='GFF to annotate or filter')
+    parser.add_argument('--annotation-source', choices=('prodigal', 'refseq'), default='prodigal')
+    parser.add_argument('--domtblout-file', help='filtered domtblout of the proteins, for annotate')
+    parser.add_argument('--hmm-protein-file', help='_with_names_unique.txt table of the proteins, for filter')
+    parser.add_argument('--write-name-tables', action='store_true',
+                        help='also write the _with_names.txt and _with_names_unique.txt tables, for annotate')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--no-wait', action='store_true', help='return once the job is queued')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # the service resolves paths from its own working directory
+    job = {'task': args.task, 'annotation_file': os.path.abspath(args.annotation_file),
+           'annotation_source': args.annotation_source,
+           'domtblout_file': args.domtblout_file and os.path.abspath(args.domtblout_file),
+           'hmm_protein_file': args.hmm_protein_file and os.path.abspath(args.hmm_protein_file),
+           'write_name_tables': args.write_name_tables}
+    status = submit_annotation_job(job, args.host, args.port, wait=not args.no_wait)
+    print(json.dumps(status, indent=2))
+    if status.get('status') in ('failed', None):
+        raise SystemExit(1)
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+import argparse
+from collections import deque
+from collections.abc import Callable, Hashable, Iterable, Mapping
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import threading
+from typing import Any, NamedTuple, TypeVar, cast
+from urllib.parse import urlsplit
+
+from annotation_client import DEFAULT_HOST, DEFAULT_PORT, JOB_TASKS
+from compressed_io import get_derived_file_name, open_file
+from filter_protein_names_in_annotation import (FunctionalColors, filter_prodigal_annotation,
+                                                filter_refseq_annotation, functional_colors)
+from make_functional_annotation_table_with_names import (ANNOTATION_SOURCES, annotate_and_filter_gff_file,
+                                                         get_annotated_gff_file_names, get_profile_name_dict,
+                                                         get_protein_name_index)
+from protein_function_index import ProteinFunctionIndex, get_index_dir_name, open_protein_function_index
+
+
+PathToFile = str
+ProfileId = str
+ProteinName = str
+JobId = int
+FileSignature = tuple[int, int]
+Table = TypeVar('Table')
+
+# modules the worker processes are forked with, so no job pays for importing pandas
+WORKER_PRELOAD_MODULES = ['make_functional_annotation_table_with_names', 'filter_protein_names_in_annotation']
+# finished jobs whose status is kept; older ones are forgotten and report as unknown
+MAX_FINISHED_JOBS = 10_000
+
+
+def get_file_signature(file_name: PathToFile) -> FileSignature:
+    stat = os.stat(file_name)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class WarmTables:
+    """Tables kept in memory between jobs and loaded again only when a file they were loaded from changes.
+
+    Loading a table holds a lock for its key only, so jobs that need other tables are not held up. Tables that are
+    built into the same place on disk pass the same ``lock_key``, so they are never built at the same time.
+    """
+
+    def __init__(self) -> None:
+        self.tables: dict[Hashable, tuple[list[FileSignature], Any]] = {}
+        self.key_locks: dict[Hashable, threading.Lock] = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, source_file_names: Iterable[PathToFile], load: Callable[[], Table],
+            lock_key: Hashable | None = None) -> Table:
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key if lock_key is None else lock_key, threading.Lock())
+        with key_lock:
+            # taken before loading, so a file changed during the load is loaded again by the next job
+            signatures = [get_file_signature(file_name) for file_name in source_file_names]
+            cached = self.tables.get(key)
+            if cached is not None and cached[0] == signatures:
+                return cached[1]
+            table = load()
+            self.tables[key] = (signatures, table)
+            return table
+
+
+class AnnotationJob(NamedTuple):
+    """An ``annotate`` job writes ``_edited.gff`` and ``_edited_filtered.gff`` of a GFF from its filtered domtblout;
+    a ``filter`` job writes ``_filtered.gff`` of an ``_edited.gff`` from its ``_with_names_unique.txt`` table."""
+    task: str
+    annotation_file: PathToFile
+    annotation_source: str = 'prodigal'
+    domtblout_file: PathToFile | None = None
+    hmm_protein_file: PathToFile | None = None
+    write_name_tables: bool = False
+
+
+def read_annotation_job(params: Mapping[str, Any]) -> AnnotationJob:
+    unknown_params = set(params).difference(AnnotationJob._fields)
+    if unknown_params:
+        raise ValueError(f'Unknown job parameters {sorted(unknown_params)}')
+    job = AnnotationJob(**params)
+    if job.task not in JOB_TASKS:
+        raise ValueError(f'Unknown task {job.task}, expected one of {list(JOB_TASKS)}')
+    if job.annotation_source not in ANNOTATION_SOURCES:
+        raise ValueError(f'Unknown annotation source {job.annotation_source}, expected one of '
+                         f'{list(ANNOTATION_SOURCES)}')
+    table_file_name = job.domtblout_file if job.task == 'annotate' else job.hmm_protein_file
+    for file_name in (job.annotation_file, table_file_name):
+        if not file_name or not os.path.isfile(file_name):
+            raise ValueError(f'{job.task} job needs an existing file, got {file_name!r}')
+    return job
+
+
+def read_functional_colors(functional_colors_file_name: PathToFile) -> FunctionalColors:
+    with open_file(functional_colors_file_name) as functional_colors_file:
+        return json.load(functional_colors_file)
+
+
+class AnnotationService:
+    """Run annotation jobs against lookup tables that stay loaded between jobs.
+
+    The profile list, the functional colors and the protein-function index of every domtblout or
+    ``_with_names_unique.txt`` table are loaded by the first job that needs them and reloaded when their files
+    change. Queued jobs run in up to ``workers`` threads that hand the GFF rewriting to as many long-lived worker
+    processes. The status of the last ``max_finished_jobs`` finished jobs is kept.
+    """
+
+    def __init__(self, profile_list_file_name: PathToFile, functional_colors_file_name: PathToFile | None = None,
+                 workers: int | None = None, max_finished_jobs: int = MAX_FINISHED_JOBS) -> None:
+        self.profile_list_file_name = profile_list_file_name
+        self.functional_colors_file_name = functional_colors_file_name
+        self.tables = WarmTables()
+        # forking worker processes from the threaded server is unsafe, so they are forked from a clean process
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(WORKER_PRELOAD_MODULES)
+        self.process_executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        self.job_executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.jobs: dict[JobId, tuple[AnnotationJob, Future]] = {}
+        self.finished_job_ids: deque[JobId] = deque()
+        self.max_finished_jobs = max_finished_jobs
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def get_profile_name_dict(self) -> dict[ProfileId, ProteinName]:
+        return self.tables.get('profile_list', [self.profile_list_file_name],
+                               lambda: get_profile_name_dict(self.profile_list_file_name))
+
+    def get_functional_colors(self) -> FunctionalColors:
+        if self.functional_colors_file_name is None:
+            return functional_colors
+        return self.tables.get('functional_colors', [self.functional_colors_file_name],
+                               lambda: read_functional_colors(cast(str, self.functional_colors_file_name)))
+
+    def get_domtblout_index(self, domtblout_file_name: PathToFile, write_name_tables: bool) -> ProteinFunctionIndex:
+        profile_name_dict = self.get_profile_name_dict()
+        index_dir = get_index_dir_name(get_derived_file_name(domtblout_file_name, '_with_names_unique.txt'))
+        return self.tables.get(
+            ('domtblout', domtblout_file_name, write_name_tables), [self.profile_list_file_name, domtblout_file_name],
+            lambda: self.process_executor.submit(get_protein_name_index, domtblout_file_name, profile_name_dict,
+                                                 write_name_tables).result(),
+            lock_key=('index_dir', os.path.abspath(index_dir)))
+
+    def get_protein_names_index(self, hmm_protein_file_name: PathToFile) -> ProteinFunctionIndex:
+        index_dir = get_index_dir_name(hmm_protein_file_name)
+        return self.tables.get(('protein_names', hmm_protein_file_name), [hmm_protein_file_name],
+                               lambda: self.process_executor.submit(open_protein_function_index,
+                                                                    hmm_protein_file_name).result(),
+                               lock_key=('index_dir', os.path.abspath(index_dir)))
+
+    def run_job(self, job: AnnotationJob) -> list[PathToFile]:
+        # the index is pickled as its directory, so workers reopen the shared memory map
+        if job.task == 'annotate':
+            protein_name_index = self.get_domtblout_index(cast(str, job.domtblout_file), job.write_name_tables)
+            self.process_executor.submit(annotate_and_filter_gff_file, job.annotation_file, job.annotation_source,
+                                         protein_name_index, self.get_functional_colors()).result()
+            return get_annotated_gff_file_names(job.annotation_file)
+
+        protein_name_index = self.get_protein_names_index(cast(str, job.hmm_protein_file))
+        annotation_file_filtered = get_derived_file_name(job.annotation_file, '_filtered.gff')
+        filter_annotation = filter_prodigal_annotation if job.annotation_source == 'prodigal' \
+            else filter_refseq_annotation
+        self.process_executor.submit(filter_annotation, job.annotation_file, annotation_file_filtered,
+                                     protein_name_index, self.get_functional_colors()).result()
+        return [annotation_file_filtered]
+
+    def submit(self, job: AnnotationJob) -> tuple[JobId, Future]:
+        """Queue a job; its future stays usable after the service forgets the job."""
+        with self.lock:
+            job_id = next(self.job_ids)
+            future = self.job_executor.submit(self.run_job, job)
+            self.jobs[job_id] = job, future
+        future.add_done_callback(lambda _: self.forget_finished_jobs(job_id))
+        return job_id, future
+
+    def forget_finished_jobs(self, finished_job_id: JobId) -> None:
+        with self.lock:
+            self.finished_job_ids.append(finished_job_id)
+            while len(self.finished_job_ids) > self.max_finished_jobs:
+                del self.jobs[self.finished_job_ids.popleft()]
+
+    def wait(self, job_id: JobId, job: AnnotationJob, future: Future) -> dict[str, Any]:
+        """Wait for a submitted job and return its final status, even if the job is forgotten meanwhile."""
+        future.exception()
+        return self.get_status(job_id, job, future)
+
+    def get_job_status(self, job_id: JobId) -> dict[str, Any]:
+        """Status of a job, or ``KeyError`` for unknown and forgotten jobs."""
+        with self.lock:
+            job, future = self.jobs[job_id]
+        return self.get_status(job_id, job, future)
+
+    @staticmethod
+    def get_status(job_id: JobId, job: AnnotationJob, future: Future) -> dict[str, Any]:
+        status: dict[str, Any] = {'job_id': job_id, 'job': job._asdict()}
+        if not future.done():
+            status['status'] = 'running' if future.running() else 'queued'
+        elif future.exception() is not None:
+            status['status'] = 'failed'
+            status['error'] = repr(future.exception())
+        else:
+            status['status'] = 'done'
+            status['outputs'] = future.result()
+        return status
+
+    def close(self) -> None:
+        self.job_executor.shutdown(cancel_futures=True)
+        self.process_executor.shutdown()
+
+
+class AnnotationServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], service: AnnotationService) -> None:
+        super().__init__(address, AnnotationRequestHandler)
+        self.service = service
+
+
+class AnnotationRequestHandler(BaseHTTPRequestHandler):
+    """``POST /jobs`` queues a JSON job (``?wait=1`` answers once it finished), ``GET /jobs/<id>`` reports it."""
+
+    def get_service(self) -> AnnotationService:
+        return cast(AnnotationServer, self.server).service
+
+    def send_json(self, code: HTTPStatus, body: Mapping[str, Any]) -> None:
+        content = json.dumps(body).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != '/jobs':
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': f'Unknown path {url.path}'})
+            return
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job = read_annotation_job({key: value for key, value in params.items() if value is not None})
+        except (ValueError, TypeError, AttributeError) as error:
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': str(error)})
+            return
+        service = self.get_service()
+        job_id, future = service.submit(job)
+        if url.query == 'wait=1':
+            self.send_json(HTTPStatus.OK, service.wait(job_id, job, future))
+        else:
+            self.send_json(HTTPStatus.ACCEPTED, service.get_status(job_id, job, future))
+
+    def do_GET(self) -> None:
+        path_parts = urlsplit(self.path).path.strip('/').split('/')
+        try:
+            if len(path_parts) != 2 or path_parts[0] != 'jobs' or not path_parts[1].isdigit():
+                raise KeyError(self.path)
+            status = self.get_service().get_job_status(int(path_parts[1]))
+        except KeyError:
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': f'Unknown job {self.path}'})
+            return
+        self.send_json(HTTPStatus.OK, status)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Serve GFF annotation jobs on localhost with the profile list and '
+                                                 'protein-function indexes kept loaded between jobs')
+    parser.add_argument('profile_list_file', help='profile list spreadsheet with "profile ID" and "nickname" columns')
+    parser.add_argument('--functional-colors', help='JSON file of function colors, instead of the built-in ones')
+    parser.add_argument('--workers', type=int, help='jobs run at the same time (default: CPU count)')
+    parser.add_argument('--max-finished-jobs', type=int, default=MAX_FINISHED_JOBS,
+                        help='finished jobs whose status is kept for GET /jobs/<id>')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='only bind to other addresses on trusted networks')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    service = AnnotationService(args.profile_list_file, args.functional_colors, args.workers,
+                                args.max_finished_jobs)
+    server = AnnotationServer((args.host, args.port), service)
+    # stopping the service with SIGTERM finishes the running jobs like Ctrl-C does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f'Serving annotation jobs on http://{args.host}:{args.port}/jobs')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
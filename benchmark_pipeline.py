@@ -0,0 +1,592 @@
+#!/usr/bin/python
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import filecmp
+import multiprocessing
+import os
+from pathlib import Path
+import random
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import cluster_layout
+import cluster_membership
+import filter_protein_names_in_annotation
+import get_cluster_sequences
+import get_random_genome
+import hmmscan_domtblout_parser
+import make_functional_annotation_table_with_names
+import protein_function_index
+
+
+PathToFile = str
+
+# hmmscan writes the free-text description of the profile as the last, space-separated column
+HIT_DESCRIPTIONS = ('-', 'Phage major capsid protein', 'terminase large subunit (TerL)',
+                    'hypothetical protein  with   irregular spacing')
+
+
+def generate_domtblout(file_name: PathToFile, number_of_queries: int, hits_per_query: int = 5,
+                       domains_per_hit: int = 2, seed: int = 0) -> int:
+    """Write a synthetic hmmscan --domtblout file and return the number of domain rows."""
+    rng = random.Random(seed)
+    number_of_rows = 0
+    with open(file_name, 'w', encoding='utf8') as domtblout:
+        domtblout.write('# target name accession tlen query name accession qlen E-value ...\n')
+        for query_number in range(number_of_queries):
+            query_id = f'genome_{query_number // 50}_{query_number % 50 + 1}'
+            query_len = rng.randint(50, 1500)
+            for hit_number in range(hits_per_query):
+                hmm_name = f'cl_{rng.randint(1, 5000)}_{hit_number}'
+                hmm_len = rng.randint(50, 800)
+                evalue = 10 ** rng.uniform(-60, 1)
+                for domain_number in range(1, domains_per_hit + 1):
+                    hmm_from = rng.randint(1, hmm_len)
+                    hmm_to = rng.randint(hmm_from, hmm_len)
+                    ali_from = rng.randint(1, query_len)
+                    ali_to = rng.randint(ali_from, query_len)
+                    columns = (hmm_name, '-', hmm_len, query_id, '-', query_len, f'{evalue:.1e}', '100.0', '0.1',
+                               domain_number, domains_per_hit, '1e-10', '1e-10', '50.0', '0.1',
+                               hmm_from, hmm_to, ali_from, ali_to, ali_from, ali_to, '0.90',
+                               HIT_DESCRIPTIONS[hit_number % len(HIT_DESCRIPTIONS)])
+                    domtblout.write(' '.join(str(column) for column in columns) + '\n')
+                    number_of_rows += 1
+        domtblout.write('#\n# Program:         hmmscan\n# [ok]\n')
+    return number_of_rows
+
+
+def generate_prodigal_gff(file_name: PathToFile, number_of_contigs: int, proteins_per_contig: int = 50) -> None:
+    with open(file_name, 'w', encoding='utf8') as gff:
+        gff.write('##gff-version  3\n')
+        for contig_number in range(number_of_contigs):
+            gff.write(f'# Sequence Data: seqnum={contig_number + 1};seqlen=100000;seqhdr="contig{contig_number}"\n')
+            for protein_number in range(1, proteins_per_contig + 1):
+                start = protein_number * 1000
+                gff.write(f'contig{contig_number}\tProdigal_v2.6.3\tCDS\t{start}\t{start + 899}\t80.5\t+\t0\t'
+                          f'ID={contig_number + 1}_{protein_number};partial=00;start_type=ATG;rbs_motif=None;'
+                          f'rbs_spacer=None;gc_cont=0.350;conf=100.00;score=80.49;cscore=75.38;sscore=5.11;'
+                          f'rscore=0.00;uscore=0.00;tscore=3.67;\n')
+
+
+def generate_refseq_gff(file_name: PathToFile, number_of_genomes: int, proteins_per_genome: int = 50) -> None:
+    with open(file_name, 'w', encoding='utf8') as gff:
+        gff.write('##gff-version 3\n')
+        for genome_number in range(number_of_genomes):
+            seqid = f'NC_{genome_number:06d}.1'
+            gff.write(f'{seqid}\tRefSeq\tregion\t1\t100000\t.\t+\t.\tID={seqid}:1..100000;Dbxref=taxon:1\n')
+            for protein_number in range(1, proteins_per_genome + 1):
+                start = protein_number * 1000
+                protein_id = f'YP_{genome_number:06d}{protein_number:03d}.1'
+                gff.write(f'{seqid}\tRefSeq\tgene\t{start}\t{start + 899}\t.\t+\t.\t'
+                          f'ID=gene-g{genome_number}_{protein_number};Name=g{protein_number}\n')
+                gff.write(f'{seqid}\tRefSeq\tCDS\t{start}\t{start + 899}\t.\t+\t0\t'
+                          f'ID=cds-{protein_id};Parent=gene-g{genome_number}_{protein_number};'
+                          f'Name={protein_id};product=hypothetical protein\n')
+
+
+def generate_filtered_domtblout(file_name: PathToFile, query_ids: list[str], annotated_fraction: float = 0.5,
+                                number_of_profiles: int = 1000, seed: int = 0) -> None:
+    """Write a ``_filtered_0.05.txt`` table that assigns a ``cl_N`` profile to part of ``query_ids``."""
+    rng = random.Random(seed)
+    with open(file_name, 'w', encoding='utf8') as domtblout:
+        domtblout.write('\t'.join(hmmscan_domtblout_parser.RESULT_HEADER) + '\n')
+        for query_id in query_ids:
+            if rng.random() < annotated_fraction:
+                domtblout.write(f'cl_{rng.randint(1, number_of_profiles)}\t300\t{query_id}\t400\t1e-20\t'
+                                f'0\t250\t10\t270\t0.8333333333333334\n')
+
+
+def generate_profile_list(file_name: PathToFile, number_of_profiles: int = 1000, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    nicknames = list(filter_protein_names_in_annotation.functional_colors) + ['terminase', 'tail_fiber', 'holin']
+    profile_list_df = pd.DataFrame({'profile ID': [f'cl_{i}' for i in range(1, number_of_profiles + 1)],
+                                    'nickname': [rng.choice(nicknames) for _ in range(number_of_profiles)]})
+    profile_list_df.to_excel(file_name, index=False)
+
+
+def get_ictv_vmr_df(number_of_viruses: int, seed: int = 0) -> pd.DataFrame:
+    """VMR-like table: taxonomy ranks with gaps, accessions and a column mixing numbers and text."""
+    rng = random.Random(seed)
+    families = [f'Family{i}viridae' for i in range(60)] + [None]
+    rows = []
+    for virus_number in range(number_of_viruses):
+        family = rng.choice(families)
+        rows.append({'Sort': virus_number + 1, 'Realm': 'Duplodnaviria', 'Kingdom': 'Heunggongvirae',
+                     'Phylum': 'Uroviricota', 'Class': rng.choice(['Caudoviricetes'] * 9 + ['Other']),
+                     'Order': rng.choice(['Crassvirales', None, None, 'Kirjokansivirales']), 'Family': family,
+                     'Subfamily': rng.choice([None, f'{family}_subfamily{rng.randint(1, 3)}']),
+                     'Genus': f'Genus{rng.randint(1, 3000)}virus', 'Species': f'Virus species {virus_number}',
+                     'Virus GENBANK accession': f'MN{rng.randint(100000, 999999)}',
+                     'Genome coverage': rng.choice(['Complete genome', 'Coding-complete genome', 1]),
+                     'Host source': rng.choice(['bacteria', 'archaea'])})
+    return pd.DataFrame(rows)
+
+
+def generate_ictv_vmr_table(file_name: PathToFile, number_of_viruses: int, seed: int = 0) -> None:
+    get_ictv_vmr_df(number_of_viruses, seed).to_excel(file_name, index=False)
+
+
+def get_prodigal_query_ids(number_of_contigs: int, proteins_per_contig: int = 50) -> list[str]:
+    return [f'all_genomes_table_contig{contig_number}_{protein_number}'
+            for contig_number in range(number_of_contigs) for protein_number in range(1, proteins_per_contig + 1)]
+
+
+def get_refseq_query_ids(number_of_genomes: int, proteins_per_genome: int = 50) -> list[str]:
+    return [f'lcl|NC_{genome_number:06d}.1_prot_YP_{genome_number:06d}{protein_number:03d}.1_{protein_number}'
+            for genome_number in range(number_of_genomes) for protein_number in range(1, proteins_per_genome + 1)]
+
+
+def get_protein_ids(number_of_proteins: int) -> list[str]:
+    return [f'genome{protein_number // 50}_{protein_number % 50 + 1}' for protein_number in range(number_of_proteins)]
+
+
+def generate_protein_fasta(file_name: PathToFile, protein_ids: list[str], line_width: int = 60,
+                           seed: int = 0) -> dict[str, int]:
+    """Write a wrapped protein FASTA and return the length of every protein."""
+    rng = random.Random(seed)
+    residues = ''.join(rng.choices('ACDEFGHIKLMNPQRSTVWY', k=100_000))
+    protein_lengths = {}
+    with open(file_name, 'w', encoding='utf8') as fasta:
+        for protein_id in protein_ids:
+            protein_length = rng.randint(30, 1200)
+            start = rng.randrange(len(residues) - protein_length)
+            sequence = residues[start:start + protein_length]
+            fasta.write(f'>{protein_id} # {protein_length * 3} # 1\n')
+            fasta.writelines(f'{sequence[i:i + line_width]}\n' for i in range(0, protein_length, line_width))
+            protein_lengths[protein_id] = protein_length
+    return protein_lengths
+
+
+def generate_protein_sizes(file_name: PathToFile, protein_lengths: dict[str, int]) -> None:
+    with open(file_name, 'w', encoding='utf8') as sizes:
+        sizes.writelines(f'{protein_id}\t{protein_length}\n' for protein_id, protein_length in protein_lengths.items())
+
+
+def generate_cluster_table(file_name: PathToFile, protein_ids: list[str], mean_cluster_size: float = 5.0,
+                           seed: int = 0) -> int:
+    """Write an MMseqs2 ``createtsv`` table (representative, member) with geometric cluster sizes.
+
+    Returns the number of clusters.
+    """
+    rng = random.Random(seed)
+    shuffled_protein_ids = protein_ids[:]
+    rng.shuffle(shuffled_protein_ids)
+    number_of_clusters = 0
+    with open(file_name, 'w', encoding='utf8') as cluster_table:
+        position = 0
+        while position < len(shuffled_protein_ids):
+            cluster_size = 1
+            while rng.random() > 1 / mean_cluster_size:
+                cluster_size += 1
+            members = shuffled_protein_ids[position:position + cluster_size]
+            cluster_table.writelines(f'{members[0]}\t{member}\n' for member in members)
+            position += cluster_size
+            number_of_clusters += 1
+    return number_of_clusters
+
+
+def benchmark_domtblout_engines(number_of_queries: int, engines: tuple[str, ...]) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        domtblout_file_name = f'{tmp_dir}/synthetic_domtblout.txt'
+        number_of_rows = generate_domtblout(domtblout_file_name, number_of_queries)
+        file_size_mb = os.path.getsize(domtblout_file_name) / 2 ** 20
+        print(f'Synthetic domtblout: {number_of_rows} rows, {file_size_mb:.1f} MB')
+
+        outputs = {}
+        for engine in engines:
+            start = time.perf_counter()
+            hmmscan_domtblout_parser.start_hmmscan_domtblout_result_analysis(domtblout_file_name, engine)
+            elapsed = time.perf_counter() - start
+            output_file_name = f'{tmp_dir}/{engine}_filtered.txt'
+            os.replace(domtblout_file_name[:-4] + '_filtered_0.05.txt', output_file_name)
+            outputs[engine] = output_file_name
+            print(f'{engine}: {elapsed:.2f} s, {number_of_rows / elapsed:,.0f} rows/s, '
+                  f'{file_size_mb / elapsed:.1f} MB/s')
+
+        reference_engine, *other_engines = engines
+        different_engines = [engine for engine in other_engines
+                             if not filecmp.cmp(outputs[reference_engine], outputs[engine], shallow=False)]
+        if different_engines:
+            raise SystemExit(f"Filtered domtblout differs from {reference_engine}: {', '.join(different_engines)}")
+        print(f'Filtered domtblout identical across engines: {", ".join(engines)}')
+
+
+def benchmark_parallel_domtblout_filtering(number_of_queries: int, number_of_files: int, workers: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        domtblout_file_names = [f'{tmp_dir}/synthetic_{file_number}_domtblout.txt'
+                                for file_number in range(number_of_files)]
+        for file_number, domtblout_file_name in enumerate(domtblout_file_names):
+            generate_domtblout(domtblout_file_name, number_of_queries, seed=file_number)
+
+        start = time.perf_counter()
+        for domtblout_file_name in domtblout_file_names:
+            hmmscan_domtblout_parser.start_hmmscan_domtblout_result_analysis(domtblout_file_name)
+        serial_elapsed = time.perf_counter() - start
+        serial_outputs = []
+        for domtblout_file_name in domtblout_file_names:
+            serial_output = f'{domtblout_file_name[:-4]}_serial.txt'
+            os.replace(hmmscan_domtblout_parser.get_result_file_name(domtblout_file_name), serial_output)
+            serial_outputs.append(serial_output)
+
+        # small shards so that every file is split even at benchmark sizes
+        min_shard_size = max(1, os.path.getsize(domtblout_file_names[0]) // workers)
+        start = time.perf_counter()
+        hmmscan_domtblout_parser.start_parallel_hmmscan_domtblout_result_analysis(domtblout_file_names, workers,
+                                                                                  min_shard_size)
+        parallel_elapsed = time.perf_counter() - start
+
+        print(f'{number_of_files} files, serial: {serial_elapsed:.2f} s, {workers} workers: {parallel_elapsed:.2f} s '
+              f'(speed-up {serial_elapsed / parallel_elapsed:.1f}x)')
+        different_files = [os.path.basename(file_name)
+                           for serial_output, file_name in zip(serial_outputs, domtblout_file_names)
+                           if not filecmp.cmp(serial_output, hmmscan_domtblout_parser.get_result_file_name(file_name),
+                                              shallow=False)]
+        if different_files:
+            raise SystemExit(f"Sharded filtering differs from serial: {', '.join(different_files)}")
+        print('Merged sharded output identical to serial')
+
+
+def benchmark_gff_annotation(number_of_contigs: int, number_of_gff_files: int, workers: int) -> None:
+    """Compare the two-step make/filter GFF annotation with the single-pass engine."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        profile_list_file_name = f'{tmp_dir}/profile_list.xlsx'
+        generate_profile_list(profile_list_file_name)
+        annotation_files, domtblout_file_names = [], []
+        for file_number in range(number_of_gff_files):
+            annotation_files.append(f'{tmp_dir}/prodigal_{file_number}.gff')
+            generate_prodigal_gff(annotation_files[-1], number_of_contigs)
+            domtblout_file_names.append(f'{tmp_dir}/prodigal_{file_number}_domtblout_filtered_0.05.txt')
+            generate_filtered_domtblout(domtblout_file_names[-1], get_prodigal_query_ids(number_of_contigs),
+                                        seed=file_number)
+        annotation_file_refseq = f'{tmp_dir}/refseq.gff'
+        generate_refseq_gff(annotation_file_refseq, number_of_contigs)
+        domtblout_file_name_refseq = f'{tmp_dir}/refseq_domtblout_filtered_0.05.txt'
+        generate_filtered_domtblout(domtblout_file_name_refseq, get_refseq_query_ids(number_of_contigs))
+        output_files = [f'{annotation_file[:-4]}_edited{suffix}.gff'
+                        for annotation_file in [*annotation_files, annotation_file_refseq]
+                        for suffix in ('', '_filtered')]
+
+        start = time.perf_counter()
+        make_functional_annotation_table_with_names.make_functional_annotation(
+            profile_list_file_name, domtblout_file_names, annotation_files,
+            domtblout_file_name_refseq, annotation_file_refseq)
+        hmm_protein_files = [f'{domtblout_file_name[:-4]}_with_names_unique.txt'
+                             for domtblout_file_name in [*domtblout_file_names, domtblout_file_name_refseq]]
+        for annotation_file, hmm_protein_file in zip(annotation_files, hmm_protein_files):
+            filter_protein_names_in_annotation.filter_prodigal_annotation(
+                f'{annotation_file[:-4]}_edited.gff', f'{annotation_file[:-4]}_edited_filtered.gff',
+                filter_protein_names_in_annotation.get_protein_name_dict(hmm_protein_file),
+                filter_protein_names_in_annotation.functional_colors)
+        filter_protein_names_in_annotation.filter_refseq_annotation(
+            f'{annotation_file_refseq[:-4]}_edited.gff', f'{annotation_file_refseq[:-4]}_edited_filtered.gff',
+            filter_protein_names_in_annotation.get_protein_name_dict(hmm_protein_files[-1]),
+            filter_protein_names_in_annotation.functional_colors)
+        two_step_elapsed = time.perf_counter() - start
+        for output_file in output_files:
+            os.replace(output_file, f'{output_file}.two_step')
+
+        start = time.perf_counter()
+        make_functional_annotation_table_with_names.make_and_filter_functional_annotation(
+            profile_list_file_name, domtblout_file_names, annotation_files,
+            domtblout_file_name_refseq, annotation_file_refseq,
+            filter_protein_names_in_annotation.functional_colors, workers)
+        single_pass_elapsed = time.perf_counter() - start
+
+        print(f'GFF annotation of {number_of_gff_files + 1} files, two-step: {two_step_elapsed:.2f} s, '
+              f'single pass with {workers} workers: {single_pass_elapsed:.2f} s')
+        different_files = [os.path.basename(output_file) for output_file in output_files
+                           if not filecmp.cmp(f'{output_file}.two_step', output_file, shallow=False)]
+        if different_files:
+            raise SystemExit(f"Single-pass GFF annotation differs from two-step: {', '.join(different_files)}")
+        print('Single-pass GFF annotation identical to two-step')
+
+
+def benchmark_protein_function_index(number_of_contigs: int, number_of_lookups: int = 1_000_000) -> None:
+    """Compare memory and lookup latency of the protein-name dict with the memory-mapped index."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        names_file_name = f'{tmp_dir}/proteins_domtblout_filtered_0.05_with_names_unique.txt'
+        query_ids = get_prodigal_query_ids(number_of_contigs)
+        generate_filtered_domtblout(names_file_name, query_ids, annotated_fraction=1.0)
+        rng = random.Random(0)
+        protein_names = ['_'.join(query_id.split('_')[3:5]) for query_id in rng.choices(query_ids, k=number_of_lookups)]
+        protein_names[::2] = [f'missing_{i}' for i in range(len(protein_names[::2]))]
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        protein_name_dict = filter_protein_names_in_annotation.get_protein_name_dict(names_file_name)
+        load_elapsed = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        start = time.perf_counter()
+        for protein_name in protein_names:
+            protein_name_dict.get(protein_name, 'hp')
+        lookup_elapsed = time.perf_counter() - start
+        print(f'dict of {len(protein_name_dict)} proteins: load {load_elapsed:.2f} s, '
+              f'peak {peak_memory / 2 ** 20:.1f} MB, {lookup_elapsed / number_of_lookups * 1e9:.0f} ns/lookup')
+        del protein_name_dict
+
+        start = time.perf_counter()
+        protein_function_index.open_protein_function_index(names_file_name)
+        build_elapsed = time.perf_counter() - start
+        index_dir = protein_function_index.get_index_dir_name(names_file_name)
+        index_size = sum(os.path.getsize(f'{index_dir}/{file_name}') for file_name in os.listdir(index_dir))
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        protein_name_index = protein_function_index.open_protein_function_index(names_file_name)
+        open_elapsed = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        start = time.perf_counter()
+        for protein_name in protein_names:
+            protein_name_index.get(protein_name, 'hp')
+        lookup_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        protein_name_index.get_function_codes(protein_names)
+        batch_lookup_elapsed = time.perf_counter() - start
+        print(f'index of {len(protein_name_index)} proteins: build {build_elapsed:.2f} s, '
+              f'open {open_elapsed * 1e3:.1f} ms, peak {peak_memory / 2 ** 20:.1f} MB heap, '
+              f'{index_size / 2 ** 20:.1f} MB mapped, {lookup_elapsed / number_of_lookups * 1e9:.0f} ns/lookup, '
+              f'{batch_lookup_elapsed / number_of_lookups * 1e9:.0f} ns/lookup in batch')
+
+
+def benchmark_cluster_sequence_extraction(number_of_proteins: int, workers: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        protein_ids = get_protein_ids(number_of_proteins)
+        proteins_faa = f'{tmp_dir}/proteins.faa'
+        generate_protein_fasta(proteins_faa, protein_ids)
+        cluster_table = f'{tmp_dir}/table_clustering.tsv'
+        number_of_clusters = generate_cluster_table(cluster_table, protein_ids)
+        clusters_dir_name = f'{tmp_dir}/clusters_seqs'
+        get_cluster_sequences.extract_cluster_member_ids(cluster_table, clusters_dir_name)
+
+        engines = ['index'] + (['seqtk'] if shutil.which('seqtk') else [])
+        for engine in engines:
+            start = time.perf_counter()
+            get_cluster_sequences.retrieve_cluster_member_sequences(clusters_dir_name, proteins_faa, workers, engine)
+            print(f'{engine} extraction of {number_of_proteins} proteins into {number_of_clusters} clusters: '
+                  f'{time.perf_counter() - start:.2f} s')
+
+
+def benchmark_clusters_statistics(number_of_proteins: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        protein_ids = get_protein_ids(number_of_proteins)
+        rng = random.Random(0)
+        proteins_sizes = f'{tmp_dir}/proteins_sizes.txt'
+        generate_protein_sizes(proteins_sizes, {protein_id: rng.randint(50, 2_000) for protein_id in protein_ids})
+        cluster_table = f'{tmp_dir}/table_clustering.tsv'
+        number_of_clusters = generate_cluster_table(cluster_table, protein_ids)
+
+        start = time.perf_counter()
+        clusters_dir_name = f'{tmp_dir}/clusters_seqs'
+        get_cluster_sequences.extract_cluster_member_ids(cluster_table, clusters_dir_name)
+        get_cluster_sequences.extract_cluster_member_lengths(cluster_table, clusters_dir_name, proteins_sizes)
+        get_cluster_sequences.calculate_clusters_statistics(clusters_dir_name, tmp_dir)
+        per_cluster_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        statistics_file_name = f'{tmp_dir}/clusters_statistics_columnar.txt'
+        get_cluster_sequences.calculate_clusters_statistics_from_tables(cluster_table, proteins_sizes,
+                                                                        statistics_file_name)
+        columnar_time = time.perf_counter() - start
+
+        per_cluster_df = pd.read_csv(f'{tmp_dir}/clusters_statistics.txt', sep='\t', dtype={'cluster_name': str})
+        columnar_df = pd.read_csv(statistics_file_name, sep='\t', usecols=per_cluster_df.columns.tolist(),
+                                  dtype={'cluster_name': str})
+        print(f'statistics of {number_of_clusters} clusters: per-cluster files {per_cluster_time:.2f} s, '
+              f'columnar {columnar_time:.2f} s')
+        if not per_cluster_df.sort_values('cluster_name', ignore_index=True).equals(
+                columnar_df.sort_values('cluster_name', ignore_index=True)):
+            raise SystemExit('Columnar cluster statistics differ from the per-cluster ones')
+        print('Columnar cluster statistics identical to the per-cluster ones')
+
+
+def benchmark_cluster_layouts(number_of_proteins: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        protein_ids = get_protein_ids(number_of_proteins)
+        proteins_faa = f'{tmp_dir}/proteins.faa'
+        protein_lengths = generate_protein_fasta(proteins_faa, protein_ids)
+        proteins_sizes = f'{tmp_dir}/proteins_sizes.txt'
+        generate_protein_sizes(proteins_sizes, protein_lengths)
+        cluster_table = f'{tmp_dir}/table_clustering.tsv'
+        number_of_clusters = generate_cluster_table(cluster_table, protein_ids)
+
+        layout_members = {}
+        layout_sequences = {}
+        for layout in cluster_layout.CLUSTER_LAYOUTS:
+            clusters_dir_name = f'{tmp_dir}/clusters_seqs_{layout}'
+            start = time.perf_counter()
+            get_cluster_sequences.extract_cluster_member_ids(cluster_table, clusters_dir_name, layout)
+            creation_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            layout_members[layout] = dict(cluster_layout.iter_cluster_members(clusters_dir_name))
+            traversal_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            get_cluster_sequences.retrieve_cluster_member_sequences(clusters_dir_name, proteins_faa)
+            sequences_time = time.perf_counter() - start
+            layout_sequences[layout] = get_cluster_layout_sequences(clusters_dir_name)
+
+            get_cluster_sequences.extract_cluster_member_lengths(cluster_table, clusters_dir_name, proteins_sizes)
+            get_cluster_sequences.calculate_clusters_statistics(clusters_dir_name, clusters_dir_name)
+            number_of_files = sum(len(files) + len(dirs) for _, dirs, files in os.walk(clusters_dir_name))
+            print(f'{layout} layout of {number_of_clusters} clusters: {number_of_files} files and directories, '
+                  f'ids {creation_time:.2f} s, traversal {traversal_time:.2f} s, sequences {sequences_time:.2f} s')
+
+        different_layouts = [layout for layout in cluster_layout.CLUSTER_LAYOUTS
+                             if layout_members[layout] != layout_members['flat'] or
+                             layout_sequences[layout] != layout_sequences['flat']]
+        if different_layouts:
+            raise SystemExit(f'Cluster members or sequences differ from the flat layout: '
+                             f'{", ".join(different_layouts)}')
+        print('Cluster members and sequences identical across layouts')
+
+
+def get_cluster_layout_sequences(clusters_dir_name: PathToFile) -> dict[str, bytes]:
+    if cluster_layout.get_cluster_layout(clusters_dir_name) == 'packed':
+        with open(f'{clusters_dir_name}/{cluster_layout.PACKED_SEQUENCES_FILE_NAME}', 'rb') as packed_faa:
+            records = packed_faa.read()
+        offsets_df = cluster_layout.read_packed_sequences_offsets(clusters_dir_name)
+        return {cluster_name: records[offset:end_offset]
+                for cluster_name, offset, end_offset in offsets_df.itertuples(index=False)}
+    sequences = {}
+    for cluster_name, cluster_dir_name in cluster_layout.iter_cluster_dir_names(clusters_dir_name):
+        with open(f'{cluster_dir_name}/{cluster_name}_ids.faa', 'rb') as cluster_faa:
+            sequences[cluster_name] = cluster_faa.read()
+    return sequences
+
+
+def get_peak_rss() -> int:
+    """Peak resident set size of this process in KiB.
+
+    ``VmHWM`` belongs to the address space and starts afresh after exec, unlike ``ru_maxrss``, which a spawned
+    interpreter inherits from the process that forked it.
+    """
+    with open('/proc/self/status', encoding='utf8') as status_file:
+        for line in status_file:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def load_cluster_dicts(mmseqs2_cluster_table: PathToFile, proteins_sizes: PathToFile) -> int:
+    get_cluster_sequences.get_cluster_members_dict(mmseqs2_cluster_table, Path(tempfile.gettempdir()))
+    get_cluster_sequences.get_cluster_member_lengths(proteins_sizes)
+    return get_peak_rss()
+
+
+def load_cluster_membership(mmseqs2_cluster_table: PathToFile, proteins_sizes: PathToFile) -> int:
+    membership = cluster_membership.read_cluster_membership(mmseqs2_cluster_table)
+    cluster_membership.read_protein_lengths(membership, proteins_sizes)
+    return get_peak_rss()
+
+
+def benchmark_cluster_table_ingestion(number_of_rows: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        protein_ids = get_protein_ids(number_of_rows)
+        cluster_table = f'{tmp_dir}/table_clustering.tsv'
+        number_of_clusters = generate_cluster_table(cluster_table, protein_ids)
+        proteins_sizes = f'{tmp_dir}/proteins_sizes.txt'
+        generate_protein_sizes(proteins_sizes, {protein_id: 50 + n % 2_000 for n, protein_id in enumerate(protein_ids)})
+        del protein_ids
+
+        # every loader runs in a fresh interpreter, so its peak RSS is not hidden by an earlier one
+        spawn_context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn_context) as executor:
+            baseline_max_rss = executor.submit(get_peak_rss).result()
+        for loader in (load_cluster_dicts, load_cluster_membership):
+            start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn_context) as executor:
+                max_rss = executor.submit(loader, cluster_table, proteins_sizes).result()
+            print(f'{loader.__name__} of {number_of_rows} rows in {number_of_clusters} clusters: '
+                  f'{time.perf_counter() - start:.2f} s, peak RSS {(max_rss - baseline_max_rss) / 2 ** 10:.0f} MiB '
+                  f'above interpreter start')
+
+
+def benchmark_spreadsheet_loading(number_of_viruses: int, number_of_profiles: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        vmr_file_name = f'{tmp_dir}/VMR.xlsx'
+        generate_ictv_vmr_table(vmr_file_name, number_of_viruses)
+        profile_list_file_name = f'{tmp_dir}/profile_list.xlsx'
+        generate_profile_list(profile_list_file_name, number_of_profiles)
+
+        start = time.perf_counter()
+        excel_df = pd.read_excel(vmr_file_name).fillna('unknown')
+        profile_list_df = pd.read_excel(profile_list_file_name)
+        excel_profile_name_dict = dict(zip(profile_list_df['profile ID'], profile_list_df.nickname))
+        excel_time = time.perf_counter() - start
+
+        timings = []
+        for _ in range(2):
+            start = time.perf_counter()
+            vmr_df = get_random_genome.read_ictv_vmr_table(vmr_file_name)
+            profile_name_dict = make_functional_annotation_table_with_names.get_profile_name_dict(
+                profile_list_file_name)
+            timings.append(time.perf_counter() - start)
+
+        print(f'VMR with {number_of_viruses} viruses and {number_of_profiles} profiles: read_excel {excel_time:.2f} s, '
+              f'cold snapshot {timings[0]:.2f} s, warm snapshot {timings[1] * 1000:.0f} ms')
+        if not vmr_df.astype(str).equals(excel_df.astype(str)):
+            raise SystemExit('VMR table read from the snapshot differs from read_excel')
+        if profile_name_dict != excel_profile_name_dict:
+            raise SystemExit('Profile names read from the snapshot differ from read_excel')
+        print('Spreadsheets read from snapshots identical to read_excel')
+
+
+def benchmark_stratified_sampling(number_of_viruses: int, replicates: int) -> None:
+    vmr_df = get_ictv_vmr_df(number_of_viruses).fillna('unknown')
+    caudoviricetes_df = vmr_df.query('Class == "Caudoviricetes" and Order != "Crassvirales" and Family != "unknown"')
+
+    start = time.perf_counter()
+    for _ in range(replicates):
+        caudoviricetes_df.groupby('Family', as_index=False, group_keys=False).apply(lambda x: x.sample(min(10, len(x))))
+    apply_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    random_df = get_random_genome.sample_taxonomic_members(caudoviricetes_df, 'Family', 10, replicates=replicates,
+                                                           seed=0)
+    vectorized_time = time.perf_counter() - start
+
+    print(f'{replicates} family samples of {len(caudoviricetes_df)} genomes: groupby-apply {apply_time:.2f} s, '
+          f'vectorized {vectorized_time:.2f} s')
+    family_sizes = caudoviricetes_df.groupby('Family').size()
+    sample_sizes = random_df.groupby(['replicate', 'Family']).size().unstack()
+    if not (sample_sizes == family_sizes.clip(upper=10)).all().all():
+        raise SystemExit('Family samples do not meet their quotas')
+    if not random_df.equals(get_random_genome.sample_taxonomic_members(caudoviricetes_df, 'Family', 10,
+                                                                       replicates=replicates, seed=0)):
+        raise SystemExit('Family samples with the same seed differ between runs')
+    print('Family samples meet their quotas and are reproducible with a seed')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for the crassvirales annotation scripts')
+    parser.add_argument('--queries', type=int, default=200_000,
+                        help='number of synthetic queries (10 domain rows each)')
+    parser.add_argument('--engines', nargs='+', default=list(hmmscan_domtblout_parser.ENGINES),
+                        choices=hmmscan_domtblout_parser.ENGINES)
+    parser.add_argument('--files', type=int, default=8, help='number of domtblout files for the parallel benchmark')
+    parser.add_argument('--contigs', type=int, default=2_000,
+                        help='number of synthetic contigs (50 proteins each) per GFF file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--replicates', type=int, default=500, help='number of replicate reference panels')
+    parser.add_argument('--cluster-rows', type=int, default=10_000_000,
+                        help='number of rows of the synthetic MMseqs2 cluster table for the peak-RSS benchmark')
+    args = parser.parse_args()
+
+    benchmark_domtblout_engines(args.queries, tuple(args.engines))
+    benchmark_parallel_domtblout_filtering(args.queries, args.files, args.workers)
+    benchmark_gff_annotation(args.contigs, args.files, args.workers)
+    benchmark_protein_function_index(args.contigs * 10)
+    benchmark_cluster_sequence_extraction(args.contigs * 50, args.workers)
+    benchmark_clusters_statistics(args.contigs * 50)
+    benchmark_cluster_layouts(args.contigs * 50)
+    benchmark_cluster_table_ingestion(args.cluster_rows)
+    benchmark_spreadsheet_loading(args.contigs * 10, args.contigs)
+    benchmark_stratified_sampling(args.contigs * 10, args.replicates)
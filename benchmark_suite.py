@@ -0,0 +1,339 @@
+#!/usr/bin/python
+import argparse
+from collections.abc import Callable, Sequence
+from datetime import datetime, timezone
+import functools
+import json
+import math
+import os
+import platform
+import statistics
+import tempfile
+import time
+from typing import Any, NamedTuple
+
+import numpy as np
+
+from benchmark_pipeline import (generate_cluster_table, generate_domtblout, generate_filtered_domtblout,
+                                generate_ictv_vmr_table, generate_profile_list, generate_prodigal_gff,
+                                generate_protein_fasta, generate_protein_sizes, generate_refseq_gff,
+                                get_ictv_vmr_df, get_prodigal_query_ids, get_protein_ids, get_refseq_query_ids)
+import cluster_functions
+import cluster_membership
+import filter_protein_names_in_annotation
+import get_cluster_sequences
+import get_random_genome
+import hmmscan_domtblout_parser
+import make_functional_annotation_table_with_names
+
+
+PathToFile = str
+PathToDir = str
+CaseName = str
+CallArguments = tuple[Any, ...]
+
+SWEEP_THRESHOLDS = [(1e-5, 0.5), (1e-10, 0.7), (1e-20, 0.9)]
+REGRESSION_TOLERANCE = 0.25
+
+
+class BenchmarkCase(NamedTuple):
+    """A public function timed on synthetic inputs.
+
+    ``prepare`` writes the inputs of one size into a directory and returns the arguments of ``function``; only the
+    calls of ``function`` are timed. Sizes are multiples of ``base_size`` counted in ``size_unit``.
+    """
+    function: Callable[..., Any]
+    prepare: Callable[[PathToDir, int], CallArguments]
+    size_unit: str
+    base_size: int
+
+
+class Timing(NamedTuple):
+    size: int
+    min_seconds: float
+    median_seconds: float
+
+
+def prepare_domtblout(tmp_dir: PathToDir, number_of_queries: int) -> CallArguments:
+    domtblout_file_name = f'{tmp_dir}/synthetic_domtblout.txt'
+    generate_domtblout(domtblout_file_name, number_of_queries)
+    return (domtblout_file_name,)
+
+
+def prepare_domtblout_engine(engine: str, tmp_dir: PathToDir, number_of_queries: int) -> CallArguments:
+    return (*prepare_domtblout(tmp_dir, number_of_queries), engine)
+
+
+def prepare_threshold_sweep(tmp_dir: PathToDir, number_of_queries: int) -> CallArguments:
+    return (*prepare_domtblout(tmp_dir, number_of_queries), SWEEP_THRESHOLDS)
+
+
+def prepare_prodigal_annotation(tmp_dir: PathToDir, number_of_contigs: int) -> CallArguments:
+    annotation_file = f'{tmp_dir}/prodigal.gff'
+    generate_prodigal_gff(annotation_file, number_of_contigs)
+    names_file_name = f'{tmp_dir}/prodigal_domtblout_filtered_0.05_with_names_unique.txt'
+    generate_filtered_domtblout(names_file_name, get_prodigal_query_ids(number_of_contigs))
+    protein_name_dict = filter_protein_names_in_annotation.get_protein_name_dict(names_file_name)
+    return annotation_file, f'{tmp_dir}/prodigal_edited.gff', protein_name_dict
+
+
+def prepare_refseq_annotation(tmp_dir: PathToDir, number_of_genomes: int) -> CallArguments:
+    annotation_file = f'{tmp_dir}/refseq.gff'
+    generate_refseq_gff(annotation_file, number_of_genomes)
+    names_file_name = f'{tmp_dir}/refseq_domtblout_filtered_0.05_with_names_unique.txt'
+    generate_filtered_domtblout(names_file_name, get_refseq_query_ids(number_of_genomes))
+    protein_name_dict = filter_protein_names_in_annotation.get_protein_name_dict(names_file_name)
+    return annotation_file, f'{tmp_dir}/refseq_edited.gff', protein_name_dict
+
+
+def prepare_prodigal_filtering(tmp_dir: PathToDir, number_of_contigs: int) -> CallArguments:
+    annotation_file, annotation_file_edited, protein_name_dict = prepare_prodigal_annotation(tmp_dir,
+                                                                                             number_of_contigs)
+    make_functional_annotation_table_with_names.make_functional_anotation_for_prodigal(
+        annotation_file, annotation_file_edited, protein_name_dict)
+    return (annotation_file_edited, f'{annotation_file_edited[:-4]}_filtered.gff', protein_name_dict,
+            filter_protein_names_in_annotation.functional_colors)
+
+
+def prepare_refseq_filtering(tmp_dir: PathToDir, number_of_genomes: int) -> CallArguments:
+    annotation_file, annotation_file_edited, protein_name_dict = prepare_refseq_annotation(tmp_dir,
+                                                                                           number_of_genomes)
+    make_functional_annotation_table_with_names.make_functional_anotation_for_refseq(
+        annotation_file, annotation_file_edited, protein_name_dict)
+    return (annotation_file_edited, f'{annotation_file_edited[:-4]}_filtered.gff', protein_name_dict,
+            filter_protein_names_in_annotation.functional_colors)
+
+
+def prepare_single_pass_annotation(tmp_dir: PathToDir, number_of_contigs: int) -> CallArguments:
+    annotation_file, _, protein_name_dict = prepare_prodigal_annotation(tmp_dir, number_of_contigs)
+    return annotation_file, 'prodigal', protein_name_dict, filter_protein_names_in_annotation.functional_colors
+
+
+def prepare_protein_names_table(tmp_dir: PathToDir, number_of_contigs: int) -> CallArguments:
+    names_file_name = f'{tmp_dir}/prodigal_domtblout_filtered_0.05_with_names_unique.txt'
+    generate_filtered_domtblout(names_file_name, get_prodigal_query_ids(number_of_contigs))
+    return (names_file_name,)
+
+
+def prepare_profile_list(tmp_dir: PathToDir, number_of_profiles: int) -> CallArguments:
+    profile_list_file_name = f'{tmp_dir}/profile_list.xlsx'
+    generate_profile_list(profile_list_file_name, number_of_profiles)
+    return (profile_list_file_name,)
+
+
+def prepare_cluster_table(tmp_dir: PathToDir, number_of_proteins: int) -> CallArguments:
+    cluster_table = f'{tmp_dir}/table_clustering.tsv'
+    generate_cluster_table(cluster_table, get_protein_ids(number_of_proteins))
+    return (cluster_table,)
+
+
+def prepare_cluster_member_ids(tmp_dir: PathToDir, number_of_proteins: int) -> CallArguments:
+    return (*prepare_cluster_table(tmp_dir, number_of_proteins), f'{tmp_dir}/clusters_seqs')
+
+
+def prepare_cluster_sequences(tmp_dir: PathToDir, number_of_proteins: int) -> CallArguments:
+    proteins_faa = f'{tmp_dir}/proteins.faa'
+    generate_protein_fasta(proteins_faa, get_protein_ids(number_of_proteins))
+    cluster_table, clusters_dir_name = prepare_cluster_member_ids(tmp_dir, number_of_proteins)
+    get_cluster_sequences.extract_cluster_member_ids(cluster_table, clusters_dir_name)
+    return clusters_dir_name, proteins_faa
+
+
+def prepare_clusters_statistics(tmp_dir: PathToDir, number_of_proteins: int) -> CallArguments:
+    protein_ids = get_protein_ids(number_of_proteins)
+    proteins_sizes = f'{tmp_dir}/proteins_sizes.txt'
+    generate_protein_sizes(proteins_sizes, {protein_id: 50 + n % 2_000 for n, protein_id in enumerate(protein_ids)})
+    return (*prepare_cluster_table(tmp_dir, number_of_proteins), proteins_sizes,
+            f'{tmp_dir}/clusters_statistics.txt')
+
+
+def prepare_cluster_functions(tmp_dir: PathToDir, number_of_proteins: int) -> CallArguments:
+    protein_names_file = f'{tmp_dir}/proteins_with_names_unique.txt'
+    generate_filtered_domtblout(protein_names_file, get_protein_ids(number_of_proteins))
+    return (*prepare_cluster_table(tmp_dir, number_of_proteins), [protein_names_file],
+            f'{tmp_dir}/clusters_functions.txt', f'{tmp_dir}/clusters_function_counts.txt')
+
+
+def prepare_ictv_vmr_table(tmp_dir: PathToDir, number_of_viruses: int) -> CallArguments:
+    vmr_file_name = f'{tmp_dir}/VMR.xlsx'
+    generate_ictv_vmr_table(vmr_file_name, number_of_viruses)
+    return (vmr_file_name,)
+
+
+def prepare_taxonomic_sampling(tmp_dir: PathToDir, number_of_viruses: int) -> CallArguments:
+    vmr_df = get_ictv_vmr_df(number_of_viruses).fillna('unknown')
+    caudoviricetes_df = vmr_df.query('Class == "Caudoviricetes" and Order != "Crassvirales" and Family != "unknown"')
+    return caudoviricetes_df, 'Family', 10, 'fixed', None, 100, 0
+
+
+BENCHMARK_CASES: dict[CaseName, BenchmarkCase] = {
+    **{f'filter_domtblout_{engine}': BenchmarkCase(hmmscan_domtblout_parser.start_hmmscan_domtblout_result_analysis,
+                                                   functools.partial(prepare_domtblout_engine, engine),
+                                                   'queries', 2_000)
+       for engine in hmmscan_domtblout_parser.ENGINES},
+    'sweep_domtblout': BenchmarkCase(hmmscan_domtblout_parser.start_hmmscan_domtblout_threshold_sweep,
+                                     prepare_threshold_sweep, 'queries', 2_000),
+    'read_protein_names_table': BenchmarkCase(filter_protein_names_in_annotation.get_protein_name_dict,
+                                              prepare_protein_names_table, 'contigs', 1_000),
+    'read_profile_list': BenchmarkCase(make_functional_annotation_table_with_names.get_profile_name_dict,
+                                       prepare_profile_list, 'profiles', 1_000),
+    'annotate_prodigal_gff': BenchmarkCase(
+        make_functional_annotation_table_with_names.make_functional_anotation_for_prodigal,
+        prepare_prodigal_annotation, 'contigs', 1_000),
+    'annotate_refseq_gff': BenchmarkCase(
+        make_functional_annotation_table_with_names.make_functional_anotation_for_refseq,
+        prepare_refseq_annotation, 'genomes', 1_000),
+    'filter_prodigal_gff': BenchmarkCase(filter_protein_names_in_annotation.filter_prodigal_annotation,
+                                         prepare_prodigal_filtering, 'contigs', 1_000),
+    'filter_refseq_gff': BenchmarkCase(filter_protein_names_in_annotation.filter_refseq_annotation,
+                                       prepare_refseq_filtering, 'genomes', 1_000),
+    'annotate_and_filter_gff': BenchmarkCase(
+        make_functional_annotation_table_with_names.annotate_and_filter_gff_file,
+        prepare_single_pass_annotation, 'contigs', 1_000),
+    'read_cluster_membership': BenchmarkCase(cluster_membership.read_cluster_membership, prepare_cluster_table,
+                                             'proteins', 50_000),
+    'extract_cluster_member_ids': BenchmarkCase(get_cluster_sequences.extract_cluster_member_ids,
+                                                prepare_cluster_member_ids, 'proteins', 20_000),
+    'retrieve_cluster_member_sequences': BenchmarkCase(get_cluster_sequences.retrieve_cluster_member_sequences,
+                                                       prepare_cluster_sequences, 'proteins', 20_000),
+    'calculate_clusters_statistics': BenchmarkCase(get_cluster_sequences.calculate_clusters_statistics_from_tables,
+                                                   prepare_clusters_statistics, 'proteins', 50_000),
+    'aggregate_cluster_functions': BenchmarkCase(cluster_functions.aggregate_cluster_functions,
+                                                 prepare_cluster_functions, 'proteins', 50_000),
+    'read_ictv_vmr_table': BenchmarkCase(get_random_genome.read_ictv_vmr_table, prepare_ictv_vmr_table,
+                                         'viruses', 2_000),
+    'sample_taxonomic_members': BenchmarkCase(get_random_genome.sample_taxonomic_members,
+                                              prepare_taxonomic_sampling, 'viruses', 10_000),
+}
+
+
+def time_case(case: BenchmarkCase, size: int, repeats: int, warmups: int = 1) -> Timing:
+    """Time ``repeats`` calls after ``warmups`` untimed ones, which fill caches such as spreadsheet snapshots."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        arguments = case.prepare(tmp_dir, size)
+        for _ in range(warmups):
+            case.function(*arguments)
+        elapsed = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            case.function(*arguments)
+            elapsed.append(time.perf_counter() - start)
+    return Timing(size, min(elapsed), statistics.median(elapsed))
+
+
+def get_scaling_exponent(timings: Sequence[Timing]) -> float | None:
+    """Slope of log(time) against log(size): about 1 for linear stages, 2 for quadratic ones."""
+    if len(timings) < 2:
+        return None
+    sizes = np.log([timing.size for timing in timings])
+    seconds = np.log([max(timing.min_seconds, 1e-9) for timing in timings])
+    return float(np.polyfit(sizes, seconds, 1)[0])
+
+
+def run_benchmark_cases(case_names: Sequence[CaseName], scales: Sequence[float],
+                        repeats: int, warmups: int = 1) -> dict[CaseName, list[Timing]]:
+    results: dict[CaseName, list[Timing]] = {}
+    for case_name in case_names:
+        case = BENCHMARK_CASES[case_name]
+        results[case_name] = []
+        for scale in scales:
+            timing = time_case(case, max(1, round(case.base_size * scale)), repeats, warmups)
+            results[case_name].append(timing)
+            print(f'{case_name}: {timing.size} {case.size_unit}, min {timing.min_seconds:.3f} s, '
+                  f'median {timing.median_seconds:.3f} s, {timing.size / timing.min_seconds:,.0f} {case.size_unit}/s')
+        exponent = get_scaling_exponent(results[case_name])
+        if exponent is not None:
+            print(f'{case_name}: time grows as size^{exponent:.2f}')
+    return results
+
+
+def get_results_record(results: dict[CaseName, list[Timing]]) -> dict[str, Any]:
+    return {'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+            'cases': {case_name: {'size_unit': BENCHMARK_CASES[case_name].size_unit,
+                                  'scaling_exponent': get_scaling_exponent(timings),
+                                  'timings': [timing._asdict() for timing in timings]}
+                      for case_name, timings in results.items()}}
+
+
+def write_scaling_curves(results: dict[CaseName, list[Timing]], curves_file_name: PathToFile) -> None:
+    with open(curves_file_name, 'w', encoding='utf8') as curves_file:
+        curves_file.write('case\tsize\tsize_unit\tmin_seconds\tmedian_seconds\n')
+        for case_name, timings in results.items():
+            for timing in timings:
+                curves_file.write(f'{case_name}\t{timing.size}\t{BENCHMARK_CASES[case_name].size_unit}\t'
+                                  f'{timing.min_seconds:.6f}\t{timing.median_seconds:.6f}\n')
+
+
+def write_baseline(results: dict[CaseName, list[Timing]], baseline_file_name: PathToFile) -> None:
+    """Store the timings, merged into an existing baseline so that a run of some cases keeps the others."""
+    baseline: dict[str, Any] = {'cases': {}}
+    if os.path.exists(baseline_file_name):
+        with open(baseline_file_name, encoding='utf8') as baseline_file:
+            baseline = json.load(baseline_file)
+    record = get_results_record(results)
+    record['cases'] = {**baseline['cases'], **record['cases']}
+    with open(f'{baseline_file_name}.tmp', 'w', encoding='utf8') as baseline_file:
+        json.dump(record, baseline_file, indent=2)
+    os.replace(f'{baseline_file_name}.tmp', baseline_file_name)
+
+
+def compare_with_baseline(results: dict[CaseName, list[Timing]], baseline_file_name: PathToFile,
+                          tolerance: float = REGRESSION_TOLERANCE) -> list[str]:
+    """Print the time ratio to the baseline of every size timed in both and return the regressed cases.
+
+    A case regresses when its minimum time at some size exceeds the baseline by more than ``tolerance``.
+    """
+    with open(baseline_file_name, encoding='utf8') as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"compared with {baseline_file_name} ({baseline['created']}, Python {baseline['python']}, "
+          f"{baseline['cpus']} CPUs)")
+    regressed_cases = []
+    for case_name, timings in results.items():
+        if case_name not in baseline['cases']:
+            print(f'{case_name}: not in baseline')
+            continue
+        baseline_seconds = {timing['size']: timing['min_seconds'] for timing in baseline['cases'][case_name]['timings']}
+        ratios = [timing.min_seconds / baseline_seconds[timing.size] for timing in timings
+                  if timing.size in baseline_seconds and baseline_seconds[timing.size] > 0]
+        if not ratios:
+            print(f'{case_name}: no sizes in common with baseline')
+            continue
+        ratio = math.exp(statistics.mean(math.log(ratio) for ratio in ratios))
+        verdict = 'slower' if ratio > 1 + tolerance else 'faster' if ratio < 1 / (1 + tolerance) else 'unchanged'
+        print(f'{case_name}: {ratio:.2f}x baseline time, {verdict}')
+        if verdict == 'slower':
+            regressed_cases.append(case_name)
+    return regressed_cases
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Time the public functions of the crassvirales scripts on '
+                                                 'synthetic inputs of growing size')
+    parser.add_argument('--cases', nargs='+', default=list(BENCHMARK_CASES), choices=BENCHMARK_CASES,
+                        metavar='CASE', help=f'cases to run, default all: {", ".join(BENCHMARK_CASES)}')
+    parser.add_argument('--scales', nargs='+', type=float, default=[1, 2, 4, 8],
+                        help='input sizes as multiples of the base size of every case')
+    parser.add_argument('--repeats', type=int, default=3, help='timed calls per size; the minimum is compared')
+    parser.add_argument('--warmups', type=int, default=1, help='untimed calls per size before the timed ones')
+    parser.add_argument('--curves', help='write the scaling curves to this TSV file')
+    parser.add_argument('--save-baseline', help='store the timings in this JSON baseline file')
+    parser.add_argument('--baseline', help='compare the timings with this JSON baseline file')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                        help='relative slow-down that counts as a regression')
+    parser.add_argument('--check', action='store_true', help='exit with an error when a case regressed')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    benchmark_results = run_benchmark_cases(args.cases, args.scales, args.repeats, args.warmups)
+    if args.curves:
+        write_scaling_curves(benchmark_results, args.curves)
+    regressions = []
+    if args.baseline:
+        regressions = compare_with_baseline(benchmark_results, args.baseline, args.tolerance)
+    if args.save_baseline:
+        write_baseline(benchmark_results, args.save_baseline)
+    if args.check and regressions:
+        raise SystemExit(f"Slower than baseline: {', '.join(regressions)}")
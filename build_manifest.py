@@ -0,0 +1,109 @@
+from collections.abc import Callable, Iterable, Mapping
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+from typing import Any
+
+
+PathToFile = str
+StageName = str
+Parameters = Mapping[str, Any]
+
+HASH_BLOCK_SIZE = 2 ** 20
+
+
+def get_file_sha256(file_name: PathToFile) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_name, 'rb') as input_file:
+        while block := input_file.read(HASH_BLOCK_SIZE):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+class BuildManifest:
+    """JSON record of what every pipeline stage was last built from.
+
+    For each stage it keeps the content hashes of its input files and its parameters. A stage is up to date when
+    all of its outputs exist and neither changed. File hashes are cached by size and modification time, so
+    unchanged inputs are not re-read on every run.
+    """
+
+    def __init__(self, manifest_file_name: PathToFile) -> None:
+        self.manifest_file_name = manifest_file_name
+        self.stages: dict[StageName, dict[str, Any]] = {}
+        self.file_hashes: dict[PathToFile, dict[str, Any]] = {}
+        if os.path.exists(manifest_file_name):
+            with open(manifest_file_name, encoding='utf8') as manifest_file:
+                manifest = json.load(manifest_file)
+            self.stages = manifest['stages']
+            self.file_hashes = manifest['file_hashes']
+
+    def get_file_hash(self, file_name: PathToFile) -> str:
+        stat = os.stat(file_name)
+        cached = self.file_hashes.get(file_name)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['sha256']
+        file_hash = get_file_sha256(file_name)
+        self.file_hashes[file_name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_hash}
+        return file_hash
+
+    def get_signature(self, inputs: Iterable[PathToFile], parameters: Parameters) -> dict[str, Any]:
+        """Hashes of the inputs and the parameters, taken before a stage runs and recorded once it finished."""
+        return {'inputs': {input_file_name: self.get_file_hash(input_file_name) for input_file_name in inputs},
+                'parameters': json.loads(json.dumps(parameters, sort_keys=True, default=str))}
+
+    def is_up_to_date(self, stage_name: StageName, outputs: Iterable[PathToFile], signature: dict[str, Any]) -> bool:
+        stage = self.stages.get(stage_name)
+        if stage is None or not all(os.path.exists(output) for output in outputs):
+            return False
+        return stage['signature'] == signature
+
+    def invalidate(self, stage_name: StageName) -> None:
+        """Forget a stage, so an interrupted rebuild is never mistaken for a finished one."""
+        if self.stages.pop(stage_name, None) is not None:
+            self.save()
+
+    def record(self, stage_name: StageName, outputs: Iterable[PathToFile], signature: dict[str, Any]) -> None:
+        # the signature is taken before the stage ran, so an input changed meanwhile rebuilds the stage next time
+        self.stages[stage_name] = {'outputs': list(outputs), 'signature': signature}
+        self.save()
+
+    def save(self) -> None:
+        Path(self.manifest_file_name).parent.mkdir(parents=True, exist_ok=True)
+        tmp_file_name = f'{self.manifest_file_name}.tmp'
+        with open(tmp_file_name, 'w', encoding='utf8') as manifest_file:
+            json.dump({'stages': self.stages, 'file_hashes': self.file_hashes}, manifest_file, indent=2)
+        os.replace(tmp_file_name, self.manifest_file_name)
+
+
+def remove_outputs(outputs: Iterable[PathToFile]) -> None:
+    for output in outputs:
+        if os.path.isdir(output):
+            shutil.rmtree(output)
+        elif os.path.exists(output):
+            os.remove(output)
+
+
+def run_stage(manifest: BuildManifest | None, stage_name: StageName, outputs: Iterable[PathToFile],
+              inputs: Iterable[PathToFile], parameters: Parameters,
+              function: Callable[..., Any], *args: Any, clean_outputs: bool = False, **kwargs: Any) -> bool:
+    """Run ``function(*args, **kwargs)`` unless the manifest says the stage is up to date; return whether it ran.
+
+    With ``clean_outputs`` stale outputs are deleted before a tracked stage is rebuilt, for stages whose leftovers
+    (e.g. the directory of a cluster that no longer exists) would otherwise be picked up downstream.
+    """
+    outputs = list(outputs)
+    if manifest is not None:
+        signature = manifest.get_signature(inputs, parameters)
+        if manifest.is_up_to_date(stage_name, outputs, signature):
+            print(f'{stage_name}: up to date, skipped')
+            return False
+        manifest.invalidate(stage_name)
+        if clean_outputs:
+            remove_outputs(outputs)
+    function(*args, **kwargs)
+    if manifest is not None:
+        manifest.record(stage_name, outputs, signature)
+    return True
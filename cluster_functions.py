@@ -0,0 +1,189 @@
+#!/usr/bin/python
+from collections.abc import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+
+from build_manifest import BuildManifest, run_stage
+from cluster_membership import CLUSTER_TABLE_CHUNK_ROWS, ClusterMembership, encode_names, read_cluster_membership
+from compressed_io import open_file
+from filter_protein_names_in_annotation import FunctionalColors, functional_colors
+from gff_rewriter import OTHER_FUNCTION, UNKNOWN_FUNCTION
+from protein_function_index import MISSING_FUNCTION_CODE
+from stage_profiler import profiled
+
+
+PathToFile = str
+ProteinName = str
+
+
+def iter_protein_function_chunks(protein_names_file_names: Iterable[PathToFile],
+                                 chunk_rows: int) -> Iterator[pd.DataFrame]:
+    for protein_names_file_name in protein_names_file_names:
+        with open_file(protein_names_file_name) as protein_names_file:
+            yield from pd.read_csv(protein_names_file, sep='\t', usecols=['#HMM_family', 'Query_ID'], dtype=object,
+                                   keep_default_na=False, chunksize=chunk_rows)
+
+
+def read_protein_function_codes(membership: ClusterMembership, protein_names_file_names: Iterable[PathToFile],
+                                chunk_rows: int = CLUSTER_TABLE_CHUNK_ROWS) -> tuple[np.ndarray, list[ProteinName]]:
+    """Function codes of the membership's proteins indexed by protein ID, and the sorted functions they index.
+
+    The ``_with_names_unique.txt`` tables are streamed chunk by chunk and matched to the cluster table on the full
+    protein ID. Proteins without a function get ``MISSING_FUNCTION_CODE``; a protein listed twice keeps its last
+    function.
+    """
+    protein_function_codes = np.full(len(membership.protein_names), MISSING_FUNCTION_CODE, dtype=np.int32)
+    function_codes: dict[ProteinName, int] = {}
+    if not len(membership.protein_names):
+        return protein_function_codes, []
+    for chunk in iter_protein_function_chunks(protein_names_file_names, chunk_rows):
+        protein_names = encode_names(chunk['Query_ID'])
+        positions = np.searchsorted(membership.protein_names, protein_names).clip(
+            max=len(membership.protein_names) - 1)
+        found = membership.protein_names[positions] == protein_names
+        chunk_codes, chunk_functions = pd.factorize(chunk['#HMM_family'])
+        chunk_function_codes = np.array([function_codes.setdefault(function, len(function_codes))
+                                         for function in chunk_functions], dtype=np.int32)
+        protein_function_codes[positions[found]] = chunk_function_codes[chunk_codes[found]]
+
+    # alphabetical codes make ties for the dominant function go to the alphabetically first one
+    functions = sorted(function_codes)
+    sorted_codes = {function: code for code, function in enumerate(functions)}
+    code_ranks = np.array([sorted_codes[function] for function in function_codes], dtype=np.int32)
+    is_annotated = protein_function_codes != MISSING_FUNCTION_CODE
+    protein_function_codes[is_annotated] = code_ranks[protein_function_codes[is_annotated]]
+    return protein_function_codes, functions
+
+
+def count_cluster_functions(membership: ClusterMembership, protein_function_codes: np.ndarray,
+                            number_of_functions: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Members of every (cluster, function) pair with at least one member, sorted by cluster and function.
+
+    Returns the cluster IDs, the function codes and the member counts of the pairs.
+    """
+    member_function_codes = protein_function_codes[membership.members]
+    is_annotated = member_function_codes != MISSING_FUNCTION_CODE
+    # a pair is one integer, so counting them is a single sort of the annotated members
+    pair_keys = membership.get_member_cluster_ids()[is_annotated].astype(np.int64) * number_of_functions + \
+        member_function_codes[is_annotated]
+    pair_keys, member_counts = np.unique(pair_keys, return_counts=True)
+    return ((pair_keys // max(number_of_functions, 1)).astype(np.int32),
+            (pair_keys % max(number_of_functions, 1)).astype(np.int32), member_counts)
+
+
+def get_dominant_functions(cluster_ids: np.ndarray, function_codes: np.ndarray,
+                           member_counts: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Cluster IDs with a function, their most common function and its member count."""
+    order = np.lexsort((function_codes, -member_counts, cluster_ids))
+    is_first = np.ones(len(order), dtype=np.bool_)
+    np.not_equal(cluster_ids[order][1:], cluster_ids[order][:-1], out=is_first[1:])
+    dominant_pairs = order[is_first]
+    return cluster_ids[dominant_pairs], function_codes[dominant_pairs], member_counts[dominant_pairs]
+
+
+def get_cluster_functions_df(membership: ClusterMembership, protein_function_codes: np.ndarray,
+                             functions: list[ProteinName], functional_colors: FunctionalColors,
+                             ) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Per-cluster summary of the member functions, and the member count of every function of every cluster.
+
+    Clusters without annotated members have the dominant function 'hp'. Purity is the share of annotated members
+    with the dominant function. The functional category is the dominant function where ``functional_colors`` has
+    a color for it and 'other_known_functions' otherwise, as in the filtered GFFs.
+    """
+    cluster_ids, function_codes, member_counts = count_cluster_functions(membership, protein_function_codes,
+                                                                         len(functions))
+    number_of_clusters = len(membership.cluster_names)
+    cluster_names = pd.Series(membership.cluster_names.astype(str))
+    function_names = pd.Categorical.from_codes(function_codes, categories=functions) if functions \
+        else pd.Categorical([])
+    counts_df = pd.DataFrame({'cluster_name': cluster_names.to_numpy()[cluster_ids],
+                              'function': function_names,
+                              'members': member_counts})
+
+    annotated_members = np.bincount(cluster_ids, weights=member_counts, minlength=number_of_clusters).astype(np.int64)
+    dominant_cluster_ids, dominant_codes, dominant_counts = get_dominant_functions(cluster_ids, function_codes,
+                                                                                   member_counts)
+    dominant_functions = np.full(number_of_clusters, UNKNOWN_FUNCTION, dtype=object)
+    dominant_functions[dominant_cluster_ids] = np.array(functions, dtype=object)[dominant_codes]
+    dominant_members = np.zeros(number_of_clusters, dtype=np.int64)
+    dominant_members[dominant_cluster_ids] = dominant_counts
+
+    categories = pd.Series(dominant_functions).where(pd.Series(dominant_functions).isin(list(functional_colors)),
+                                                     OTHER_FUNCTION)
+    summary_df = pd.DataFrame({
+        'cluster_name': cluster_names,
+        'cluster_members_number': membership.get_cluster_sizes(),
+        'annotated_members_number': annotated_members,
+        'functions_number': np.bincount(cluster_ids, minlength=number_of_clusters),
+        'dominant_function': dominant_functions,
+        'dominant_function_members': dominant_members,
+        'purity': (dominant_members / np.where(annotated_members > 0, annotated_members, np.nan)).round(4),
+        'annotated_fraction': (annotated_members / membership.get_cluster_sizes()).round(4),
+        'functional_category': categories,
+        'color': categories.map(functional_colors),
+    })
+    return summary_df, counts_df
+
+
+def write_table(df: pd.DataFrame, file_name: PathToFile) -> None:
+    if file_name.endswith('.parquet'):
+        df.to_parquet(file_name, index=False)
+    else:
+        with open_file(file_name, 'w') as table_file:
+            df.to_csv(table_file, sep='\t', index=False)
+
+
+def get_cluster_functions_outputs(mmseqs2_cluster_table: PathToFile, protein_names_file_names: list[PathToFile],
+                                  summary_file_name: PathToFile, counts_file_name: PathToFile | None = None,
+                                  *_: object) -> list[PathToFile]:
+    return [summary_file_name] + ([counts_file_name] if counts_file_name else [])
+
+
+@profiled(inputs=('mmseqs2_cluster_table', 'protein_names_file_names'), outputs=get_cluster_functions_outputs)
+def aggregate_cluster_functions(mmseqs2_cluster_table: PathToFile, protein_names_file_names: list[PathToFile],
+                                summary_file_name: PathToFile, counts_file_name: PathToFile | None = None,
+                                functional_colors: FunctionalColors = functional_colors,
+                                chunk_rows: int = CLUSTER_TABLE_CHUNK_ROWS) -> None:
+    """Join the MMseqs2 clusters with the function of their members from ``_with_names_unique.txt`` tables.
+
+    Writes one row per cluster with its dominant function, purity and functional category and, with
+    ``counts_file_name``, the member count of every function of every cluster. Both tables are streamed into
+    integer arrays, so memory grows with the number of proteins, not with their names; a ``.parquet`` file name
+    writes Parquet.
+    """
+    membership = read_cluster_membership(mmseqs2_cluster_table, chunk_rows)
+    protein_function_codes, functions = read_protein_function_codes(membership, protein_names_file_names,
+                                                                    chunk_rows)
+    summary_df, counts_df = get_cluster_functions_df(membership, protein_function_codes, functions,
+                                                     functional_colors)
+    write_table(summary_df, summary_file_name)
+    if counts_file_name:
+        write_table(counts_df, counts_file_name)
+
+
+def main(mmseqs2_cluster_table: PathToFile, protein_names_file_names: list[PathToFile], results_dir: str,
+         manifest: BuildManifest | None = None, file_format: str = 'txt') -> None:
+    summary_file_name = f'{results_dir}/clusters_functions.{file_format}'
+    counts_file_name = f'{results_dir}/clusters_function_counts.{file_format}'
+    run_stage(manifest, 'cluster_functions', [summary_file_name, counts_file_name],
+              [mmseqs2_cluster_table, *protein_names_file_names], {'functional_colors': functional_colors},
+              aggregate_cluster_functions, mmseqs2_cluster_table, protein_names_file_names, summary_file_name,
+              counts_file_name)
+
+
+if __name__ == '__main__':
+    mmseqs2_cluster_table = '/mnt/c/crassvirales/phylomes/results/crassvirales_refseq/' \
+                            '6_protein_clustering/table_clustering.tsv'
+    hmmscan_results_path = '/mnt/c/crassvirales/functional_annotation/crassvirales_confirmed/hmmscan_results'
+    protein_names_file_names = [f'{hmmscan_results_path}/all_genomes_without_refseq_{genetic_code}_'
+                                f'domtblout_filtered_0.05_with_names_unique.txt'
+                                for genetic_code in ('meta', 'table_4', 'table_11', 'table_11_TAG_Q',
+                                                     'table_11_TGA_W', 'table_15', 'table_25')]
+    protein_names_file_names.append(f'{hmmscan_results_path}/all_refseq_proteins_domtblout_filtered_0.05_'
+                                    f'with_names_unique.txt')
+
+    results_dir = '/mnt/c/crassvirales/phylomes/results/crassvirales_refseq/'
+
+    main(mmseqs2_cluster_table, protein_names_file_names, results_dir,
+         BuildManifest(f'{results_dir}/pipeline_manifest.json'))
@@ -0,0 +1,132 @@
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
+import subprocess
+import threading
+import time
+from typing import NamedTuple, TextIO
+
+
+PathToFile = str
+
+JOB_LOG_HEADER = ('cluster_name', 'threads', 'exit_status', 'start_time', 'elapsed_seconds')
+
+SMALL_CLUSTER_SIZE = 200  # clusters up to this many sequences are aligned single-threaded
+SEQUENCES_PER_THREAD = 500
+
+
+class ClusterJob(NamedTuple):
+    """A shell command that writes ``output_file_name`` for one cluster using ``threads`` CPUs.
+
+    The command must write to ``{output_file_name}.tmp``; the file is renamed only after a zero exit status,
+    so an existing ``output_file_name`` always means the job completed. What the command prints to stdout and
+    stderr is kept in ``{output_file_name}.stderr`` only when the job fails.
+    """
+    cluster_name: str
+    command: str
+    output_file_name: PathToFile
+    input_file_names: tuple[PathToFile, ...] = ()
+    threads: int = 1
+    size: int = 1
+
+
+def is_job_complete(job: ClusterJob) -> bool:
+    """A job is complete when its output exists and is not older than any of its inputs."""
+    if not os.path.exists(job.output_file_name):
+        return False
+    output_mtime = os.path.getmtime(job.output_file_name)
+    return all(os.path.getmtime(input_file_name) <= output_mtime for input_file_name in job.input_file_names)
+
+
+def get_job_threads(cluster_size: int, max_threads: int) -> int:
+    """Give small clusters one thread and large ones one more thread per ``SEQUENCES_PER_THREAD`` sequences."""
+    if cluster_size <= SMALL_CLUSTER_SIZE:
+        return 1
+    return max(1, min(max_threads, 1 + cluster_size // SEQUENCES_PER_THREAD))
+
+
+class CpuBudget:
+    """Counting semaphore that hands out several CPUs to a job at once."""
+
+    def __init__(self, cpus: int) -> None:
+        self.cpus = cpus
+        self.free_cpus = cpus
+        self.condition = threading.Condition()
+
+    def acquire(self, cpus: int) -> None:
+        with self.condition:
+            self.condition.wait_for(lambda: self.free_cpus >= cpus)
+            self.free_cpus -= cpus
+
+    def release(self, cpus: int) -> None:
+        with self.condition:
+            self.free_cpus += cpus
+            self.condition.notify_all()
+
+
+def run_cluster_job(job: ClusterJob, cpu_budget: CpuBudget) -> tuple[int, float, float]:
+    threads = min(job.threads, cpu_budget.cpus)
+    cpu_budget.acquire(threads)
+    returncode = -1
+    try:
+        start_time = time.time()
+        start = time.perf_counter()
+        ps = subprocess.Popen(job.command, shell=True, executable="/bin/bash",
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        messages = ps.communicate()[0]
+        elapsed = time.perf_counter() - start
+        returncode = ps.returncode
+        if returncode == 0:
+            os.replace(f'{job.output_file_name}.tmp', job.output_file_name)
+            if os.path.exists(f'{job.output_file_name}.stderr'):
+                os.remove(f'{job.output_file_name}.stderr')
+        else:
+            # one file per job, so messages of concurrent jobs stay apart
+            with open(f'{job.output_file_name}.stderr', 'wb') as stderr_file:
+                stderr_file.write(messages)
+    finally:
+        cpu_budget.release(threads)
+        # a failed job leaves no partial output behind
+        if returncode != 0 and os.path.exists(f'{job.output_file_name}.tmp'):
+            os.remove(f'{job.output_file_name}.tmp')
+    return returncode, start_time, elapsed
+
+
+def run_and_log_cluster_job(job: ClusterJob, cpu_budget: CpuBudget,
+                            job_log_file: TextIO, log_lock: threading.Lock) -> int:
+    exit_status, start_time, elapsed = run_cluster_job(job, cpu_budget)
+    with log_lock:
+        job_log_file.write(f'{job.cluster_name}\t{min(job.threads, cpu_budget.cpus)}\t{exit_status}\t'
+                           f'{start_time:.3f}\t{elapsed:.3f}\n')
+        job_log_file.flush()
+    return exit_status
+
+
+def run_cluster_jobs(jobs: Iterable[ClusterJob], cpus: int, job_log_file_name: PathToFile) -> None:
+    """Run cluster jobs concurrently without using more than ``cpus`` CPUs in total.
+
+    Complete jobs are skipped, so an interrupted run can simply be restarted. Large jobs are
+    started first to keep the tail of the run short. Exit status and timing of every job are appended to
+    ``job_log_file_name``. Failed jobs do not stop the others; a ``RuntimeError`` naming them is raised once all
+    jobs finished, so the stage is not recorded as complete and a rerun retries them. The messages of a failed job
+    are in ``{output_file_name}.stderr``.
+    """
+    pending_jobs = sorted((job for job in jobs if not is_job_complete(job)),
+                          key=lambda job: job.size, reverse=True)
+    write_header = not os.path.exists(job_log_file_name)
+    with open(job_log_file_name, 'a', encoding='utf8') as job_log_file, \
+            ThreadPoolExecutor(max_workers=cpus) as executor:
+        if write_header:
+            job_log_file.write('\t'.join(JOB_LOG_HEADER) + '\n')
+        run_job = partial(run_and_log_cluster_job, cpu_budget=CpuBudget(cpus), job_log_file=job_log_file,
+                          log_lock=threading.Lock())
+        futures = [executor.submit(run_job, job) for job in pending_jobs]
+        failed_clusters = []
+        for job, future in zip(pending_jobs, futures):
+            if future.exception() is not None or future.result() != 0:
+                failed_clusters.append(job.cluster_name)
+
+    if failed_clusters:
+        raise RuntimeError(f'{len(failed_clusters)} of {len(pending_jobs)} cluster jobs failed '
+                           f"(see {job_log_file_name}): {', '.join(failed_clusters)}")
@@ -0,0 +1,181 @@
+from collections.abc import Iterator, Mapping, Sequence
+import hashlib
+import itertools
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cluster_membership import ClusterMembership
+from fasta_index import extract_sequence_groups, pack_sequence_groups
+
+
+PathToFile = str
+PathToDir = str
+ClusterName = str
+ProteinId = str
+
+CLUSTER_LAYOUTS = ('flat', 'hashed', 'packed')
+LAYOUT_FILE_NAME = 'layout.txt'
+HASH_PREFIX_LENGTH = 2  # 256 subdirectories
+
+PACKED_MEMBERS_FILE_NAME = 'cluster_members.tsv'
+PACKED_INDEX_FILE_NAME = 'cluster_index.tsv'
+PACKED_SEQUENCES_FILE_NAME = 'cluster_sequences.faa'
+PACKED_SEQUENCES_OFFSETS_FILE_NAME = 'cluster_sequences_offsets.tsv'
+PACKED_LENGTHS_FILE_NAME = 'cluster_member_lengths.tsv'
+PACKED_ALIGNMENTS_DIR_NAME = 'alignments'
+PACKED_INDEX_COLUMNS = ('cluster_name', 'size')
+
+
+def get_cluster_layout(clusters_dir_name: PathToDir) -> str:
+    """Layout recorded in ``clusters_dir_name``; directories written before layouts existed are 'flat'."""
+    layout_file_name = f'{clusters_dir_name}/{LAYOUT_FILE_NAME}'
+    if not os.path.exists(layout_file_name):
+        return 'flat'
+    with open(layout_file_name, encoding='utf8') as layout_file:
+        return layout_file.read().strip()
+
+
+def get_hash_prefix(cluster_name: ClusterName) -> str:
+    return hashlib.md5(cluster_name.encode('utf8')).hexdigest()[:HASH_PREFIX_LENGTH]
+
+
+def get_cluster_dir_name(clusters_dir_name: PathToDir, cluster_name: ClusterName, layout: str) -> PathToDir:
+    if layout == 'hashed':
+        return f'{clusters_dir_name}/{get_hash_prefix(cluster_name)}/{cluster_name}'
+    return f'{clusters_dir_name}/{cluster_name}'
+
+
+def write_cluster_members(cluster_members: Mapping[ClusterName, Sequence[ProteinId]], clusters_dir_name: PathToDir,
+                          layout: str = 'flat') -> None:
+    """Store cluster member IDs in one of ``CLUSTER_LAYOUTS``.
+
+    'flat' keeps the original directory per cluster, 'hashed' spreads those directories over hash-prefixed
+    subdirectories and 'packed' writes all clusters into one member table, whose sequences later go into one FASTA
+    with a byte-offset table.
+    """
+    if layout not in CLUSTER_LAYOUTS:
+        raise ValueError(f'Unknown cluster layout {layout}, expected one of {CLUSTER_LAYOUTS}')
+    Path(clusters_dir_name).mkdir(parents=True, exist_ok=True)
+    with open(f'{clusters_dir_name}/{LAYOUT_FILE_NAME}', 'w', encoding='utf8') as layout_file:
+        layout_file.write(f'{layout}\n')
+
+    if layout == 'packed':
+        with open(f'{clusters_dir_name}/{PACKED_MEMBERS_FILE_NAME}', 'w', encoding='utf8') as members_file, \
+                open(f'{clusters_dir_name}/{PACKED_INDEX_FILE_NAME}', 'w', encoding='utf8') as index_file:
+            index_file.write('\t'.join(PACKED_INDEX_COLUMNS) + '\n')
+            for cluster_name, members in cluster_members.items():
+                members_file.writelines([f'{cluster_name}\t{member}\n' for member in members])
+                index_file.write(f'{cluster_name}\t{len(members)}\n')
+        return
+
+    for cluster_name, members in cluster_members.items():
+        cluster_dir_name = get_cluster_dir_name(clusters_dir_name, cluster_name, layout)
+        Path(cluster_dir_name).mkdir(parents=True, exist_ok=True)
+        with open(f'{cluster_dir_name}/{cluster_name}_ids.txt', 'w', encoding='utf8') as cluster_ids:
+            cluster_ids.writelines([f'{member}\n' for member in members])
+
+
+def iter_cluster_dir_names(clusters_dir_name: PathToDir) -> Iterator[tuple[ClusterName, PathToDir]]:
+    """Yield the name and directory of every cluster of a 'flat' or 'hashed' layout."""
+    layout = get_cluster_layout(clusters_dir_name)
+    if layout == 'packed':
+        raise ValueError(f'{clusters_dir_name} is packed and has no per-cluster directories')
+    parent_dir_names = [clusters_dir_name]
+    if layout == 'hashed':
+        parent_dir_names = [entry.path for entry in os.scandir(clusters_dir_name) if entry.is_dir()]
+    for parent_dir_name in parent_dir_names:
+        for entry in os.scandir(parent_dir_name):
+            if entry.is_dir():
+                yield entry.name, f'{parent_dir_name}/{entry.name}'
+
+
+def read_packed_cluster_index(clusters_dir_name: PathToDir) -> pd.DataFrame:
+    return pd.read_csv(f'{clusters_dir_name}/{PACKED_INDEX_FILE_NAME}', sep='\t', dtype={'cluster_name': str},
+                       keep_default_na=False)
+
+
+def iter_packed_table_groups(table_file_name: PathToFile) -> Iterator[tuple[ClusterName, list[list[str]]]]:
+    """Group the rows of a packed table, which are stored cluster by cluster, without loading the whole table."""
+    with open(table_file_name, encoding='utf8') as table_file:
+        rows = (line.rstrip('\n').split('\t') for line in table_file)
+        for cluster_name, cluster_rows in itertools.groupby(rows, key=lambda row: row[0]):
+            yield cluster_name, [row[1:] for row in cluster_rows]
+
+
+def read_cluster_member_ids(cluster_name: ClusterName, cluster_dir_name: PathToDir) -> list[ProteinId]:
+    with open(f'{cluster_dir_name}/{cluster_name}_ids.txt', encoding='utf8') as ids_file:
+        return [line.split('\t', 1)[0].strip() for line in ids_file]
+
+
+def iter_cluster_members(clusters_dir_name: PathToDir) -> Iterator[tuple[ClusterName, list[ProteinId]]]:
+    """Yield every cluster with its member IDs, whatever the layout."""
+    if get_cluster_layout(clusters_dir_name) == 'packed':
+        for cluster_name, rows in iter_packed_table_groups(f'{clusters_dir_name}/{PACKED_MEMBERS_FILE_NAME}'):
+            yield cluster_name, [row[0] for row in rows]
+        return
+    for cluster_name, cluster_dir_name in iter_cluster_dir_names(clusters_dir_name):
+        yield cluster_name, read_cluster_member_ids(cluster_name, cluster_dir_name)
+
+
+def iter_cluster_sizes(clusters_dir_name: PathToDir) -> Iterator[tuple[ClusterName, int]]:
+    if get_cluster_layout(clusters_dir_name) == 'packed':
+        index_df = read_packed_cluster_index(clusters_dir_name)
+        yield from zip(index_df['cluster_name'], index_df['size'].tolist())
+        return
+    for cluster_name, cluster_dir_name in iter_cluster_dir_names(clusters_dir_name):
+        with open(f'{cluster_dir_name}/{cluster_name}_ids.txt', encoding='utf8') as ids_file:
+            yield cluster_name, sum(1 for _ in ids_file)
+
+
+def write_cluster_sequences(clusters_dir_name: PathToDir, proteins_faa: PathToFile) -> None:
+    """Write the member sequences of every cluster next to its IDs, or all of them into the packed FASTA."""
+    if get_cluster_layout(clusters_dir_name) == 'packed':
+        pack_sequence_groups(proteins_faa, iter_cluster_members(clusters_dir_name),
+                             f'{clusters_dir_name}/{PACKED_SEQUENCES_FILE_NAME}',
+                             f'{clusters_dir_name}/{PACKED_SEQUENCES_OFFSETS_FILE_NAME}')
+        return
+    extract_sequence_groups(proteins_faa, ((f'{cluster_dir_name}/{cluster_name}_ids.faa',
+                                            read_cluster_member_ids(cluster_name, cluster_dir_name))
+                                           for cluster_name, cluster_dir_name in
+                                           iter_cluster_dir_names(clusters_dir_name)))
+
+
+def read_packed_sequences_offsets(clusters_dir_name: PathToDir) -> pd.DataFrame:
+    return pd.read_csv(f'{clusters_dir_name}/{PACKED_SEQUENCES_OFFSETS_FILE_NAME}', sep='\t',
+                       dtype={'group_name': str}, keep_default_na=False)
+
+
+def write_cluster_member_lengths(clusters_dir_name: PathToDir, membership: ClusterMembership,
+                                 member_lengths: np.ndarray) -> None:
+    """Write the member lengths of every cluster to its ``_lengths.txt``, or all of them into one packed table.
+
+    ``member_lengths`` holds the length of every entry of ``membership.members``; only one cluster's member names
+    are decoded at a time.
+    """
+    layout = get_cluster_layout(clusters_dir_name)
+    clusters = ((cluster_name.decode('utf8'), membership.get_cluster_members(cluster_id),
+                 member_lengths[membership.offsets[cluster_id]:membership.offsets[cluster_id + 1]].tolist())
+                for cluster_id, cluster_name in enumerate(membership.cluster_names))
+    if layout == 'packed':
+        with open(f'{clusters_dir_name}/{PACKED_LENGTHS_FILE_NAME}', 'w', encoding='utf8') as lengths_file:
+            for cluster_name, members, lengths in clusters:
+                lengths_file.writelines([f'{cluster_name}\t{member}\t{length}\n'
+                                         for member, length in zip(members, lengths)])
+        return
+    for cluster_name, members, lengths in clusters:
+        cluster_dir_name = get_cluster_dir_name(clusters_dir_name, cluster_name, layout)
+        with open(f'{cluster_dir_name}/{cluster_name}_lengths.txt', 'w', encoding='utf8') as lengths_file:
+            lengths_file.writelines([f'{member}\t{length}\n' for member, length in zip(members, lengths)])
+
+
+def iter_cluster_member_lengths(clusters_dir_name: PathToDir) -> Iterator[tuple[ClusterName, list[int]]]:
+    if get_cluster_layout(clusters_dir_name) == 'packed':
+        for cluster_name, rows in iter_packed_table_groups(f'{clusters_dir_name}/{PACKED_LENGTHS_FILE_NAME}'):
+            yield cluster_name, [int(row[1]) for row in rows]
+        return
+    for cluster_name, cluster_dir_name in iter_cluster_dir_names(clusters_dir_name):
+        with open(f'{cluster_dir_name}/{cluster_name}_lengths.txt', encoding='utf8') as lengths_file:
+            yield cluster_name, [int(line.split('\t')[1]) for line in lengths_file]
@@ -0,0 +1,152 @@
+from collections.abc import Iterator, Mapping
+
+import numpy as np
+import pandas as pd
+
+from compressed_io import open_file
+
+
+PathToFile = str
+ClusterName = str
+ProteinId = str
+
+CLUSTER_TABLE_CHUNK_ROWS = 200_000
+MISSING_LENGTH = -1
+
+
+class ClusterMembership(Mapping[ClusterName, list[ProteinId]]):
+    """MMseqs2 clusters stored as integer arrays instead of a dict of string lists.
+
+    Cluster and protein names are interned into fixed-width byte arrays whose positions are their integer IDs:
+    clusters in the order in which the table first lists them, proteins sorted. The members of cluster ``i`` are
+    ``members[offsets[i]:offsets[i + 1]]`` (CSR layout), in cluster-table order.
+    """
+
+    def __init__(self, cluster_names: np.ndarray, protein_names: np.ndarray,
+                 offsets: np.ndarray, members: np.ndarray) -> None:
+        self.cluster_names = cluster_names
+        self.protein_names = protein_names
+        self.offsets = offsets
+        self.members = members
+        self.cluster_name_order = np.argsort(cluster_names)
+
+    def get_cluster_id(self, cluster_name: ClusterName) -> int:
+        key = cluster_name.encode('utf8')
+        position = int(np.searchsorted(self.cluster_names, key, sorter=self.cluster_name_order))
+        if position < len(self.cluster_names) and self.cluster_names[self.cluster_name_order[position]] == key:
+            return int(self.cluster_name_order[position])
+        raise KeyError(cluster_name)
+
+    def __getitem__(self, cluster_name: ClusterName) -> list[ProteinId]:
+        return self.get_cluster_members(self.get_cluster_id(cluster_name))
+
+    def __len__(self) -> int:
+        return len(self.cluster_names)
+
+    def __iter__(self) -> Iterator[ClusterName]:
+        return (cluster_name.decode('utf8') for cluster_name in self.cluster_names)
+
+    def items(self) -> Iterator[tuple[ClusterName, list[ProteinId]]]:  # type: ignore[override]
+        # walk the clusters in ID order instead of looking every name up again
+        for cluster_id, cluster_name in enumerate(self.cluster_names):
+            yield cluster_name.decode('utf8'), self.get_cluster_members(cluster_id)
+
+    def get_cluster_members(self, cluster_id: int) -> list[ProteinId]:
+        member_ids = self.members[self.offsets[cluster_id]:self.offsets[cluster_id + 1]]
+        return [protein_name.decode('utf8') for protein_name in self.protein_names[member_ids]]
+
+    def get_cluster_sizes(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def get_member_cluster_ids(self) -> np.ndarray:
+        """Cluster ID of every entry of ``members``."""
+        return np.repeat(np.arange(len(self.cluster_names), dtype=np.int32), self.get_cluster_sizes())
+
+
+def iter_table_chunks(table_file_name: PathToFile, column_names: list[str],
+                      chunk_rows: int) -> Iterator[pd.DataFrame]:
+    with open_file(table_file_name) as table_file:
+        yield from pd.read_csv(table_file, sep='\t', header=None, names=column_names, dtype=object,
+                               keep_default_na=False, chunksize=chunk_rows)
+
+
+def encode_names(names: pd.Series | pd.Index) -> np.ndarray:
+    # MMseqs2 and Prodigal protein IDs are ASCII, which NumPy encodes without a Python bytes object per name
+    return names.to_numpy(dtype=object).astype(np.bytes_)
+
+
+def concatenate_names(name_chunks: list[np.ndarray]) -> np.ndarray:
+    return np.concatenate(name_chunks) if name_chunks else np.zeros(0, dtype=np.bytes_)
+
+
+def get_sorted_name_ids(names: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Sorted unique names and the int32 ID of every input name; ``np.unique`` with a smaller peak footprint."""
+    permutation = np.argsort(names)
+    sorted_names = names[permutation]
+    del names
+    is_new_name = np.ones(len(sorted_names), dtype=np.bool_)
+    np.not_equal(sorted_names[1:], sorted_names[:-1], out=is_new_name[1:])
+    unique_names = sorted_names[is_new_name]
+    del sorted_names
+    name_ids = np.empty(len(permutation), dtype=np.int32)
+    name_ids[permutation] = np.cumsum(is_new_name, dtype=np.int32) - 1
+    return unique_names, name_ids
+
+
+def get_first_appearance_ids(names: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Unique names in order of first appearance and the ID of every input name."""
+    unique_names, first_positions, name_ids = np.unique(names, return_index=True, return_inverse=True)
+    order = np.argsort(first_positions)
+    ranks = np.empty(len(order), dtype=np.int32)
+    ranks[order] = np.arange(len(order), dtype=np.int32)
+    return unique_names[order], ranks[name_ids]
+
+
+def read_cluster_membership(mmseqs2_cluster_table: PathToFile,
+                            chunk_rows: int = CLUSTER_TABLE_CHUNK_ROWS) -> ClusterMembership:
+    """Read ``table_clustering.tsv`` chunk by chunk into a ``ClusterMembership``.
+
+    Only one chunk of Python strings is alive at a time; everything kept across chunks is a NumPy array.
+    """
+    chunk_cluster_name_chunks: list[np.ndarray] = []
+    member_cluster_code_chunks: list[np.ndarray] = []
+    protein_name_chunks: list[np.ndarray] = []
+    number_of_chunk_cluster_names = 0
+    for chunk in iter_table_chunks(mmseqs2_cluster_table, ['cluster_name', 'protein_id'], chunk_rows):
+        chunk_codes, chunk_cluster_names = pd.factorize(chunk['cluster_name'])
+        member_cluster_code_chunks.append(chunk_codes.astype(np.int32) + number_of_chunk_cluster_names)
+        chunk_cluster_name_chunks.append(encode_names(chunk_cluster_names))
+        number_of_chunk_cluster_names += len(chunk_cluster_names)
+        protein_name_chunks.append(encode_names(chunk['protein_id']))
+
+    # a cluster that spans a chunk boundary is listed in both chunks, so chunk names are interned once more
+    cluster_names, chunk_cluster_ids = get_first_appearance_ids(concatenate_names(chunk_cluster_name_chunks))
+    del chunk_cluster_name_chunks
+    member_cluster_ids = chunk_cluster_ids[np.concatenate(member_cluster_code_chunks or [np.zeros(0, np.int32)])]
+    del member_cluster_code_chunks
+    protein_names, protein_ids = get_sorted_name_ids(concatenate_names(protein_name_chunks))
+    del protein_name_chunks
+
+    order = np.argsort(member_cluster_ids, kind='stable')
+    offsets = np.zeros(len(cluster_names) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(member_cluster_ids, minlength=len(cluster_names)), out=offsets[1:])
+    members = protein_ids[order]
+    return ClusterMembership(cluster_names, protein_names, offsets, members)
+
+
+def read_protein_lengths(membership: ClusterMembership, proteins_sizes: PathToFile,
+                         chunk_rows: int = CLUSTER_TABLE_CHUNK_ROWS) -> np.ndarray:
+    """Lengths of the membership's proteins indexed by protein ID, streamed from a ``protein<TAB>length`` table.
+
+    Proteins that are not in the table get ``MISSING_LENGTH``; a protein listed twice keeps its last length.
+    """
+    protein_lengths = np.full(len(membership.protein_names), MISSING_LENGTH, dtype=np.int64)
+    if not len(membership.protein_names):
+        return protein_lengths
+    for chunk in iter_table_chunks(proteins_sizes, ['protein_id', 'protein_length'], chunk_rows):
+        protein_names = encode_names(chunk['protein_id'])
+        positions = np.searchsorted(membership.protein_names, protein_names).clip(
+            max=len(membership.protein_names) - 1)
+        found = membership.protein_names[positions] == protein_names
+        protein_lengths[positions[found]] = chunk['protein_length'].to_numpy(dtype=np.int64)[found]
+    return protein_lengths
@@ -0,0 +1,184 @@
+import gzip
+import io
+import os
+import shutil
+import signal
+import subprocess
+from typing import IO, Any
+
+try:
+    import zstandard
+except ImportError:  # zstd files are then piped through the zstd command line tool
+    zstandard = None
+
+try:
+    from Bio import bgzf
+except ImportError:  # BGZF files are then written by the bgzip command line tool
+    bgzf = None  # type: ignore[assignment]
+
+
+PathToFile = str
+
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.bgz': 'bgzip', '.zst': 'zstd'}
+COMPRESSION_THREADS_ENV = 'CRASSVIRALES_COMPRESSION_THREADS'
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+PIPE_BUFFER_SIZE = 2 ** 20
+
+
+class CommandPipe(io.RawIOBase):
+    """Raw stream through a (de)compression command that reads or writes ``file_name``."""
+
+    def __init__(self, command: list[str], file_name: PathToFile, mode: str) -> None:
+        super().__init__()
+        self.command = command
+        self.file_name = file_name
+        self.mode = mode
+        self.file = open(file_name, mode)
+        if mode == 'rb':
+            self.process = subprocess.Popen(command, stdin=self.file, stdout=subprocess.PIPE)
+            stream = self.process.stdout
+        else:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.file)
+            stream = self.process.stdin
+        assert stream is not None
+        self.stream: IO[bytes] = stream
+
+    def readable(self) -> bool:
+        return self.mode == 'rb'
+
+    def writable(self) -> bool:
+        return self.mode == 'wb'
+
+    def readinto(self, buffer: Any) -> int:
+        return self.stream.readinto(buffer)  # type: ignore[attr-defined]
+
+    def write(self, data: Any) -> int:
+        return self.stream.write(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.stream.close()
+        return_code = self.process.wait()
+        self.file.close()
+        super().close()
+        # a reader that stops early closes the pipe, which the command sees as SIGPIPE
+        if return_code and not (self.mode == 'rb' and return_code == -signal.SIGPIPE):
+            raise OSError(f'{self.command[0]} exited with {return_code} on {self.file_name}')
+
+
+class BgzfRawWriter(io.RawIOBase):
+    """``Bio.bgzf.BgzfWriter`` as a raw stream, so it can be buffered and wrapped for text."""
+
+    def __init__(self, file_name: PathToFile) -> None:
+        super().__init__()
+        self.writer = bgzf.BgzfWriter(file_name, 'wb', compresslevel=GZIP_LEVEL)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        self.writer.write(bytes(data))
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.writer.close()
+        super().close()
+
+
+def get_compression_threads() -> int:
+    return int(os.environ.get(COMPRESSION_THREADS_ENV, os.cpu_count() or 1))
+
+
+def split_compression_suffix(file_name: PathToFile) -> tuple[PathToFile, str]:
+    for suffix in COMPRESSION_SUFFIXES:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)], suffix
+    return file_name, ''
+
+
+def get_derived_file_name(file_name: PathToFile, ending: str, replaced_length: int = 4) -> PathToFile:
+    """Replace the last ``replaced_length`` characters of the uncompressed name, keeping the compression suffix.
+
+    'proteins_domtblout.txt.gz' with '_filtered_0.05.txt' gives 'proteins_domtblout_filtered_0.05.txt.gz'.
+    """
+    base_name, suffix = split_compression_suffix(file_name)
+    return base_name[:-replaced_length] + ending + suffix
+
+
+def get_compression(file_name: PathToFile) -> str | None:
+    """Compression of an existing file from its first bytes: 'gzip', 'bgzip', 'zstd' or None for plain text.
+
+    BGZF is gzip whose header has the extra field 'BC', so it can be read as plain gzip as well.
+    """
+    with open(file_name, 'rb') as input_file:
+        header = input_file.read(14)
+    if header.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    if header.startswith(GZIP_MAGIC):
+        return 'bgzip' if len(header) == 14 and header[3] & 4 and header[12:14] == b'BC' else 'gzip'
+    return None
+
+
+def open_compressed_reader(file_name: PathToFile, compression: str) -> io.BufferedIOBase:
+    if compression in ('gzip', 'bgzip'):
+        # decompressing in another process overlaps it with parsing
+        gzip_command = shutil.which('pigz') or shutil.which('gzip')
+        if gzip_command:
+            return io.BufferedReader(CommandPipe([gzip_command, '-dc'], file_name, 'rb'), PIPE_BUFFER_SIZE)
+        return gzip.open(file_name, 'rb')
+    if zstandard is not None:
+        return zstandard.open(file_name, 'rb')
+    if shutil.which('zstd'):
+        return io.BufferedReader(CommandPipe(['zstd', '-dcq'], file_name, 'rb'), PIPE_BUFFER_SIZE)
+    raise ImportError(f'Reading {file_name} needs the zstandard package or the zstd command')
+
+
+def open_compressed_writer(file_name: PathToFile, compression: str) -> io.BufferedIOBase:
+    threads = get_compression_threads()
+    if compression == 'gzip':
+        if shutil.which('pigz'):
+            command = ['pigz', '-c', f'-{GZIP_LEVEL}', '-p', str(threads)]
+            return io.BufferedWriter(CommandPipe(command, file_name, 'wb'), PIPE_BUFFER_SIZE)
+        return gzip.open(file_name, 'wb', compresslevel=GZIP_LEVEL)
+    if compression == 'bgzip':
+        if shutil.which('bgzip'):
+            command = ['bgzip', '-c', '-l', str(GZIP_LEVEL), '-@', str(threads)]
+            return io.BufferedWriter(CommandPipe(command, file_name, 'wb'), PIPE_BUFFER_SIZE)
+        if bgzf is None:
+            raise ImportError(f'Writing {file_name} needs Biopython or the bgzip command')
+        return io.BufferedWriter(BgzfRawWriter(file_name), PIPE_BUFFER_SIZE)
+    if zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=threads)
+        return zstandard.open(file_name, 'wb', cctx=compressor)
+    if shutil.which('zstd'):
+        command = ['zstd', '-cq', f'-{ZSTD_LEVEL}', f'-T{threads}']
+        return io.BufferedWriter(CommandPipe(command, file_name, 'wb'), PIPE_BUFFER_SIZE)
+    raise ImportError(f'Writing {file_name} needs the zstandard package or the zstd command')
+
+
+def open_file(file_name: PathToFile, mode: str = 'r', encoding: str = 'utf8') -> Any:
+    """``open`` for plain, gzip, BGZF and zstd files.
+
+    Files are read according to their first bytes and written according to their suffix ('.gz', '.bgz', '.zst').
+    Compression uses ``CRASSVIRALES_COMPRESSION_THREADS`` threads (default: all CPUs) where pigz, bgzip or zstd
+    support it. ``mode`` is one of 'r', 'rb', 'w' and 'wb'.
+    """
+    if mode not in ('r', 'rb', 'w', 'wb'):
+        raise ValueError(f'Unsupported mode {mode!r}')
+    if mode.startswith('r'):
+        compression = get_compression(file_name)
+    else:
+        compression = COMPRESSION_SUFFIXES.get(split_compression_suffix(file_name)[1])
+    if compression is None:
+        return open(file_name, mode, encoding=None if mode.endswith('b') else encoding)
+
+    if mode.startswith('r'):
+        binary_file = open_compressed_reader(file_name, compression)
+    else:
+        binary_file = open_compressed_writer(file_name, compression)
+    return binary_file if mode.endswith('b') else io.TextIOWrapper(binary_file, encoding=encoding)
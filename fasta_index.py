@@ -0,0 +1,188 @@
+import bisect
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from contextlib import contextmanager, nullcontext
+import mmap
+import os
+import re
+from typing import IO, Any, TypeVar
+
+import pandas as pd
+
+from compressed_io import get_compression, open_file
+
+try:
+    from Bio import bgzf
+except ImportError:  # only needed for BGZF-compressed FASTA files
+    bgzf = None  # type: ignore[assignment]
+
+
+PathToFile = str
+SequenceId = str
+GroupKey = TypeVar('GroupKey')
+SequenceGroup = tuple[GroupKey, Sequence[SequenceId]]
+
+INDEX_COLUMNS = ('name', 'header_offset', 'sequence_offset', 'end_offset')
+PACKED_OFFSETS_COLUMNS = ('group_name', 'offset', 'end_offset')
+VIRTUAL_OFFSET_COLUMN = 'virtual_offset'
+INDEX_BLOCK_SIZE = 16 * 2 ** 20
+BGZF_CACHED_BLOCKS = 1024  # 64 MiB of decompressed blocks
+
+HEADER_PATTERN = re.compile(rb'^>', re.MULTILINE)
+WHITESPACE_PATTERN = re.compile(rb'\s')
+
+
+def get_fasta_index_file_name(fasta_file_name: PathToFile) -> PathToFile:
+    return f'{fasta_file_name}.offsets'
+
+
+def iter_fasta_index_rows(fasta_file: IO[bytes]) -> Iterator[tuple[bytes, int, int, int]]:
+    """Yield the name and the header, sequence and end offsets of every record of an uncompressed stream."""
+    offset = 0
+    remainder = b''
+    last_header: tuple[bytes, int, int] | None = None
+    while True:
+        block = fasta_file.read(INDEX_BLOCK_SIZE)
+        chunk = remainder + block
+        # cut blocks at line ends, so that every header line lies in one chunk
+        cut = len(chunk) if not block else chunk.rfind(b'\n') + 1
+        chunk, remainder = chunk[:cut], chunk[cut:]
+        for match in HEADER_PATTERN.finditer(chunk):
+            header_offset = match.start()
+            if last_header is not None:
+                yield *last_header, offset + header_offset
+            sequence_offset = chunk.find(b'\n', header_offset) + 1 or len(chunk)
+            name = WHITESPACE_PATTERN.split(chunk[header_offset + 1:sequence_offset], 1)[0]
+            last_header = name, offset + header_offset, offset + sequence_offset
+        offset += len(chunk)
+        if not block:
+            break
+    if last_header is not None:
+        yield *last_header, offset
+
+
+def get_bgzf_virtual_offsets(fasta_file_name: PathToFile, offsets: Sequence[int]) -> list[int]:
+    """BGZF virtual offsets (block start << 16 | offset in block) of sorted uncompressed offsets."""
+    with open(fasta_file_name, 'rb') as fasta_file:
+        blocks = [(block_start, data_start) for block_start, _, data_start, data_length in bgzf.BgzfBlocks(fasta_file)
+                  if data_length]
+    block_data_starts = [data_start for _, data_start in blocks]
+    virtual_offsets = []
+    for offset in offsets:
+        block_start, data_start = blocks[bisect.bisect_right(block_data_starts, offset) - 1]
+        virtual_offsets.append(bgzf.make_virtual_offset(block_start, offset - data_start))
+    return virtual_offsets
+
+
+def build_fasta_index(fasta_file_name: PathToFile, index_file_name: PathToFile) -> None:
+    """Write the byte offsets of every record's header, sequence and end, in file order.
+
+    Unlike a ``.fai`` the header offset is kept, so records can be copied with their description. Offsets are
+    positions in the uncompressed sequence; a BGZF-compressed FASTA also gets the virtual offset of each header.
+    """
+    with open_file(fasta_file_name, 'rb') as fasta_file:
+        rows: list[tuple[Any, ...]] = list(iter_fasta_index_rows(fasta_file))
+    columns = list(INDEX_COLUMNS)
+    if get_compression(fasta_file_name) == 'bgzip':
+        virtual_offsets = get_bgzf_virtual_offsets(fasta_file_name, [row[1] for row in rows])
+        rows = [(*row, virtual_offset) for row, virtual_offset in zip(rows, virtual_offsets)]
+        columns.append(VIRTUAL_OFFSET_COLUMN)
+    with open(f'{index_file_name}.tmp', 'w', encoding='utf8') as index:
+        index.write('\t'.join(columns) + '\n')
+        for name, *offsets in rows:
+            index.write('\t'.join([name.decode('utf8'), *map(str, offsets)]) + '\n')
+    os.replace(f'{index_file_name}.tmp', index_file_name)
+
+
+def get_random_access_compression(fasta_file_name: PathToFile) -> str | None:
+    """Compression of a FASTA file that records can be read from by offset: 'bgzip' or None for plain text."""
+    compression = get_compression(fasta_file_name)
+    if compression not in ('bgzip', None):
+        raise ValueError(f'{fasta_file_name} is {compression}-compressed without random access, '
+                         f'recompress it with bgzip')
+    return compression
+
+
+def load_fasta_index(fasta_file_name: PathToFile) -> pd.DataFrame:
+    """Read the persisted offset index of a FASTA file, building it first if it is missing or stale.
+
+    FASTA files without random access are rejected before they are read.
+    """
+    get_random_access_compression(fasta_file_name)
+    index_file_name = get_fasta_index_file_name(fasta_file_name)
+    if not os.path.exists(index_file_name) or os.path.getmtime(index_file_name) < os.path.getmtime(fasta_file_name):
+        build_fasta_index(fasta_file_name, index_file_name)
+    return pd.read_csv(index_file_name, sep='\t', index_col=None, dtype={'name': str}, keep_default_na=False)
+
+
+def format_fasta_record(fasta: mmap.mmap | bytes, header_offset: int, sequence_offset: int, end_offset: int) -> bytes:
+    """Return a record the way ``seqtk subseq`` prints it: ``>name comment`` and the sequence on one line."""
+    name, *comment = WHITESPACE_PATTERN.split(fasta[header_offset + 1:sequence_offset].rstrip(b'\r\n'), 1)
+    header = b'>' + name + (b' ' + comment[0] if comment and comment[0] else b'')
+    sequence = fasta[sequence_offset:end_offset].replace(b'\n', b'').replace(b'\r', b'')
+    return header + b'\n' + sequence + b'\n'
+
+
+@contextmanager
+def open_fasta_records(fasta_file_name: PathToFile, index_df: pd.DataFrame) -> Iterator[Callable[[int], bytes]]:
+    """Give a function that returns the record at a position of the index, formatted by ``format_fasta_record``.
+
+    Plain files are memory-mapped and BGZF files are read block-wise from their virtual offsets; other compressed
+    files have no random access.
+    """
+    offsets = index_df[['header_offset', 'sequence_offset', 'end_offset']].to_numpy().tolist()
+    compression = get_random_access_compression(fasta_file_name)
+    if compression == 'bgzip':
+        virtual_offsets = index_df[VIRTUAL_OFFSET_COLUMN].tolist()
+        with bgzf.BgzfReader(fasta_file_name, 'rb', max_cache=BGZF_CACHED_BLOCKS) as fasta:
+            def read_bgzf_record(position: int) -> bytes:
+                header_offset, sequence_offset, end_offset = offsets[position]
+                fasta.seek(virtual_offsets[position])
+                record = fasta.read(end_offset - header_offset)
+                return format_fasta_record(record, 0, sequence_offset - header_offset, end_offset - header_offset)
+            yield read_bgzf_record
+    else:
+        with open(fasta_file_name, 'rb') as fasta_file, \
+                mmap.mmap(fasta_file.fileno(), 0, access=mmap.ACCESS_READ) if offsets else nullcontext(b'') as fasta:
+            yield lambda position: format_fasta_record(fasta, *offsets[position])
+
+
+def iter_sequence_group_records(fasta_file_name: PathToFile,
+                                groups: Iterable[SequenceGroup[GroupKey]]) -> Iterator[tuple[GroupKey, bytes]]:
+    """Yield every group's key with its records, read through a single index of the input.
+
+    Records are returned in input-file order and once each; IDs missing from the FASTA are ignored, as with
+    ``seqtk subseq``.
+    """
+    index_df = load_fasta_index(fasta_file_name)
+    positions_by_name: dict[SequenceId, list[int]] = {}
+    for position, name in enumerate(index_df['name']):
+        positions_by_name.setdefault(name, []).append(position)
+
+    with open_fasta_records(fasta_file_name, index_df) as read_record:
+        for group_key, sequence_ids in groups:
+            positions = sorted({position for sequence_id in sequence_ids
+                                for position in positions_by_name.get(sequence_id, ())})
+            yield group_key, b''.join(read_record(position) for position in positions)
+
+
+def extract_sequence_groups(fasta_file_name: PathToFile,
+                            groups: Iterable[tuple[PathToFile, Sequence[SequenceId]]]) -> None:
+    """Write each group of sequence IDs to its own FASTA file."""
+    for output_file_name, records in iter_sequence_group_records(fasta_file_name, groups):
+        with open(output_file_name, 'wb') as output_file:
+            output_file.write(records)
+
+
+def pack_sequence_groups(fasta_file_name: PathToFile, groups: Iterable[tuple[str, Sequence[SequenceId]]],
+                         packed_fasta_file_name: PathToFile, offsets_file_name: PathToFile) -> None:
+    """Write all groups one after another into a single FASTA file and the byte range of each group to a table."""
+    with open(f'{packed_fasta_file_name}.tmp', 'wb') as packed_fasta, \
+            open(f'{offsets_file_name}.tmp', 'w', encoding='utf8') as offsets_file:
+        offsets_file.write('\t'.join(PACKED_OFFSETS_COLUMNS) + '\n')
+        offset = 0
+        for group_name, records in iter_sequence_group_records(fasta_file_name, groups):
+            packed_fasta.write(records)
+            offsets_file.write(f'{group_name}\t{offset}\t{offset + len(records)}\n')
+            offset += len(records)
+    os.replace(f'{packed_fasta_file_name}.tmp', packed_fasta_file_name)
+    os.replace(f'{offsets_file_name}.tmp', offsets_file_name)
@@ -2,6 +2,12 @@ from collections.abc import Iterable, Mapping
 
 import pandas as pd
 
+from build_manifest import BuildManifest, run_stage
+from compressed_io import get_derived_file_name, open_file
+from gff_rewriter import GffNameOutput, get_prodigal_protein_key, get_refseq_protein_key, rewrite_gff_names
+from protein_function_index import get_index_dir_name, open_protein_function_index
+from stage_profiler import profiled
+
 
 Color = str
 ProfileId = str
@@ -29,8 +35,10 @@ functional_colors = {"gene86": "#a16a2e", "PDDEXK_alpha": "#6600cc",
                      'hp': '#808080', 'other_known_functions': '#d3d3d3'}
 
 
+@profiled(inputs=('file_name',))
 def get_protein_name_dict(file_name: PathToFile) -> dict[ProfileId, ProteinName]:
-    df = pd.read_csv(file_name, index_col=None, sep='\t')
+    with open_file(file_name) as input_file:
+        df = pd.read_csv(input_file, index_col=None, sep='\t')
     protein_name_dict = dict(zip(df['Query_ID'],
                                  df['#HMM_family']))
 
@@ -39,66 +47,48 @@ def get_protein_name_dict(file_name: PathToFile) -> dict[ProfileId, ProteinName]
     return protein_name_dict
 
 
+@profiled(inputs=('annotation_file',), outputs=('annotation_file_edited',))
 def filter_prodigal_annotation(annotation_file: PathToFile, annotation_file_edited: PathToFile,
                                protein_name_dict: Mapping[ProfileId, ProteinName],
                                functional_colors: FunctionalColors) -> None:
-    with open(annotation_file, encoding='utf-8') as file, \
-         open(annotation_file_edited, 'w', encoding='utf-8') as result:
-        for line in file:
-            line = line.split('\t')
-            if not line[0].startswith('#'):
-                description = line[-1].split(';')
-                _, protein_number = description[0].rsplit('_', 1)
-                protein_name = '_'.join([line[0], protein_number])
-                protein_name_function = protein_name_dict.get(protein_name, 'hp')
-
-                if protein_name_function not in functional_colors:
-                    protein_name_function = 'other_known_functions'
-
-                protein_name_function_line = f'name={protein_name_function}'
-                description_edited = ';'.join([description[0], protein_name_function_line,
-                                               *description[2:]])
-                line_edited = '\t'.join([*line[:-1], description_edited])
-
-                result.write(line_edited)
+    rewrite_gff_names(annotation_file, [GffNameOutput(annotation_file_edited, functional_colors)],
+                      protein_name_dict, get_prodigal_protein_key, replace_name=True)
 
 
+@profiled(inputs=('annotation_file',), outputs=('annotation_file_edited',))
 def filter_refseq_annotation(annotation_file: PathToFile, annotation_file_edited: PathToFile,
                              protein_name_dict: Mapping[ProfileId, ProteinName],
                              functional_colors: FunctionalColors) -> None:
+    rewrite_gff_names(annotation_file, [GffNameOutput(annotation_file_edited, functional_colors)],
+                      protein_name_dict, get_refseq_protein_key, replace_name=True)
 
-    with open(annotation_file, encoding='utf-8') as file, \
-            open(annotation_file_edited, 'w', encoding='utf-8') as result:
-        for line in file:
-            line = line.split('\t')
-            if not line[0].startswith('#'):
-                description = line[-1].split(';')
-                _, protein_name = description[0].rsplit('-', 1)
-                protein_name_function = protein_name_dict.get(protein_name, 'hp')
 
-                if protein_name_function not in functional_colors:
-                    protein_name_function = 'other_known_functions'
-
-                protein_name_function_line = f'name={protein_name_function}'
-                description_edited = ';'.join([description[0], protein_name_function_line,
-                                               *description[2:]])
-                line_edited = '\t'.join([*line[:-1], description_edited])
-
-                result.write(line_edited)
+def filter_annotation_file(annotation_file: PathToFile, hmm_protein_file: PathToFile, annotation_source: str,
+                           functional_colors: FunctionalColors) -> None:
+    protein_name_index = open_protein_function_index(hmm_protein_file)
+    annotation_file_edited = get_derived_file_name(annotation_file, "_filtered.gff")
+    if annotation_source == 'prodigal':
+        filter_prodigal_annotation(annotation_file, annotation_file_edited,
+                                   protein_name_index, functional_colors)
+    else:
+        filter_refseq_annotation(annotation_file, annotation_file_edited,
+                                 protein_name_index, functional_colors)
 
 
 def filter_annotations(annotation_files: Iterable[PathToFile], hmm_protein_files: Iterable[PathToFile],
-                       functional_colors: FunctionalColors) -> None:
-    for annotation_file, hmm_protein_file in zip(annotation_files, hmm_protein_files):
-        protein_name_dict = get_protein_name_dict(hmm_protein_file)
-        annotation_file_edited = annotation_file[:-4] + "_filtered.gff"
-        filter_prodigal_annotation(annotation_file, annotation_file_edited,
-                                   protein_name_dict, functional_colors)
+                       annotation_refseq_file: PathToFile | None, hmm_protein_refseq_file: PathToFile | None,
+                       functional_colors: FunctionalColors, manifest: BuildManifest | None = None) -> None:
+    jobs = [(annotation_file, hmm_protein_file, 'prodigal')
+            for annotation_file, hmm_protein_file in zip(annotation_files, hmm_protein_files)]
+    if annotation_refseq_file is not None and hmm_protein_refseq_file is not None:
+        jobs.append((annotation_refseq_file, hmm_protein_refseq_file, 'refseq'))
 
-    protein_name_dict = get_protein_name_dict(hmm_protein_refseq_file)
-    annotation_file_edited = annotation_refseq_file[:-4] + "_filtered.gff"
-    filter_refseq_annotation(annotation_refseq_file, annotation_file_edited,
-                             protein_name_dict, functional_colors)
+    for annotation_file, hmm_protein_file, annotation_source in jobs:
+        run_stage(manifest, f'filter_gff:{annotation_file}',
+                  [get_derived_file_name(annotation_file, "_filtered.gff"), get_index_dir_name(hmm_protein_file)],
+                  [annotation_file, hmm_protein_file],
+                  {'annotation_source': annotation_source, 'functional_colors': functional_colors},
+                  filter_annotation_file, annotation_file, hmm_protein_file, annotation_source, functional_colors)
 
 
 if __name__ == "__main__":
@@ -129,4 +119,6 @@ if __name__ == "__main__":
 
     hmm_protein_refseq_file = f'{path}/all_refseq_proteins_domtblout_filtered_0.05_with_names_unique.txt'
 
-    filter_annotations(annotation_files, hmm_protein_files, functional_colors)
+    manifest = BuildManifest('/mnt/c/crassvirales/functional_annotation/crassvirales_confirmed/pipeline_manifest.json')
+    filter_annotations(annotation_files, hmm_protein_files, annotation_refseq_file, hmm_protein_refseq_file,
+                       functional_colors, manifest)
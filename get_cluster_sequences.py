@@ -1,13 +1,23 @@
 from collections import defaultdict
+from collections.abc import Iterator, Mapping, Sequence
 import os
 from pathlib import Path
-import subprocess
 
+import numpy as np
 import pandas as pd
 
+from build_manifest import BuildManifest, run_stage
+from cluster_job_scheduler import ClusterJob, get_job_threads, run_cluster_jobs
+from cluster_layout import PACKED_ALIGNMENTS_DIR_NAME, PACKED_SEQUENCES_FILE_NAME, get_cluster_layout, \
+    get_hash_prefix, iter_cluster_dir_names, iter_cluster_member_lengths, iter_cluster_sizes, \
+    read_packed_sequences_offsets, write_cluster_member_lengths, write_cluster_members, write_cluster_sequences
+from cluster_membership import MISSING_LENGTH, ClusterMembership, read_cluster_membership, read_protein_lengths
+from compressed_io import open_file
+from stage_profiler import profiled
+
 
 def get_cluster_members_dict(mmseqs2_cluster_table: str, clusters_dir: Path) -> defaultdict:
-    with open(mmseqs2_cluster_table, encoding='utf8') as cluster_table:
+    with open_file(mmseqs2_cluster_table) as cluster_table:
         if not clusters_dir.is_dir():
             clusters_dir.mkdir(parents=True, exist_ok=True)
         result = defaultdict(list)
@@ -17,30 +27,37 @@ def get_cluster_members_dict(mmseqs2_cluster_table: str, clusters_dir: Path) ->
         return result
 
 
-def write_cluster_member_ids_to_file(cluster_dict: defaultdict, clusters_dir_name: str) -> None:
-    for cluster_name, cluster_members in cluster_dict.items():
-        cluster_dir = Path(f'{clusters_dir_name}/{cluster_name}')
-        if not cluster_dir.is_dir():
-            cluster_dir.mkdir(parents=True, exist_ok=True)
-        with open(f'{cluster_dir}/{cluster_name}_ids.txt', 'w', encoding='utf8') as cluster_ids:
-            cluster_ids.writelines([f'{line}\n' for line in cluster_members])
+def write_cluster_member_ids_to_file(cluster_dict: Mapping[str, Sequence[str]], clusters_dir_name: str,
+                                     layout: str = 'flat') -> None:
+    write_cluster_members(cluster_dict, clusters_dir_name, layout)
+
 
+@profiled(inputs=('proteins_faa',), outputs=('clusters_dir_name',))
+def retrieve_cluster_member_sequences(clusters_dir_name: str, proteins_faa: str, cpus: int = 1,
+                                      engine: str = 'index') -> None:
+    """Write every cluster's member sequences.
 
-def retrieve_cluster_member_sequences(clusters_dir_name: str, proteins_faa: str) -> None:
-    for root, dirs, files in os.walk(clusters_dir_name):
-        for directory in dirs:
-            file_name = f'{root}/{directory}/{directory}_ids.txt'
+    The default 'index' engine reads the proteome once through a persisted offset index and supports every
+    cluster layout; 'seqtk' runs one ``seqtk subseq`` per cluster directory on ``cpus`` CPUs.
+    """
+    if engine == 'index':
+        write_cluster_sequences(clusters_dir_name, proteins_faa)
+        return
 
-            cmd = f"seqtk subseq {proteins_faa} "\
-                  f"<(cut -f 1 {file_name}) "\
-                  f"> {file_name.removesuffix('.txt')}.faa"
-            ps = subprocess.Popen(cmd, shell=True, executable="/bin/bash",
-                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            _ = ps.communicate()[0]
+    jobs = []
+    for cluster_name, cluster_dir_name in iter_cluster_dir_names(clusters_dir_name):
+        file_name = f'{cluster_dir_name}/{cluster_name}_ids.txt'
+        output_file_name = f"{file_name.removesuffix('.txt')}.faa"
+
+        cmd = f"seqtk subseq {proteins_faa} "\
+              f"<(cut -f 1 {file_name}) "\
+              f"> {output_file_name}.tmp"
+        jobs.append(ClusterJob(cluster_name, cmd, output_file_name, (file_name, proteins_faa)))
+    run_cluster_jobs(jobs, cpus, f'{clusters_dir_name}_seqtk_jobs.tsv')
 
 
 def get_cluster_member_lengths(proteins_sizes: str) -> dict:
-    with open(proteins_sizes, encoding='utf8') as proteins_sizes_file:
+    with open_file(proteins_sizes) as proteins_sizes_file:
         result = {}
         for line in proteins_sizes_file:
             protein_id, protein_length = line.split('\t')
@@ -48,65 +65,155 @@ def get_cluster_member_lengths(proteins_sizes: str) -> dict:
         return result
 
 
-def save_cluster_member_lengths(clusters_dir_name: str, proteins_sizes_dict: dict) -> None:
-    for root, dirs, files in os.walk(clusters_dir_name):
-        for directory in dirs:
-            with open(f'{root}/{directory}/{directory}_ids.txt', encoding='utf8') as proteins_ids_file,\
-                 open(f'{root}/{directory}/{directory}_lengths.txt', 'w', encoding='utf8') as proteins_lengths_file:
-                for line in proteins_ids_file:
-                    protein_id = line.strip()
-                    proteins_lengths_file.write(f'{protein_id}\t{proteins_sizes_dict[protein_id]}\n')
+def save_cluster_member_lengths(clusters_dir_name: str, membership: ClusterMembership,
+                                member_lengths: np.ndarray) -> None:
+    write_cluster_member_lengths(clusters_dir_name, membership, member_lengths)
 
 
+@profiled(outputs=lambda clusters_dir_name, results_dir: [f'{results_dir}/clusters_statistics.txt'])
 def calculate_clusters_statistics(clusters_dir_name: str, results_dir: str) -> None:
     with open(f'{results_dir}/clusters_statistics.txt', 'w', encoding='utf8') as statistics_file:
         statistics_header = 'cluster_name\tcluster_members_number\tcluster_members_mean_length'
         statistics_file.write(f'{statistics_header}\n')
-        columns = ['protein_id', 'protein_length']
-        for root, dirs, files in os.walk(clusters_dir_name):
-            for directory in dirs:
-                proteins_lengths_df = pd.read_csv(f'{root}/{directory}/{directory}_lengths.txt',
-                                                  index_col=None, sep='\t',
-                                                  header=None, names=columns)
-                cluster_members_number = proteins_lengths_df.shape[0]
-                cluster_members_mean_length = proteins_lengths_df['protein_length'].mean()
-                result_line = "\t".join([directory,
-                                         str(cluster_members_number),
-                                         str(round(cluster_members_mean_length, 2))])
-
-                statistics_file.write(f'{result_line}\n')
-
-
-def build_mafft_alignment_for_each_cluster(clusters_dir_name: str, results_dir: str) -> None:
-    for root, dirs, files in os.walk(clusters_dir_name):
-        for directory in dirs:
-            file_name = f'{root}/{directory}/{directory}_ids.faa'
-            number_of_threads = 1
-
-            cmd = f"mafft --thread {number_of_threads} --auto {file_name} " \
-                  f"1> {file_name.removesuffix('_ids.faa')}.msa 2>> {results_dir}/mafft_stderr.txt"
-            ps = subprocess.Popen(cmd, shell=True, executable="/bin/bash",
-                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            _ = ps.communicate()[0]
+        for cluster_name, protein_lengths in iter_cluster_member_lengths(clusters_dir_name):
+            cluster_members_number = len(protein_lengths)
+            cluster_members_mean_length = sum(protein_lengths) / cluster_members_number
+            result_line = "\t".join([cluster_name,
+                                     str(cluster_members_number),
+                                     str(round(cluster_members_mean_length, 2))])
+
+            statistics_file.write(f'{result_line}\n')
+
+
+def get_member_lengths(membership: ClusterMembership, proteins_sizes: str) -> np.ndarray:
+    """Length of every entry of ``membership.members``; a member without a size is a ``KeyError``."""
+    member_lengths = read_protein_lengths(membership, proteins_sizes)[membership.members]
+    if (member_lengths == MISSING_LENGTH).any():
+        missing_proteins = membership.protein_names[membership.members[member_lengths == MISSING_LENGTH]]
+        raise KeyError(f'{len(missing_proteins)} cluster members have no size in {proteins_sizes}, '
+                       f"e.g. {missing_proteins[0].decode('utf8')}")
+    return member_lengths
+
+
+def read_cluster_member_lengths(mmseqs2_cluster_table: str,
+                                proteins_sizes: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Join the cluster table with the protein sizes as integer arrays.
+
+    Returns the cluster names, the cluster ID of every member and the length of every member.
+    """
+    membership = read_cluster_membership(mmseqs2_cluster_table)
+    member_lengths = get_member_lengths(membership, proteins_sizes)
+    return membership.cluster_names.astype(str), membership.get_member_cluster_ids(), member_lengths
+
+
+@profiled(inputs=('mmseqs2_cluster_table', 'proteins_sizes'), outputs=('statistics_file_name',))
+def calculate_clusters_statistics_from_tables(mmseqs2_cluster_table: str, proteins_sizes: str,
+                                              statistics_file_name: str) -> None:
+    """Cluster size and member length statistics from one grouped aggregation, without per-cluster files.
+
+    The first three columns match ``calculate_clusters_statistics``; a ``.parquet`` file name writes Parquet.
+    """
+    cluster_names, member_cluster_ids, protein_lengths = read_cluster_member_lengths(mmseqs2_cluster_table,
+                                                                                     proteins_sizes)
+    lengths = pd.Series(protein_lengths).groupby(member_cluster_ids, sort=True)
+    statistics_df = pd.DataFrame({
+        'cluster_name': cluster_names,
+        'cluster_members_number': lengths.size().to_numpy(),
+        'cluster_members_mean_length': lengths.mean().round(2).to_numpy(),
+        'cluster_members_median_length': lengths.median().to_numpy(),
+        'cluster_members_min_length': lengths.min().to_numpy(),
+        'cluster_members_max_length': lengths.max().to_numpy(),
+    })
+    statistics_df['cluster_members_length_range'] = statistics_df['cluster_members_max_length'] - \
+        statistics_df['cluster_members_min_length']
+    statistics_df['is_singleton'] = statistics_df['cluster_members_number'] == 1
+
+    if statistics_file_name.endswith('.parquet'):
+        statistics_df.to_parquet(statistics_file_name, index=False)
+    else:
+        with open_file(statistics_file_name, 'w') as statistics_file:
+            statistics_df.to_csv(statistics_file, sep='\t', index=False)
+
+
+def get_mafft_cluster_jobs(clusters_dir_name: str, max_threads: int) -> Iterator[ClusterJob]:
+    """One MAFFT job per cluster; packed clusters are streamed from their byte range of the packed FASTA."""
+    cluster_sizes = dict(iter_cluster_sizes(clusters_dir_name))
+    if get_cluster_layout(clusters_dir_name) == 'packed':
+        packed_faa = f'{clusters_dir_name}/{PACKED_SEQUENCES_FILE_NAME}'
+        offsets_df = read_packed_sequences_offsets(clusters_dir_name)
+        for cluster_name, offset, end_offset in offsets_df.itertuples(index=False):
+            cluster_size = cluster_sizes[cluster_name]
+            number_of_threads = get_job_threads(cluster_size, max_threads)
+            alignment_dir_name = f'{clusters_dir_name}/{PACKED_ALIGNMENTS_DIR_NAME}/{get_hash_prefix(cluster_name)}'
+            Path(alignment_dir_name).mkdir(parents=True, exist_ok=True)
+            output_file_name = f'{alignment_dir_name}/{cluster_name}.msa'
+
+            cmd = f"mafft --thread {number_of_threads} --auto " \
+                  f"<(tail -c +{offset + 1} {packed_faa} | head -c {end_offset - offset}) " \
+                  f"1> {output_file_name}.tmp"
+            yield ClusterJob(cluster_name, cmd, output_file_name, (packed_faa,), number_of_threads, cluster_size)
+        return
+
+    for cluster_name, cluster_dir_name in iter_cluster_dir_names(clusters_dir_name):
+        file_name = f'{cluster_dir_name}/{cluster_name}_ids.faa'
+        cluster_size = cluster_sizes[cluster_name]
+        number_of_threads = get_job_threads(cluster_size, max_threads)
+        output_file_name = f"{file_name.removesuffix('_ids.faa')}.msa"
+
+        cmd = f"mafft --thread {number_of_threads} --auto {file_name} 1> {output_file_name}.tmp"
+        yield ClusterJob(cluster_name, cmd, output_file_name, (file_name,), number_of_threads, cluster_size)
+
+
+@profiled(inputs=('clusters_dir_name',))
+def build_mafft_alignment_for_each_cluster(clusters_dir_name: str, results_dir: str,
+                                           cpus: int = 1, max_threads_per_job: int | None = None) -> None:
+    """Align every cluster with MAFFT, running clusters concurrently within a budget of ``cpus``.
+
+    Small clusters get one thread each, large ones several; clusters with a complete ``.msa`` are skipped.
+    """
+    jobs = get_mafft_cluster_jobs(clusters_dir_name, max_threads_per_job or cpus)
+    run_cluster_jobs(jobs, cpus, f'{results_dir}/mafft_jobs.tsv')
+
+
+@profiled(inputs=('mmseqs2_cluster_table',), outputs=('clusters_dir_name',))
+def extract_cluster_member_ids(mmseqs2_cluster_table: str, clusters_dir_name: str, layout: str = 'flat') -> None:
+    membership = read_cluster_membership(mmseqs2_cluster_table)
+    write_cluster_member_ids_to_file(membership, clusters_dir_name, layout)
+
+
+@profiled(inputs=('mmseqs2_cluster_table', 'proteins_sizes'), outputs=('clusters_dir_name',))
+def extract_cluster_member_lengths(mmseqs2_cluster_table: str, clusters_dir_name: str, proteins_sizes: str) -> None:
+    """Write the member lengths of every cluster from integer arrays, without a dict of every protein's size."""
+    membership = read_cluster_membership(mmseqs2_cluster_table)
+    save_cluster_member_lengths(clusters_dir_name, membership, get_member_lengths(membership, proteins_sizes))
 
 
 def main(mmseqs2_cluster_table: str, proteins_faa: str,
-         proteins_sizes: str, results_dir: str) -> None:
+         proteins_sizes: str, results_dir: str, manifest: BuildManifest | None = None, cpus: int = 1,
+         write_cluster_lengths: bool = False, layout: str = 'flat') -> None:
     clusters_dir_name = '/'.join(mmseqs2_cluster_table.split('/')[:-2]) + '/clusters_seqs'
-    clusters_dir = Path(clusters_dir_name)
-
-    cluster_dict = get_cluster_members_dict(mmseqs2_cluster_table, clusters_dir)
 
-    write_cluster_member_ids_to_file(cluster_dict, clusters_dir_name)
+    # every stage lists the original inputs and the layout it transitively depends on, so a changed table or a
+    # layout switch, which wipes the cluster directory, reruns all of them
+    run_stage(manifest, 'cluster_member_ids', [clusters_dir_name], [mmseqs2_cluster_table], {'layout': layout},
+              extract_cluster_member_ids, mmseqs2_cluster_table, clusters_dir_name, layout, clean_outputs=True)
 
-    retrieve_cluster_member_sequences(clusters_dir_name, proteins_faa)
+    run_stage(manifest, 'cluster_member_sequences', [clusters_dir_name], [mmseqs2_cluster_table, proteins_faa],
+              {'layout': layout}, retrieve_cluster_member_sequences, clusters_dir_name, proteins_faa, cpus)
 
-    proteins_sizes_dict = get_cluster_member_lengths(proteins_sizes)
-    save_cluster_member_lengths(clusters_dir_name, proteins_sizes_dict)
+    if write_cluster_lengths:
+        run_stage(manifest, 'cluster_member_lengths', [clusters_dir_name], [mmseqs2_cluster_table, proteins_sizes],
+                  {'layout': layout}, extract_cluster_member_lengths, mmseqs2_cluster_table, clusters_dir_name,
+                  proteins_sizes)
 
-    calculate_clusters_statistics(clusters_dir_name, results_dir)
+    statistics_file_name = f'{results_dir}/clusters_statistics.txt'
+    run_stage(manifest, 'clusters_statistics', [statistics_file_name], [mmseqs2_cluster_table, proteins_sizes],
+              {'layout': layout}, calculate_clusters_statistics_from_tables, mmseqs2_cluster_table, proteins_sizes,
+              statistics_file_name)
 
-    build_mafft_alignment_for_each_cluster(clusters_dir_name, results_dir)
+    run_stage(manifest, 'mafft_alignments', [clusters_dir_name], [mmseqs2_cluster_table, proteins_faa],
+              {'mafft': '--auto', 'layout': layout},
+              build_mafft_alignment_for_each_cluster, clusters_dir_name, results_dir, cpus)
 
 
 if __name__ == '__main__':
@@ -117,4 +224,5 @@ if __name__ == '__main__':
 
     results_dir = '/mnt/c/crassvirales/phylomes/results/crassvirales_refseq/'
 
-    main(mmseqs2_cluster_table, proteins_faa, proteins_sizes, results_dir)
+    main(mmseqs2_cluster_table, proteins_faa, proteins_sizes, results_dir,
+         BuildManifest(f'{results_dir}/pipeline_manifest.json'), os.cpu_count() or 1)
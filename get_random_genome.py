@@ -1,12 +1,21 @@
+import numpy as np
 import pandas as pd
 
+from compressed_io import open_file
+from spreadsheet_snapshot import read_spreadsheet
+from stage_profiler import profiled
+
 
 PathToFile = str
 
+VMR_TAXONOMY_COLUMNS = ('Realm', 'Subrealm', 'Kingdom', 'Subkingdom', 'Phylum', 'Subphylum', 'Class', 'Subclass',
+                        'Order', 'Suborder', 'Family', 'Subfamily', 'Genus', 'Subgenus')
+QUOTA_POLICIES = ('fixed', 'proportional')
+
 
+@profiled(inputs=('file_name',))
 def read_ictv_vmr_table(file_name):
-    df = pd.read_excel(file_name)
-    df = df.fillna("unknown")
+    df = read_spreadsheet(file_name, categorical_columns=VMR_TAXONOMY_COLUMNS, fill_value="unknown")
     return df
 
 
@@ -25,11 +34,60 @@ def get_families_and_subfamilies_statistics(caudoviricetes_df: pd.DataFrame) ->
     print(f'Caudoviricetes after filtering contains: {len(caudoviricetes_subfamilies)} subfamilies')
 
 
-def get_random_taxonomic_members(caudoviricetes_df: pd.DataFrame, random_number_of_genomes: int = 10) -> pd.DataFrame:
+def get_group_quotas(group_sizes: np.ndarray, quota: float, policy: str = 'fixed',
+                     max_per_group: int | None = None) -> np.ndarray:
+    """Number of members to draw from each group.
+
+    'fixed' draws ``quota`` members per group, 'proportional' the fraction ``quota`` of every group (at least one).
+    Quotas never exceed the group size or ``max_per_group``.
+    """
+    if policy == 'fixed':
+        quotas = np.full(len(group_sizes), int(quota))
+    elif policy == 'proportional':
+        quotas = np.maximum(np.rint(group_sizes * quota).astype(np.int64), 1)
+    else:
+        raise ValueError(f'Unknown quota policy {policy}, expected one of {QUOTA_POLICIES}')
+    if max_per_group is not None:
+        quotas = np.minimum(quotas, max_per_group)
+    return np.minimum(quotas, group_sizes)
+
+
+@profiled()
+def sample_taxonomic_members(df: pd.DataFrame, rank: str = 'Family', quota: float = 10, policy: str = 'fixed',
+                             max_per_group: int | None = None, replicates: int = 1,
+                             seed: int | None = None) -> pd.DataFrame:
+    """Stratified sample of ``df`` by ``rank`` without a Python call per group.
+
+    Every row gets a random key; sorting by group code plus key shuffles the rows within their group, and a row is
+    kept when its rank in the group is below the group quota. ``replicates`` independent samples are drawn at once
+    and numbered in a ``replicate`` column; the same ``seed`` always gives the same samples.
+    """
+    group_codes, group_names = pd.factorize(df[rank], sort=True)
+    row_positions = np.flatnonzero(group_codes >= 0)
+    group_codes = group_codes[row_positions]
+    group_sizes = np.bincount(group_codes, minlength=len(group_names))
+    group_starts = np.concatenate(([0], np.cumsum(group_sizes)[:-1]))
+    quotas = get_group_quotas(group_sizes, quota, policy, max_per_group)
+
+    rng = np.random.default_rng(seed)
+    sort_keys = group_codes + rng.random((replicates, len(group_codes)))
+    order = np.argsort(sort_keys, axis=1)
+    ordered_group_codes = group_codes[order]
+    group_ranks = np.arange(len(group_codes)) - group_starts[ordered_group_codes]
+    is_sampled = group_ranks < quotas[ordered_group_codes]
+
+    sampled_positions = row_positions[order[is_sampled]]
+    random_df = df.iloc[sampled_positions].copy()
+    random_df.insert(0, 'replicate', np.repeat(np.arange(replicates), quotas.sum()))
+    return random_df
+
+
+def get_random_taxonomic_members(caudoviricetes_df: pd.DataFrame, random_number_of_genomes: int = 10,
+                                 seed: int | None = None) -> pd.DataFrame:
     print(f'The random number of genomes per Caudoviricetes family is equal to {random_number_of_genomes}')
 
-    random_df = caudoviricetes_df.groupby('Family', as_index=False, group_keys=False).apply(
-        lambda x: x.sample(min(random_number_of_genomes, len(x))))
+    random_df = sample_taxonomic_members(caudoviricetes_df, 'Family', random_number_of_genomes, seed=seed)
+    random_df = random_df.drop(columns='replicate')
 
     print(f'Shape of dataframe after random selection: {random_df.shape}')
     return random_df
@@ -37,16 +95,19 @@ def get_random_taxonomic_members(caudoviricetes_df: pd.DataFrame, random_number_
 
 def extract_random_taxonomic_members_from_ictv_vmr(input_file_name: PathToFile,
                                                    output_caudoviricetes_file_name: PathToFile,
-                                                   output_caudoviricetes_random_file_name: PathToFile) -> None:
+                                                   output_caudoviricetes_random_file_name: PathToFile,
+                                                   seed: int | None = None) -> None:
     df = read_ictv_vmr_table(input_file_name)
     caudoviricetes_df = filter_caudoviricetes(df)
 
     get_families_and_subfamilies_statistics(caudoviricetes_df)
 
-    caudoviricetes_df.to_csv(output_caudoviricetes_file_name, sep="\t", index=False)
+    with open_file(output_caudoviricetes_file_name, 'w') as output_file:
+        caudoviricetes_df.to_csv(output_file, sep="\t", index=False)
 
-    random_df = get_random_taxonomic_members(caudoviricetes_df)
-    random_df.to_csv(output_caudoviricetes_random_file_name, sep="\t", index=False)
+    random_df = get_random_taxonomic_members(caudoviricetes_df, seed=seed)
+    with open_file(output_caudoviricetes_random_file_name, 'w') as output_file:
+        random_df.to_csv(output_file, sep="\t", index=False)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+from collections.abc import Callable, Iterable, Mapping, Sequence
+from contextlib import ExitStack
+from typing import NamedTuple
+
+from compressed_io import open_file
+from protein_function_index import ProteinFunctionIndex
+
+
+PathToFile = str
+ProteinId = str
+ProteinName = str
+Color = str
+KeyExtractor = Callable[[bytes, bytes], bytes]
+
+GFF_BLOCK_SIZE = 16 * 2 ** 20
+UNKNOWN_FUNCTION = 'hp'
+OTHER_FUNCTION = 'other_known_functions'
+COMMENT_CHARACTER = ord('#')
+
+
+class GffNameOutput(NamedTuple):
+    """A rewritten GFF; with ``functional_colors``, functions without a color are written as 'other_known_functions'."""
+    file_name: PathToFile
+    functional_colors: Mapping[ProteinName, Color] | None = None
+
+
+def get_prodigal_protein_key(seqid: bytes, first_attribute: bytes) -> bytes:
+    # 'ID=3_17' of contig 'contig2' -> 'contig2_17'
+    return seqid + b'_' + first_attribute.rpartition(b'_')[2]
+
+
+def get_refseq_protein_key(seqid: bytes, first_attribute: bytes) -> bytes:
+    # 'ID=cds-YP_010358662.1' -> 'YP_010358662.1'
+    return first_attribute.rpartition(b'-')[2]
+
+
+KEY_EXTRACTORS: dict[str, KeyExtractor] = {
+    'prodigal': get_prodigal_protein_key,
+    'refseq': get_refseq_protein_key,
+}
+
+
+def get_protein_functions(protein_name_dict: Mapping[ProteinId, ProteinName],
+                          protein_keys: Sequence[ProteinId]) -> list[ProteinName]:
+    """Functions of a block of proteins, 'hp' for unannotated ones; an on-disk index is searched in one batch."""
+    if isinstance(protein_name_dict, ProteinFunctionIndex):
+        # the missing-function code -1 selects the 'hp' appended at the end
+        functions = [*protein_name_dict.functions, UNKNOWN_FUNCTION]
+        return [functions[code] for code in protein_name_dict.get_function_codes(protein_keys).tolist()]
+    return [protein_name_dict.get(protein_key, UNKNOWN_FUNCTION) for protein_key in protein_keys]
+
+
+def get_output_name_attribute(function: ProteinName, functional_colors: Mapping[ProteinName, Color] | None) -> bytes:
+    if functional_colors is not None and function not in functional_colors:
+        function = OTHER_FUNCTION
+    return f';name={function}'.encode('utf8')
+
+
+def iter_gff_line_blocks(annotation_file: PathToFile, block_size: int) -> Iterable[tuple[list[bytes], bool]]:
+    """Yield the lines of large blocks without their newlines, and whether the last line ended with one."""
+    with open_file(annotation_file, 'rb') as gff:
+        remainder = b''
+        while block := gff.read(block_size):
+            block = remainder + block
+            if b'\r' in block:
+                # text mode used to turn CRLF into LF, the rewritten files keep doing so
+                block = block.replace(b'\r\n', b'\n')
+            lines = block.split(b'\n')
+            remainder = lines.pop()
+            yield lines, True
+        if remainder:
+            yield [remainder.rstrip(b'\r')], False
+
+
+def rewrite_gff_names(annotation_file: PathToFile, outputs: Sequence[GffNameOutput],
+                      protein_name_dict: Mapping[ProteinId, ProteinName], get_protein_key: KeyExtractor,
+                      feature_type: bytes | None = None, replace_name: bool = False,
+                      block_size: int = GFF_BLOCK_SIZE) -> None:
+    """Write the features of a GFF with a ``name=`` attribute holding the function of their protein.
+
+    Comment lines and, with ``feature_type``, features of other types are dropped before anything is decoded.
+    Only column 9 is edited: ``name=`` goes right after the first attribute, or replaces the second one with
+    ``replace_name``. The protein is found by ``get_protein_key`` from the seqid and the first attribute. The file
+    is processed in blocks of ``block_size`` bytes and every output gets one write per block.
+    """
+    feature_type_field = b'\t%s\t' % feature_type if feature_type is not None else None
+    with ExitStack() as stack:
+        output_files = [stack.enter_context(open_file(output.file_name, 'wb')) for output in outputs]
+        name_attributes: list[dict[ProteinName, bytes]] = [{} for _ in outputs]
+        for lines, ends_with_newline in iter_gff_line_blocks(annotation_file, block_size):
+            # every kept line becomes line[:cut] + ';name=...' + line[resume:]
+            features, cuts, resumes, protein_keys = [], [], [], []
+            for line in lines:
+                if not line or line[0] == COMMENT_CHARACTER:
+                    continue
+                if feature_type_field is not None and \
+                        not line.startswith(feature_type_field, line.find(b'\t', line.find(b'\t') + 1)):
+                    continue
+                attributes_start = line.rfind(b'\t') + 1
+                cut = line.find(b';', attributes_start)
+                if cut == -1:
+                    cut = len(line)
+                resume = cut
+                if replace_name:
+                    resume = line.find(b';', cut + 1)
+                    if resume == -1:
+                        resume = len(line)
+                features.append(line)
+                cuts.append(cut)
+                resumes.append(resume)
+                protein_keys.append(get_protein_key(line[:line.find(b'\t')], line[attributes_start:cut]).decode('utf8'))
+            if not features:
+                continue
+
+            functions = get_protein_functions(protein_name_dict, protein_keys)
+            for output, output_file, output_name_attributes in zip(outputs, output_files, name_attributes):
+                for function in set(functions).difference(output_name_attributes):
+                    output_name_attributes[function] = get_output_name_attribute(function, output.functional_colors)
+                edited_lines = [line[:cut] + output_name_attributes[function] + line[resume:]
+                                for line, cut, resume, function in zip(features, cuts, resumes, functions)]
+                output_file.write(b'\n'.join(edited_lines) + (b'\n' if ends_with_newline else b''))
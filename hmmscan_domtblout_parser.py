@@ -1,63 +1,393 @@
-#!/usr/bin/python
-from typing import TextIO
-
-from Bio import SearchIO
-
-
-def start_hmmscan_domtblout_result_analysis(domtblout_file_name: str) -> None:
-    result_file_name = file_name[:-4] + '_filtered_0.05.txt'
-    with open(domtblout_file_name, encoding='utf8') as input_file, \
-         open(result_file_name, 'w', encoding='utf8') as result_file:
-        header = ('#HMM_family', 'HMM_len', 'Query_ID', 'Query_len', 'E-value', 'HMM_start', 'HMM_end',
-                  'Query_start', 'Query_end', 'Coverage')
-        result_file.write('\t'.join(header) + '\n')
-        for qresult in SearchIO.parse(input_file, 'hmmscan3-domtab'):
-            write_results_to_file(qresult, result_file)
-
-
-def write_results_to_file(qresult: SearchIO._model.query.QueryResult, result_file: TextIO) -> None:
-    result_line = parse_hmmscan_domtblout_result(qresult)
-    if result_line is not None:
-        result_file.write(f'{result_line}\n')
-
-
-def parse_hmmscan_domtblout_result(qresult: SearchIO._model.query.QueryResult) -> str:
-    query_id = qresult.id  # sequence ID from fasta
-    query_len = qresult.seq_len
-    hits = qresult.hits
-    num_hits = len(hits)
-    if num_hits:
-        for i in range(num_hits):
-            hit_evalue = hits[i].evalue  # evalue
-            hmm_len = hits[i].seq_len  # target length
-            hmm_aln = int(hits[i].hsps[0].hit_end) - int(hits[i].hsps[0].hit_start)  # length of alignment
-            coverage = hmm_aln / float(hmm_len)  # alignment coverage
-            hmm_name = hits[i].id  # target name
-            if filter_hmmscan_domtblout_result(hit_evalue, coverage):
-                results = (hmm_name, hmm_len, query_id, query_len, hit_evalue,
-                           hits[i].hsps[0].hit_start, hits[i].hsps[0].hit_end,
-                           hits[i].hsps[0].query_start, hits[i].hsps[0].query_end, coverage)
-                result_line = '\t'.join(str(i) for i in results)
-                return result_line
-
-
-def filter_hmmscan_domtblout_result(hit_evalue: float, coverage: float,
-                                    hit_evalue_threshold: float = 0.05, coverage_threshold: float = 0.3) -> bool:
-    if hit_evalue < hit_evalue_threshold and coverage > coverage_threshold:
-        return True
-    return False
-
-
-if __name__ == "__main__":
-    path = '/mnt/c/crassvirales/functional_annotation/crassvirales_confirmed/hmmscan_results'
-    file_names = [f'{path}/all_genomes_without_refseq_table_4_domtblout.txt',
-                  f'{path}/all_genomes_without_refseq_table_11_domtblout.txt',
-                  f'{path}/all_genomes_without_refseq_table_11_TGA_W_domtblout.txt',
-                  f'{path}/all_genomes_without_refseq_table_11_TAG_Q_domtblout.txt',
-                  f'{path}/all_genomes_without_refseq_meta_domtblout.txt',
-                  f'{path}/all_genomes_without_refseq_table_15_domtblout.txt',
-                  f'{path}/all_genomes_without_refseq_table_25_domtblout.txt',
-                  f'{path}/all_refseq_proteins_domtblout.txt']
-
-    for file_name in file_names:
-        start_hmmscan_domtblout_result_analysis(file_name)
+#!/usr/bin/python
+from __future__ import annotations
+
+import argparse
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor
+import io
+import os
+from typing import BinaryIO, TextIO
+
+import pandas as pd
+
+from compressed_io import get_compression, get_derived_file_name, open_file
+from stage_profiler import profiled
+
+try:
+    from Bio import SearchIO
+except ImportError:  # Biopython is only needed for the 'searchio' engine
+    SearchIO = None  # type: ignore[assignment]
+
+
+DomtbloutColumns = list[str]
+
+RESULT_HEADER = ('#HMM_family', 'HMM_len', 'Query_ID', 'Query_len', 'E-value', 'HMM_start', 'HMM_end',
+                 'Query_start', 'Query_end', 'Coverage')
+
+# hmmscan --domtblout columns used by the filter (0-based)
+TARGET_NAME, TARGET_LEN, QUERY_NAME, QUERY_LEN, FULL_EVALUE, FULL_SCORE = 0, 2, 3, 5, 6, 7
+HMM_FROM, HMM_TO, ALI_FROM, ALI_TO = 15, 16, 17, 18
+USED_COLUMNS_NUMBER = ALI_TO + 1
+DOMTBLOUT_COLUMNS_NUMBER = 23
+DOMTBLOUT_HIT_COLUMNS = {TARGET_NAME: 'hmm_name', TARGET_LEN: 'hmm_len', QUERY_NAME: 'query_id', QUERY_LEN: 'query_len',
+                         FULL_EVALUE: 'evalue', FULL_SCORE: 'bitscore', HMM_FROM: 'hmm_start', HMM_TO: 'hmm_end',
+                         ALI_FROM: 'query_start', ALI_TO: 'query_end'}
+DOMTBLOUT_HIT_DTYPES = {column: str if column in (TARGET_NAME, QUERY_NAME) else
+                        float if column in (FULL_EVALUE, FULL_SCORE) else int for column in DOMTBLOUT_HIT_COLUMNS}
+
+ENGINES = ('native', 'columnar', 'searchio')
+SELECTION_POLICIES = ('first', 'lowest_evalue', 'highest_bitscore')
+
+HIT_EVALUE_THRESHOLD = 0.05
+COVERAGE_THRESHOLD = 0.3
+
+MIN_SHARD_SIZE = 64 * 2 ** 20  # bytes; smaller files are filtered by a single worker
+
+ByteRange = tuple[int, int]
+
+
+def get_result_file_name(domtblout_file_name: str) -> str:
+    return get_derived_file_name(domtblout_file_name, '_filtered_0.05.txt')
+
+
+@profiled(inputs=('domtblout_file_name',),
+          outputs=lambda domtblout_file_name, engine: [get_result_file_name(domtblout_file_name)])
+def start_hmmscan_domtblout_result_analysis(domtblout_file_name: str, engine: str = 'native') -> None:
+    result_file_name = get_result_file_name(domtblout_file_name)
+    with open_file(domtblout_file_name) as input_file, open_file(result_file_name, 'w') as result_file:
+        result_file.write('\t'.join(RESULT_HEADER) + '\n')
+        if engine == 'native':
+            for query_id, query_hits in iter_domtblout_queries(input_file):
+                write_native_results_to_file(query_id, query_hits, result_file)
+        elif engine == 'columnar':
+            write_hits_table(select_best_hits(read_domtblout_hits(input_file)), result_file)
+        elif engine == 'searchio':
+            if SearchIO is None:
+                raise ImportError("Biopython is required for the 'searchio' engine")
+            for qresult in SearchIO.parse(input_file, 'hmmscan3-domtab'):
+                write_results_to_file(qresult, result_file)
+        else:
+            raise ValueError(f'Unknown engine {engine!r}, expected one of {ENGINES}')
+
+
+def iter_domtblout_queries(domtblout_lines: Iterable[str]) -> Iterator[tuple[str, list[DomtbloutColumns]]]:
+    """Group domtblout rows by query without building SearchIO objects.
+
+    Only the first domain row of each hit is kept, which is the ``hsps[0]`` the SearchIO path looks at.
+    """
+    query_id = ''
+    hit_id = ''
+    query_hits: list[DomtbloutColumns] = []
+    for line in domtblout_lines:
+        if line.startswith('#') or not line.strip():
+            continue
+        columns = line.split(None, USED_COLUMNS_NUMBER)
+        if columns[QUERY_NAME] != query_id:
+            if query_hits:
+                yield query_id, query_hits
+            query_id = columns[QUERY_NAME]
+            hit_id = ''
+            query_hits = []
+        if columns[TARGET_NAME] != hit_id:
+            hit_id = columns[TARGET_NAME]
+            query_hits.append(columns)
+    if query_hits:
+        yield query_id, query_hits
+
+
+def write_native_results_to_file(query_id: str, query_hits: list[DomtbloutColumns], result_file: TextIO) -> None:
+    result_line = parse_domtblout_query_hits(query_id, query_hits)
+    if result_line is not None:
+        result_file.write(f'{result_line}\n')
+
+
+def parse_domtblout_query_hits(query_id: str, query_hits: list[DomtbloutColumns]) -> str | None:
+    for columns in query_hits:
+        hit_evalue = float(columns[FULL_EVALUE])
+        hmm_len = int(columns[TARGET_LEN])
+        hmm_start = int(columns[HMM_FROM]) - 1  # 0-based, as in SearchIO
+        hmm_end = int(columns[HMM_TO])
+        coverage = (hmm_end - hmm_start) / float(hmm_len)
+        if filter_hmmscan_domtblout_result(hit_evalue, coverage):
+            results = (columns[TARGET_NAME], hmm_len, query_id, int(columns[QUERY_LEN]), hit_evalue,
+                       hmm_start, hmm_end, int(columns[ALI_FROM]) - 1, int(columns[ALI_TO]), coverage)
+            return '\t'.join(str(i) for i in results)
+    return None
+
+
+def get_domtblout_rows_df(rows: list[str]) -> pd.DataFrame:
+    if not rows:
+        return pd.DataFrame({name: pd.Series(dtype=DOMTBLOUT_HIT_DTYPES[column])
+                             for column, name in DOMTBLOUT_HIT_COLUMNS.items()})
+    return pd.read_csv(io.StringIO('\n'.join(rows)), sep='\t', header=None, names=range(USED_COLUMNS_NUMBER),
+                       usecols=list(DOMTBLOUT_HIT_COLUMNS), dtype=DOMTBLOUT_HIT_DTYPES,
+                       float_precision='round_trip').rename(columns=DOMTBLOUT_HIT_COLUMNS)
+
+
+def iter_domtblout_row_batches(domtblout_lines: Iterable[str], batch_size: int) -> Iterator[pd.DataFrame]:
+    """Tables of the fixed columns of ``batch_size`` domain rows at a time.
+
+    The free-text description is the last column and may contain spaces, so every row is cut after its fixed
+    columns, as the native engine does, and handed to the C parser tab-separated.
+    """
+    rows: list[str] = []
+    is_first_batch = True
+    for line in domtblout_lines:
+        if line.startswith('#') or not line.strip():
+            continue
+        rows.append('\t'.join(line.split(None, USED_COLUMNS_NUMBER)[:USED_COLUMNS_NUMBER]))
+        if len(rows) == batch_size:
+            yield get_domtblout_rows_df(rows)
+            rows = []
+            is_first_batch = False
+    # an empty file still gives one empty batch, so the table has its columns
+    if rows or is_first_batch:
+        yield get_domtblout_rows_df(rows)
+
+
+def read_domtblout_hits(domtblout_file: str | TextIO, batch_size: int = 1_000_000) -> pd.DataFrame:
+    """Load the first domain row of every hit into a columnar table, ``batch_size`` rows at a time."""
+    if isinstance(domtblout_file, str):
+        with open_file(domtblout_file) as input_file:
+            return read_domtblout_hits(input_file, batch_size)
+    domains_df = pd.concat(iter_domtblout_row_batches(domtblout_file, batch_size), ignore_index=True)
+    domains_df['hmm_start'] -= 1  # 0-based, as in SearchIO
+    domains_df['query_start'] -= 1
+
+    query_ids, hmm_names = domains_df['query_id'], domains_df['hmm_name']
+    is_first_domain = (query_ids != query_ids.shift()) | (hmm_names != hmm_names.shift())
+    hits_df = domains_df[is_first_domain].reset_index(drop=True)
+    hits_df['coverage'] = (hits_df['hmm_end'] - hits_df['hmm_start']) / hits_df['hmm_len']
+    return hits_df
+
+
+def select_best_hits(hits_df: pd.DataFrame,
+                     hit_evalue_threshold: float = HIT_EVALUE_THRESHOLD, coverage_threshold: float = COVERAGE_THRESHOLD,
+                     policy: str = 'first', top_n: int = 1) -> pd.DataFrame:
+    """Keep up to ``top_n`` passing hits per query, ranked by ``policy``, in the original query order.
+
+    The 'first' policy with ``top_n=1`` reproduces ``parse_hmmscan_domtblout_result``.
+    """
+    passing_df = hits_df[(hits_df['evalue'] < hit_evalue_threshold) & (hits_df['coverage'] > coverage_threshold)]
+    if policy == 'first':
+        ranked_df = passing_df
+    elif policy in ('lowest_evalue', 'highest_bitscore'):
+        query_order = pd.Series(pd.factorize(passing_df['query_id'])[0], index=passing_df.index, name='query_order')
+        rank_column = 'evalue' if policy == 'lowest_evalue' else 'bitscore'
+        ranked_df = passing_df.assign(query_order=query_order) \
+            .sort_values(['query_order', rank_column], ascending=[True, policy == 'lowest_evalue'], kind='stable') \
+            .drop(columns='query_order')
+    else:
+        raise ValueError(f'Unknown selection policy {policy!r}, expected one of {SELECTION_POLICIES}')
+    return ranked_df.groupby('query_id', sort=False).head(top_n)
+
+
+def sweep_hit_thresholds(hits_df: pd.DataFrame, thresholds: Iterable[tuple[float, float]],
+                         policy: str = 'first', top_n: int = 1) -> dict[tuple[float, float], pd.DataFrame]:
+    """Select hits for several (e-value, coverage) threshold pairs from one parsed table."""
+    return {(hit_evalue_threshold, coverage_threshold):
+            select_best_hits(hits_df, hit_evalue_threshold, coverage_threshold, policy, top_n)
+            for hit_evalue_threshold, coverage_threshold in thresholds}
+
+
+def write_hits_table(selected_hits_df: pd.DataFrame, result_file: TextIO) -> None:
+    columns = (selected_hits_df[column].tolist()
+               for column in ('hmm_name', 'hmm_len', 'query_id', 'query_len', 'evalue',
+                              'hmm_start', 'hmm_end', 'query_start', 'query_end', 'coverage'))
+    result_file.writelines('\t'.join(str(i) for i in results) + '\n' for results in zip(*columns))
+
+
+def get_sweep_result_file_name(domtblout_file_name: str, hit_evalue_threshold: float, coverage_threshold: float,
+                               policy: str = 'first', top_n: int = 1) -> str:
+    result_file_ending = f'_filtered_{hit_evalue_threshold}_cov_{coverage_threshold}'
+    if policy != 'first' or top_n != 1:
+        result_file_ending += f'_{policy}_top_{top_n}'
+    return get_derived_file_name(domtblout_file_name, result_file_ending + '.txt')
+
+
+def get_sweep_result_file_names(domtblout_file_name: str, thresholds: Iterable[tuple[float, float]],
+                                policy: str = 'first', top_n: int = 1) -> list[str]:
+    return [get_sweep_result_file_name(domtblout_file_name, hit_evalue_threshold, coverage_threshold, policy, top_n)
+            for hit_evalue_threshold, coverage_threshold in thresholds]
+
+
+@profiled(inputs=('domtblout_file_name',), outputs=get_sweep_result_file_names)
+def start_hmmscan_domtblout_threshold_sweep(domtblout_file_name: str, thresholds: Iterable[tuple[float, float]],
+                                            policy: str = 'first', top_n: int = 1) -> None:
+    with open_file(domtblout_file_name) as input_file:
+        hits_df = read_domtblout_hits(input_file)
+    for (hit_evalue_threshold, coverage_threshold), selected_hits_df in \
+            sweep_hit_thresholds(hits_df, thresholds, policy, top_n).items():
+        result_file_name = get_sweep_result_file_name(domtblout_file_name, hit_evalue_threshold, coverage_threshold,
+                                                      policy, top_n)
+        with open_file(result_file_name, 'w') as result_file:
+            result_file.write('\t'.join(RESULT_HEADER) + '\n')
+            write_hits_table(selected_hits_df, result_file)
+
+
+def find_query_shard_boundaries(domtblout_file_name: str, number_of_shards: int) -> list[ByteRange]:
+    """Split a domtblout file into byte ranges that never cut through the rows of one query.
+
+    A compressed file cannot be entered at a byte offset and is always a single shard.
+    """
+    file_size = os.path.getsize(domtblout_file_name)
+    if get_compression(domtblout_file_name) is not None:
+        return [(0, file_size)]
+    boundaries = [0]
+    with open(domtblout_file_name, 'rb') as input_file:
+        for shard_number in range(1, number_of_shards):
+            position = max(file_size * shard_number // number_of_shards, boundaries[-1])
+            input_file.seek(position)
+            if position:
+                input_file.readline()  # move to the start of the next full line
+            boundaries.append(seek_next_query_start(input_file, file_size))
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def seek_next_query_start(input_file: BinaryIO, file_size: int) -> int:
+    first_query_id = None
+    while True:
+        position = input_file.tell()
+        line = input_file.readline()
+        if not line:
+            return file_size
+        if line.startswith(b'#') or not line.strip():
+            continue
+        query_id = line.split(None, QUERY_NAME + 1)[QUERY_NAME]
+        if first_query_id is None:
+            first_query_id = query_id
+        elif query_id != first_query_id:
+            return position
+
+
+def iter_byte_range_lines(file_name: str, byte_range: ByteRange) -> Iterator[str]:
+    if get_compression(file_name) is not None:
+        # the only shard of a compressed file is the whole file
+        with open_file(file_name) as input_file:
+            yield from input_file
+        return
+    start, end = byte_range
+    with open(file_name, 'rb') as input_file:
+        input_file.seek(start)
+        position = start
+        for line in input_file:
+            if position >= end:
+                break
+            position += len(line)
+            yield line.decode('utf8')
+
+
+@profiled()
+def filter_domtblout_shard(domtblout_file_name: str, byte_range: ByteRange) -> list[str]:
+    result_lines = []
+    for query_id, query_hits in iter_domtblout_queries(iter_byte_range_lines(domtblout_file_name, byte_range)):
+        result_line = parse_domtblout_query_hits(query_id, query_hits)
+        if result_line is not None:
+            result_lines.append(f'{result_line}\n')
+    return result_lines
+
+
+def start_parallel_hmmscan_domtblout_result_analysis(domtblout_file_names: Sequence[str], workers: int,
+                                                     min_shard_size: int = MIN_SHARD_SIZE) -> None:
+    """Filter several domtblout files at once, sharding large files at query boundaries.
+
+    The shard results are concatenated in file order, so every output is byte-identical to the serial one.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        shard_futures = []
+        for domtblout_file_name in domtblout_file_names:
+            number_of_shards = min(workers, max(1, os.path.getsize(domtblout_file_name) // min_shard_size))
+            shards = find_query_shard_boundaries(domtblout_file_name, number_of_shards)
+            shard_futures.append([executor.submit(filter_domtblout_shard, domtblout_file_name, shard)
+                                  for shard in shards])
+
+        for domtblout_file_name, futures in zip(domtblout_file_names, shard_futures):
+            with open_file(get_result_file_name(domtblout_file_name), 'w') as result_file:
+                result_file.write('\t'.join(RESULT_HEADER) + '\n')
+                for future in futures:
+                    result_file.writelines(future.result())
+
+
+def write_results_to_file(qresult: SearchIO._model.query.QueryResult, result_file: TextIO) -> None:
+    result_line = parse_hmmscan_domtblout_result(qresult)
+    if result_line is not None:
+        result_file.write(f'{result_line}\n')
+
+
+def parse_hmmscan_domtblout_result(qresult: SearchIO._model.query.QueryResult) -> str:
+    query_id = qresult.id  # sequence ID from fasta
+    query_len = qresult.seq_len
+    hits = qresult.hits
+    num_hits = len(hits)
+    if num_hits:
+        for i in range(num_hits):
+            hit_evalue = hits[i].evalue  # evalue
+            hmm_len = hits[i].seq_len  # target length
+            hmm_aln = int(hits[i].hsps[0].hit_end) - int(hits[i].hsps[0].hit_start)  # length of alignment
+            coverage = hmm_aln / float(hmm_len)  # alignment coverage
+            hmm_name = hits[i].id  # target name
+            if filter_hmmscan_domtblout_result(hit_evalue, coverage):
+                results = (hmm_name, hmm_len, query_id, query_len, hit_evalue,
+                           hits[i].hsps[0].hit_start, hits[i].hsps[0].hit_end,
+                           hits[i].hsps[0].query_start, hits[i].hsps[0].query_end, coverage)
+                result_line = '\t'.join(str(i) for i in results)
+                return result_line
+
+
+def filter_hmmscan_domtblout_result(hit_evalue: float, coverage: float,
+                                    hit_evalue_threshold: float = HIT_EVALUE_THRESHOLD,
+                                    coverage_threshold: float = COVERAGE_THRESHOLD) -> bool:
+    if hit_evalue < hit_evalue_threshold and coverage > coverage_threshold:
+        return True
+    return False
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Keep the best hmmscan hit per query from domtblout files')
+    parser.add_argument('domtblout_files', nargs='*', help='hmmscan --domtblout files (default: crassvirales runs)')
+    parser.add_argument('--engine', default='native', choices=ENGINES)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes; files and large-file shards are filtered concurrently')
+    parser.add_argument('--evalue-thresholds', nargs='+', type=float, default=[HIT_EVALUE_THRESHOLD],
+                        help='full-sequence E-value cut-offs; several values are swept over one parsed table')
+    parser.add_argument('--coverage-thresholds', nargs='+', type=float, default=[COVERAGE_THRESHOLD],
+                        help='HMM coverage cut-offs; several values are swept over one parsed table')
+    parser.add_argument('--policy', default='first', choices=SELECTION_POLICIES,
+                        help='which passing hits to keep for each query')
+    parser.add_argument('--top-n', type=int, default=1, help='number of hits to keep for each query')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    path = '/mnt/c/crassvirales/functional_annotation/crassvirales_confirmed/hmmscan_results'
+    file_names = [f'{path}/all_genomes_without_refseq_table_4_domtblout.txt',
+                  f'{path}/all_genomes_without_refseq_table_11_domtblout.txt',
+                  f'{path}/all_genomes_without_refseq_table_11_TGA_W_domtblout.txt',
+                  f'{path}/all_genomes_without_refseq_table_11_TAG_Q_domtblout.txt',
+                  f'{path}/all_genomes_without_refseq_meta_domtblout.txt',
+                  f'{path}/all_genomes_without_refseq_table_15_domtblout.txt',
+                  f'{path}/all_genomes_without_refseq_table_25_domtblout.txt',
+                  f'{path}/all_refseq_proteins_domtblout.txt']
+
+    if args.domtblout_files:
+        file_names = args.domtblout_files
+
+    thresholds = [(hit_evalue_threshold, coverage_threshold)
+                  for hit_evalue_threshold in args.evalue_thresholds
+                  for coverage_threshold in args.coverage_thresholds]
+
+    if thresholds != [(HIT_EVALUE_THRESHOLD, COVERAGE_THRESHOLD)] or args.policy != 'first' or args.top_n != 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            sweep_futures = [executor.submit(start_hmmscan_domtblout_threshold_sweep, file_name, thresholds,
+                                             args.policy, args.top_n)
+                             for file_name in file_names]
+            for future in sweep_futures:
+                future.result()
+    elif args.workers > 1 and args.engine == 'native':
+        start_parallel_hmmscan_domtblout_result_analysis(file_names, args.workers)
+    else:
+        for file_name in file_names:
+            start_hmmscan_domtblout_result_analysis(file_name, args.engine)
@@ -1,128 +1,230 @@
-from collections.abc import Iterable, Mapping
-
-import pandas as pd
-
-
-ProfileId = str
-ProteinName = str
-
-
-def get_protein_name_dict(domtblout_file_name: str,
-                          profile_name_dict: Mapping[ProfileId, ProteinName]) -> dict[ProfileId, ProteinName]:
-    domtblout_df = pd.read_csv(domtblout_file_name, index_col=False, sep='\t')
-    hmm_family_edited_col = domtblout_df['#HMM_family'].map(profile_name_dict).fillna(domtblout_df['#HMM_family'])
-    domtblout_df_edited = domtblout_df.copy()
-    domtblout_df_edited['#HMM_family'] = hmm_family_edited_col
-
-    domtblout_df_edited.to_csv(domtblout_file_name[:-4] + '_with_names.txt', sep='\t', index=False)
-
-    domtblout_df_edited_names = domtblout_df_edited[['#HMM_family', 'Query_ID']]
-    domtblout_df_edited_names_unique = domtblout_df_edited_names.drop_duplicates()
-    domtblout_df_edited_names_unique.to_csv(domtblout_file_name[:-4] + '_with_names_unique.txt', sep='\t',
-                                            index=False)
-
-    protein_name_dict = dict(zip(domtblout_df_edited_names_unique['Query_ID'],
-                                 domtblout_df_edited_names_unique['#HMM_family']))
-
-    protein_name_dict = {'_'.join(k.split('_')[3:5]): v for k, v in protein_name_dict.items()}
-
-    return protein_name_dict
-
-
-def get_profile_name_dict(profile_list_file_name: str) -> dict[ProfileId, ProteinName]:
-    profile_list_df = pd.read_excel(profile_list_file_name, index_col=None)
-    profile_name_dict = dict(zip(profile_list_df['profile ID'], profile_list_df.nickname))
-    return profile_name_dict
-
-
-def make_functional_anotation_for_prodigal(annotation_file: str, annotation_file_edited: str,
-                                           protein_name_dict: Mapping[ProfileId, ProteinName]) -> None:
-    with open(annotation_file, encoding='utf-8') as file, \
-            open(annotation_file_edited, 'w', encoding='utf-8') as result:
-        for line in file:
-            line = line.split('\t')
-            if not line[0].startswith('#'):
-                description = line[-1].split(';')
-                _, protein_number = description[0].rsplit('_', 1)
-                protein_name = '_'.join([line[0], protein_number])
-                protein_name_function = protein_name_dict.get(protein_name, 'hp')
-                protein_name_function_line = f'name={protein_name_function}'
-                description_edited = ';'.join([description[0], protein_name_function_line,
-                                               *description[1:]])
-                line_edited = '\t'.join([*line[:-1], description_edited])
-
-                result.write(line_edited)
-
-
-def make_functional_anotation_for_refseq(annotation_file: str, annotation_file_edited: str,
-                                         protein_name_dict: Mapping[ProfileId, ProteinName]) -> None:
-
-    with open(annotation_file, encoding='utf-8') as file, \
-         open(annotation_file_edited, 'w', encoding='utf-8') as result:
-        for line in file:
-            line = line.split('\t')
-            if not line[0].startswith('#') and len(line) >= 3:
-                if line[2] == 'CDS':
-                    description = line[-1].split(';')
-                    # 'lcl|NC_062765.1_prot_YP_010358662.1_8'
-                    _, protein_name = description[0].rsplit('-', 1)
-                    protein_name_function = protein_name_dict.get(protein_name, 'hp')
-                    protein_name_function_line = f'name={protein_name_function}'
-                    description_edited = ';'.join([description[0], protein_name_function_line,
-                                                   *description[1:]])
-                    line_edited = '\t'.join([*line[:-1], description_edited])
-
-                    result.write(line_edited)
-
-
-def make_functional_annotation(profile_list_file_name: str,
-                               domtblout_file_names: Iterable[str], annotation_files: Iterable[str],
-                               domtblout_file_name_refseq: str, annotation_file_name_refseq: str) -> None:
-    profile_name_dict = get_profile_name_dict(profile_list_file_name)
-
-    for domtblout_file_name, annotation_file in zip(domtblout_file_names, annotation_files):
-        protein_name_dict = get_protein_name_dict(domtblout_file_name, profile_name_dict)
-        annotation_file_edited = annotation_file[:-4] + "_edited.gff"
-
-        make_functional_anotation_for_prodigal(annotation_file, annotation_file_edited,
-                                               protein_name_dict)
-
-    annotation_file_name_refseq_edited = annotation_file_name_refseq[:-4] + "_edited.gff"
-
-    protein_name_dict_refseq = get_protein_name_dict(domtblout_file_name_refseq, profile_name_dict)
-
-    make_functional_anotation_for_refseq(annotation_file_name_refseq, annotation_file_name_refseq_edited,
-                                         protein_name_dict_refseq)
-
-
-if __name__ == "__main__":
-    profile_list_file_name = "/mnt/c/crassvirales/crassfamily_2020/profile_list.xlsx"
-
-    hmmscan_results_path = '/mnt/c/crassvirales/functional_annotation/crassvirales_confirmed/hmmscan_results'
-    domtblout_file_names = [f'{hmmscan_results_path}/all_genomes_without_refseq_meta_domtblout_filtered_0.05.txt',
-                            f'{hmmscan_results_path}/all_genomes_without_refseq_table_4_domtblout_filtered_0.05.txt',
-                            f'{hmmscan_results_path}/all_genomes_without_refseq_table_11_domtblout_filtered_0.05.txt',
-                            f'{hmmscan_results_path}/all_genomes_without_refseq_table_11_TAG_Q_'
-                            f'domtblout_filtered_0.05.txt',
-                            f'{hmmscan_results_path}/all_genomes_without_refseq_table_11_TGA_W_'
-                            f'domtblout_filtered_0.05.txt',
-                            f'{hmmscan_results_path}/all_genomes_without_refseq_table_15_domtblout_filtered_0.05.txt',
-                            f'{hmmscan_results_path}/all_genomes_without_refseq_table_25_domtblout_filtered_0.05.txt']
-
-    domtblout_file_name_refseq = f'{hmmscan_results_path}/all_refseq_proteins_domtblout_filtered_0.05.txt'
-
-    prodigal_annotation_path = '/mnt/c/crassvirales/functional_annotation/crassvirales_confirmed/annotations/prodigal'
-    refseq_annotation_path = '/mnt/c/crassvirales/functional_annotation/crassvirales_confirmed/annotations/refseq'
-    annotation_files = [f'{prodigal_annotation_path}/all_genomes_without_refseq_meta.gff',
-                        f'{prodigal_annotation_path}/all_genomes_without_refseq_table_4.gff',
-                        f'{prodigal_annotation_path}/all_genomes_without_refseq_table_11.gff',
-                        f'{prodigal_annotation_path}/all_genomes_without_refseq_table_11_TAG_Q.gff',
-                        f'{prodigal_annotation_path}/all_genomes_without_refseq_table_11_TGA_W.gff',
-                        f'{prodigal_annotation_path}/all_genomes_without_refseq_table_15.gff',
-                        f'{prodigal_annotation_path}/all_genomes_without_refseq_table_25.gff']
-
-    annotation_file_name_refseq = f'{refseq_annotation_path}/all_refseq_proteins.gff'
-
-    make_functional_annotation(profile_list_file_name,
-                               domtblout_file_names, annotation_files,
-                               domtblout_file_name_refseq, annotation_file_name_refseq)
+from collections.abc import Iterable, Mapping
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import pandas as pd
+
+from build_manifest import BuildManifest
+from compressed_io import get_derived_file_name, open_file
+from filter_protein_names_in_annotation import FunctionalColors, functional_colors
+from gff_rewriter import (GffNameOutput, KEY_EXTRACTORS, get_prodigal_protein_key, get_refseq_protein_key,
+                          rewrite_gff_names)
+from protein_function_index import (ProteinFunctionIndex, build_protein_function_index, get_index_dir_name,
+                                    get_protein_keys)
+from spreadsheet_snapshot import read_spreadsheet
+from stage_profiler import profiled
+
+
+ProfileId = str
+ProteinName = str
+
+ANNOTATION_SOURCES = ('prodigal', 'refseq')
+
+
+@profiled(inputs=('domtblout_file_name',))
+def get_protein_names_df(domtblout_file_name: str,
+                         profile_name_dict: Mapping[ProfileId, ProteinName],
+                         write_name_tables: bool = True) -> pd.DataFrame:
+    with open_file(domtblout_file_name) as domtblout_file:
+        domtblout_df = pd.read_csv(domtblout_file, index_col=False, sep='\t',
+                                   usecols=None if write_name_tables else ['#HMM_family', 'Query_ID'])
+    hmm_family_edited_col = domtblout_df['#HMM_family'].map(profile_name_dict).fillna(domtblout_df['#HMM_family'])
+    domtblout_df_edited = domtblout_df.copy()
+    domtblout_df_edited['#HMM_family'] = hmm_family_edited_col
+
+    if write_name_tables:
+        with open_file(get_derived_file_name(domtblout_file_name, '_with_names.txt'), 'w') as names_file:
+            domtblout_df_edited.to_csv(names_file, sep='\t', index=False)
+
+    domtblout_df_edited_names = domtblout_df_edited[['#HMM_family', 'Query_ID']]
+    domtblout_df_edited_names_unique = domtblout_df_edited_names.drop_duplicates()
+    if write_name_tables:
+        with open_file(get_derived_file_name(domtblout_file_name, '_with_names_unique.txt'), 'w') as names_file:
+            domtblout_df_edited_names_unique.to_csv(names_file, sep='\t', index=False)
+
+    return domtblout_df_edited_names_unique
+
+
+def get_protein_name_dict(domtblout_file_name: str,
+                          profile_name_dict: Mapping[ProfileId, ProteinName],
+                          write_name_tables: bool = True) -> dict[ProfileId, ProteinName]:
+    domtblout_df_edited_names_unique = get_protein_names_df(domtblout_file_name, profile_name_dict,
+                                                            write_name_tables)
+    protein_name_dict = dict(zip(domtblout_df_edited_names_unique['Query_ID'],
+                                 domtblout_df_edited_names_unique['#HMM_family']))
+
+    protein_name_dict = {'_'.join(k.split('_')[3:5]): v for k, v in protein_name_dict.items()}
+
+    return protein_name_dict
+
+
+def get_protein_name_index(domtblout_file_name: str,
+                           profile_name_dict: Mapping[ProfileId, ProteinName],
+                           write_name_tables: bool = True) -> ProteinFunctionIndex:
+    """Like ``get_protein_name_dict``, but (re)build the shared on-disk index instead of a dict."""
+    domtblout_df_edited_names_unique = get_protein_names_df(domtblout_file_name, profile_name_dict,
+                                                            write_name_tables)
+    index_dir = get_index_dir_name(get_derived_file_name(domtblout_file_name, '_with_names_unique.txt'))
+    return build_protein_function_index(get_protein_keys(domtblout_df_edited_names_unique['Query_ID']),
+                                        domtblout_df_edited_names_unique['#HMM_family'], index_dir)
+
+
+@profiled(inputs=('profile_list_file_name',))
+def get_profile_name_dict(profile_list_file_name: str) -> dict[ProfileId, ProteinName]:
+    profile_list_df = read_spreadsheet(profile_list_file_name, columns=['profile ID', 'nickname'])
+    profile_name_dict = dict(zip(profile_list_df['profile ID'], profile_list_df.nickname))
+    return profile_name_dict
+
+
+@profiled(inputs=('annotation_file',), outputs=('annotation_file_edited',))
+def make_functional_anotation_for_prodigal(annotation_file: str, annotation_file_edited: str,
+                                           protein_name_dict: Mapping[ProfileId, ProteinName]) -> None:
+    rewrite_gff_names(annotation_file, [GffNameOutput(annotation_file_edited)], protein_name_dict,
+                      get_prodigal_protein_key)
+
+
+@profiled(inputs=('annotation_file',), outputs=('annotation_file_edited',))
+def make_functional_anotation_for_refseq(annotation_file: str, annotation_file_edited: str,
+                                         protein_name_dict: Mapping[ProfileId, ProteinName]) -> None:
+    # 'lcl|NC_062765.1_prot_YP_010358662.1_8'
+    rewrite_gff_names(annotation_file, [GffNameOutput(annotation_file_edited)], protein_name_dict,
+                      get_refseq_protein_key, feature_type=b'CDS')
+
+
+def make_functional_annotation(profile_list_file_name: str,
+                               domtblout_file_names: Iterable[str], annotation_files: Iterable[str],
+                               domtblout_file_name_refseq: str, annotation_file_name_refseq: str) -> None:
+    profile_name_dict = get_profile_name_dict(profile_list_file_name)
+
+    for domtblout_file_name, annotation_file in zip(domtblout_file_names, annotation_files):
+        protein_name_dict = get_protein_name_dict(domtblout_file_name, profile_name_dict)
+        annotation_file_edited = get_derived_file_name(annotation_file, "_edited.gff")
+
+        make_functional_anotation_for_prodigal(annotation_file, annotation_file_edited,
+                                               protein_name_dict)
+
+    annotation_file_name_refseq_edited = get_derived_file_name(annotation_file_name_refseq, "_edited.gff")
+
+    protein_name_dict_refseq = get_protein_name_dict(domtblout_file_name_refseq, profile_name_dict)
+
+    make_functional_anotation_for_refseq(annotation_file_name_refseq, annotation_file_name_refseq_edited,
+                                         protein_name_dict_refseq)
+
+
+def get_annotated_gff_file_names(annotation_file: str, *_: object) -> list[str]:
+    annotation_file_edited = get_derived_file_name(annotation_file, "_edited.gff")
+    return [annotation_file_edited, get_derived_file_name(annotation_file_edited, "_filtered.gff")]
+
+
+@profiled(inputs=('annotation_file',), outputs=get_annotated_gff_file_names)
+def annotate_and_filter_gff_file(annotation_file: str, annotation_source: str,
+                                 protein_name_dict: Mapping[ProfileId, ProteinName],
+                                 functional_colors: FunctionalColors) -> None:
+    """Write the ``_edited.gff`` and its ``_edited_filtered.gff`` from one pass over a GFF.
+
+    Produces the same files as ``make_functional_anotation_for_*`` followed by ``filter_*_annotation``.
+    """
+    annotation_file_edited, annotation_file_filtered = get_annotated_gff_file_names(annotation_file)
+    outputs = [GffNameOutput(annotation_file_edited), GffNameOutput(annotation_file_filtered, functional_colors)]
+    rewrite_gff_names(annotation_file, outputs, protein_name_dict, KEY_EXTRACTORS[annotation_source],
+                      feature_type=b'CDS' if annotation_source == 'refseq' else None)
+
+
+def annotate_gff_file(profile_name_dict: Mapping[ProfileId, ProteinName], domtblout_file_name: str,
+                      annotation_file: str, annotation_source: str, functional_colors: FunctionalColors,
+                      write_name_tables: bool) -> None:
+    protein_name_index = get_protein_name_index(domtblout_file_name, profile_name_dict, write_name_tables)
+    annotate_and_filter_gff_file(annotation_file, annotation_source, protein_name_index, functional_colors)
+
+
+def get_annotate_gff_file_outputs(domtblout_file_name: str, annotation_file: str,
+                                  write_name_tables: bool) -> list[str]:
+    outputs = [*get_annotated_gff_file_names(annotation_file),
+               get_index_dir_name(get_derived_file_name(domtblout_file_name, '_with_names_unique.txt'))]
+    if write_name_tables:
+        outputs += [get_derived_file_name(domtblout_file_name, '_with_names.txt'),
+                    get_derived_file_name(domtblout_file_name, '_with_names_unique.txt')]
+    return outputs
+
+
+def make_and_filter_functional_annotation(profile_list_file_name: str,
+                                          domtblout_file_names: Iterable[str], annotation_files: Iterable[str],
+                                          domtblout_file_name_refseq: str, annotation_file_name_refseq: str,
+                                          functional_colors: FunctionalColors,
+                                          workers: int | None = None, write_name_tables: bool = False,
+                                          manifest: BuildManifest | None = None) -> None:
+    """Single-pass replacement for ``make_functional_annotation`` followed by ``filter_annotations``.
+
+    Every GFF is read once and annotated in its own worker process; the ``_with_names*.txt`` tables are
+    only written when ``write_name_tables`` is set. With a ``manifest``, GFFs whose inputs and parameters
+    did not change since the last run are skipped.
+    """
+    jobs = [(domtblout_file_name, annotation_file, 'prodigal')
+            for domtblout_file_name, annotation_file in zip(domtblout_file_names, annotation_files)]
+    jobs.append((domtblout_file_name_refseq, annotation_file_name_refseq, 'refseq'))
+
+    stages = {}
+    for domtblout_file_name, annotation_file, annotation_source in jobs:
+        stages[annotation_file] = (get_annotate_gff_file_outputs(domtblout_file_name, annotation_file,
+                                                                 write_name_tables),
+                                   [profile_list_file_name, domtblout_file_name, annotation_file],
+                                   {'annotation_source': annotation_source, 'functional_colors': functional_colors,
+                                    'write_name_tables': write_name_tables})
+    if manifest is not None:
+        signatures = {annotation_file: manifest.get_signature(inputs, parameters)
+                      for annotation_file, (_, inputs, parameters) in stages.items()}
+        jobs = [job for job in jobs
+                if not manifest.is_up_to_date(f'annotate_gff:{job[1]}', stages[job[1]][0], signatures[job[1]])]
+        for _, annotation_file, _ in jobs:
+            manifest.invalidate(f'annotate_gff:{annotation_file}')
+    if not jobs:
+        return
+
+    profile_name_dict = get_profile_name_dict(profile_list_file_name)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {annotation_file: executor.submit(annotate_gff_file, profile_name_dict, domtblout_file_name,
+                                                    annotation_file, annotation_source, functional_colors,
+                                                    write_name_tables)
+                   for domtblout_file_name, annotation_file, annotation_source in jobs}
+        for annotation_file, future in futures.items():
+            future.result()
+            if manifest is not None:
+                manifest.record(f'annotate_gff:{annotation_file}', stages[annotation_file][0],
+                                signatures[annotation_file])
+
+
+if __name__ == "__main__":
+    profile_list_file_name = "/mnt/c/crassvirales/crassfamily_2020/profile_list.xlsx"
+
+    hmmscan_results_path = '/mnt/c/crassvirales/functional_annotation/crassvirales_confirmed/hmmscan_results'
+    domtblout_file_names = [f'{hmmscan_results_path}/all_genomes_without_refseq_meta_domtblout_filtered_0.05.txt',
+                            f'{hmmscan_results_path}/all_genomes_without_refseq_table_4_domtblout_filtered_0.05.txt',
+                            f'{hmmscan_results_path}/all_genomes_without_refseq_table_11_domtblout_filtered_0.05.txt',
+                            f'{hmmscan_results_path}/all_genomes_without_refseq_table_11_TAG_Q_'
+                            f'domtblout_filtered_0.05.txt',
+                            f'{hmmscan_results_path}/all_genomes_without_refseq_table_11_TGA_W_'
+                            f'domtblout_filtered_0.05.txt',
+                            f'{hmmscan_results_path}/all_genomes_without_refseq_table_15_domtblout_filtered_0.05.txt',
+                            f'{hmmscan_results_path}/all_genomes_without_refseq_table_25_domtblout_filtered_0.05.txt']
+
+    domtblout_file_name_refseq = f'{hmmscan_results_path}/all_refseq_proteins_domtblout_filtered_0.05.txt'
+
+    prodigal_annotation_path = '/mnt/c/crassvirales/functional_annotation/crassvirales_confirmed/annotations/prodigal'
+    refseq_annotation_path = '/mnt/c/crassvirales/functional_annotation/crassvirales_confirmed/annotations/refseq'
+    annotation_files = [f'{prodigal_annotation_path}/all_genomes_without_refseq_meta.gff',
+                        f'{prodigal_annotation_path}/all_genomes_without_refseq_table_4.gff',
+                        f'{prodigal_annotation_path}/all_genomes_without_refseq_table_11.gff',
+                        f'{prodigal_annotation_path}/all_genomes_without_refseq_table_11_TAG_Q.gff',
+                        f'{prodigal_annotation_path}/all_genomes_without_refseq_table_11_TGA_W.gff',
+                        f'{prodigal_annotation_path}/all_genomes_without_refseq_table_15.gff',
+                        f'{prodigal_annotation_path}/all_genomes_without_refseq_table_25.gff']
+
+    annotation_file_name_refseq = f'{refseq_annotation_path}/all_refseq_proteins.gff'
+
+    make_and_filter_functional_annotation(profile_list_file_name,
+                                          domtblout_file_names, annotation_files,
+                                          domtblout_file_name_refseq, annotation_file_name_refseq,
+                                          functional_colors, workers=os.cpu_count(), write_name_tables=True,
+                                          manifest=BuildManifest('/mnt/c/crassvirales/functional_annotation/'
+                                                                 'crassvirales_confirmed/pipeline_manifest.json'))
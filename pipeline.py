@@ -0,0 +1,224 @@
+#!/usr/bin/python
+import argparse
+from collections.abc import Callable, Iterable
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+import json
+import os
+from typing import Any, NamedTuple
+
+from build_manifest import BuildManifest, run_stage
+import cluster_functions
+from filter_protein_names_in_annotation import filter_annotations, functional_colors
+import get_cluster_sequences
+import get_random_genome
+from hmmscan_domtblout_parser import (get_result_file_name, get_sweep_result_file_names,
+                                      start_hmmscan_domtblout_result_analysis,
+                                      start_hmmscan_domtblout_threshold_sweep)
+from make_functional_annotation_table_with_names import make_and_filter_functional_annotation
+from stage_profiler import PROFILE_DIR_ENV, PROFILE_LOG_ENV, PROFILE_RECORDS_ENV
+
+
+PathToFile = str
+StageName = str
+
+
+class Stage(NamedTuple):
+    """One node of the workflow: ``task`` called with ``params`` once every stage in ``after`` has finished."""
+    name: StageName
+    task: str
+    params: dict[str, Any]
+    after: tuple[StageName, ...] = ()
+    cpus: int = 1
+
+
+def filter_domtblout(manifest: BuildManifest | None, cpus: int, domtblout_file: PathToFile,
+                     engine: str = 'native') -> None:
+    run_stage(manifest, 'filter_domtblout', [get_result_file_name(domtblout_file)], [domtblout_file],
+              {'engine': engine}, start_hmmscan_domtblout_result_analysis, domtblout_file, engine)
+
+
+def sweep_domtblout(manifest: BuildManifest | None, cpus: int, domtblout_file: PathToFile,
+                    thresholds: list[tuple[float, float]], policy: str = 'first', top_n: int = 1) -> None:
+    # JSON configs give the threshold pairs as lists
+    threshold_pairs = [(hit_evalue_threshold, coverage_threshold)
+                       for hit_evalue_threshold, coverage_threshold in thresholds]
+    run_stage(manifest, 'sweep_domtblout',
+              get_sweep_result_file_names(domtblout_file, threshold_pairs, policy, top_n), [domtblout_file],
+              {'thresholds': thresholds, 'policy': policy, 'top_n': top_n},
+              start_hmmscan_domtblout_threshold_sweep, domtblout_file, threshold_pairs, policy, top_n)
+
+
+def annotate_gff(manifest: BuildManifest | None, cpus: int, profile_list_file: PathToFile,
+                 domtblout_files: list[PathToFile], annotation_files: list[PathToFile],
+                 domtblout_refseq_file: PathToFile, annotation_refseq_file: PathToFile,
+                 write_name_tables: bool = False) -> None:
+    make_and_filter_functional_annotation(profile_list_file, domtblout_files, annotation_files,
+                                          domtblout_refseq_file, annotation_refseq_file, functional_colors,
+                                          workers=cpus, write_name_tables=write_name_tables, manifest=manifest)
+
+
+def filter_gff(manifest: BuildManifest | None, cpus: int, annotation_files: list[PathToFile],
+               hmm_protein_files: list[PathToFile], annotation_refseq_file: PathToFile | None = None,
+               hmm_protein_refseq_file: PathToFile | None = None) -> None:
+    filter_annotations(annotation_files, hmm_protein_files, annotation_refseq_file, hmm_protein_refseq_file,
+                       functional_colors, manifest)
+
+
+def cluster_sequences(manifest: BuildManifest | None, cpus: int, cluster_table: PathToFile,
+                      proteins_faa: PathToFile, proteins_sizes: PathToFile, results_dir: str,
+                      write_cluster_lengths: bool = False, layout: str = 'flat') -> None:
+    get_cluster_sequences.main(cluster_table, proteins_faa, proteins_sizes, results_dir, manifest, cpus,
+                               write_cluster_lengths, layout)
+
+
+def annotate_clusters(manifest: BuildManifest | None, cpus: int, cluster_table: PathToFile,
+                      protein_names_files: list[PathToFile], results_dir: str, file_format: str = 'txt') -> None:
+    cluster_functions.main(cluster_table, protein_names_files, results_dir, manifest, file_format)
+
+
+def random_genomes(manifest: BuildManifest | None, cpus: int, vmr_file: PathToFile,
+                   caudoviricetes_file: PathToFile, random_file: PathToFile, seed: int | None = None) -> None:
+    run_stage(manifest, 'random_genomes', [caudoviricetes_file, random_file], [vmr_file], {'seed': seed},
+              get_random_genome.extract_random_taxonomic_members_from_ictv_vmr, vmr_file, caudoviricetes_file,
+              random_file, seed)
+
+
+TASKS: dict[str, Callable[..., None]] = {
+    'filter_domtblout': filter_domtblout,
+    'sweep_domtblout': sweep_domtblout,
+    'annotate_gff': annotate_gff,
+    'filter_gff': filter_gff,
+    'cluster_sequences': cluster_sequences,
+    'annotate_clusters': annotate_clusters,
+    'random_genomes': random_genomes,
+}
+
+
+def read_pipeline_config(config_file_name: PathToFile) -> tuple[dict[StageName, Stage], dict[str, Any]]:
+    """Read the stages and the run settings (``workers``, ``manifest_dir``) of a JSON workflow description.
+
+    Each entry of ``stages`` names a task of ``TASKS``, its ``params``, the stages it runs ``after`` and how many
+    ``cpus`` it uses.
+    """
+    with open(config_file_name, encoding='utf8') as config_file:
+        config = json.load(config_file)
+    stages = {name: Stage(name, stage['task'], stage.get('params', {}), tuple(stage.get('after', ())),
+                          stage.get('cpus', 1))
+              for name, stage in config['stages'].items()}
+    settings = {key: value for key, value in config.items() if key != 'stages'}
+    return stages, settings
+
+
+def get_stage_order(stages: dict[StageName, Stage]) -> list[StageName]:
+    """Topological order of the stages; unknown tasks, unknown dependencies and cycles are errors."""
+    for stage in stages.values():
+        if stage.task not in TASKS:
+            raise ValueError(f'Stage {stage.name} has unknown task {stage.task}, expected one of {list(TASKS)}')
+        for dependency in stage.after:
+            if dependency not in stages:
+                raise ValueError(f'Stage {stage.name} runs after unknown stage {dependency}')
+
+    order: list[StageName] = []
+    remaining = dict(stages)
+    while remaining:
+        ready = [name for name, stage in remaining.items() if all(dependency in order for dependency in stage.after)]
+        if not ready:
+            raise ValueError(f'Stages {sorted(remaining)} depend on each other in a cycle')
+        order.extend(ready)
+        for name in ready:
+            del remaining[name]
+    return order
+
+
+def select_stages(stages: dict[StageName, Stage], stage_names: Iterable[StageName]) -> dict[StageName, Stage]:
+    """The given stages together with everything they depend on."""
+    selected: dict[StageName, Stage] = {}
+    pending = list(stage_names)
+    while pending:
+        name = pending.pop()
+        if name not in stages:
+            raise ValueError(f'Unknown stage {name}')
+        if name not in selected:
+            selected[name] = stages[name]
+            pending.extend(stages[name].after)
+    return {name: stage for name, stage in stages.items() if name in selected}
+
+
+def run_stage_task(stage: Stage, manifest_dir: str | None) -> None:
+    # every stage keeps its own manifest, so concurrently running stages never rewrite each other's records
+    manifest = BuildManifest(f'{manifest_dir}/{stage.name}.json') if manifest_dir else None
+    TASKS[stage.task](manifest, stage.cpus, **stage.params)
+
+
+def run_pipeline(stages: dict[StageName, Stage], workers: int, manifest_dir: str | None = None) -> list[StageName]:
+    """Run the stages in worker processes as soon as their dependencies finish, within a budget of ``workers`` CPUs.
+
+    A failed stage does not stop independent stages; the stages that depend on it are not started. Returns the
+    failed and skipped stages.
+    """
+    pending = [stages[name] for name in get_stage_order(stages)]
+    finished: set[StageName] = set()
+    failed: list[StageName] = []
+    running: dict[Future, Stage] = {}
+    free_cpus = workers
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for stage in list(pending):
+                if any(dependency in failed for dependency in stage.after):
+                    print(f'{stage.name}: skipped, a stage it depends on failed')
+                    failed.append(stage.name)
+                    pending.remove(stage)
+                elif all(dependency in finished for dependency in stage.after) and \
+                        (min(stage.cpus, workers) <= free_cpus or not running):
+                    print(f'{stage.name}: started')
+                    running[executor.submit(run_stage_task, stage, manifest_dir)] = stage
+                    free_cpus -= min(stage.cpus, workers)
+                    pending.remove(stage)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                free_cpus += min(stage.cpus, workers)
+                if future.exception() is not None:
+                    print(f'{stage.name}: failed with {future.exception()!r}')
+                    failed.append(stage.name)
+                else:
+                    print(f'{stage.name}: finished')
+                    finished.add(stage.name)
+    return failed
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Run the crassvirales annotation workflow described in a JSON config')
+    parser.add_argument('config', help='JSON file with the workflow stages, see pipeline_config.json')
+    parser.add_argument('--stages', nargs='+', help='run only these stages and the stages they depend on')
+    parser.add_argument('--workers', type=int, help='CPUs shared by concurrently running stages')
+    parser.add_argument('--dry-run', action='store_true', help='print the stage order without running anything')
+    parser.add_argument('--profile-log', help='append a JSON line of timings and resource use per profiled function')
+    parser.add_argument('--profile-dir', help='also write a cProfile file per profiled stage into this directory')
+    parser.add_argument('--profile-records', action='store_true',
+                        help='also count the lines of profiled input and output files, which reads them again')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    stages, settings = read_pipeline_config(args.config)
+    if args.stages:
+        stages = select_stages(stages, args.stages)
+
+    if args.dry_run:
+        for name in get_stage_order(stages):
+            print(f"{name}\t{stages[name].task}\tafter: {', '.join(stages[name].after) or '-'}")
+    else:
+        # worker processes inherit the environment, so profiling is switched on for every stage
+        if args.profile_log:
+            os.environ[PROFILE_LOG_ENV] = args.profile_log
+        if args.profile_dir:
+            os.environ[PROFILE_DIR_ENV] = args.profile_dir
+        if args.profile_records:
+            os.environ[PROFILE_RECORDS_ENV] = '1'
+        failed_stages = run_pipeline(stages, args.workers or settings.get('workers', 1), settings.get('manifest_dir'))
+        if failed_stages:
+            raise SystemExit(f"Failed or skipped stages: {', '.join(failed_stages)}")
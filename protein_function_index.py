@@ -0,0 +1,145 @@
+from collections.abc import Iterable, Iterator, Mapping, Sequence
+from contextlib import contextmanager
+import fcntl
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from compressed_io import open_file, split_compression_suffix
+
+
+PathToFile = str
+PathToDir = str
+ProteinId = str
+ProteinName = str
+
+KEYS_FILE_NAME = 'keys.npy'
+FUNCTION_CODES_FILE_NAME = 'function_codes.npy'
+FUNCTIONS_FILE_NAME = 'functions.txt'
+
+MISSING_FUNCTION_CODE = -1
+
+
+class ProteinFunctionIndex(Mapping[ProteinId, ProteinName]):
+    """Read-only protein -> function mapping stored as memory-mapped NumPy arrays.
+
+    Keys are kept as a sorted fixed-width byte array and looked up with binary search; function names are
+    interned, so each protein costs its key plus one small integer. The arrays are opened with ``mmap_mode='r'``,
+    so processes that open the same index share its pages instead of copying them.
+    """
+
+    def __init__(self, index_dir: PathToDir) -> None:
+        self.index_dir = index_dir
+        self.protein_keys = np.load(f'{index_dir}/{KEYS_FILE_NAME}', mmap_mode='r')
+        self.function_codes = np.load(f'{index_dir}/{FUNCTION_CODES_FILE_NAME}', mmap_mode='r')
+        with open(f'{index_dir}/{FUNCTIONS_FILE_NAME}', encoding='utf8') as functions_file:
+            self.functions = functions_file.read().splitlines()
+
+    def __reduce__(self) -> tuple[type, tuple[PathToDir]]:
+        # workers reopen the memory map instead of receiving a pickled copy of the arrays
+        return self.__class__, (self.index_dir,)
+
+    def __getitem__(self, protein_name: ProteinId) -> ProteinName:
+        key = protein_name.encode('utf8')
+        if len(key) <= self.protein_keys.dtype.itemsize:
+            position = int(np.searchsorted(self.protein_keys, key))
+            if position < len(self.protein_keys) and self.protein_keys[position] == key:
+                return self.functions[self.function_codes[position]]
+        raise KeyError(protein_name)
+
+    def __len__(self) -> int:
+        return len(self.protein_keys)
+
+    def __iter__(self) -> Iterator[ProteinId]:
+        return (key.decode('utf8') for key in self.protein_keys)
+
+    def get_function_codes(self, protein_names: Sequence[ProteinId]) -> np.ndarray:
+        """Look up many proteins at once; missing proteins get ``MISSING_FUNCTION_CODE``."""
+        keys = np.array([protein_name.encode('utf8') for protein_name in protein_names],
+                        dtype=self.protein_keys.dtype)
+        positions = np.searchsorted(self.protein_keys, keys).clip(max=max(len(self.protein_keys) - 1, 0))
+        function_codes = np.full(len(keys), MISSING_FUNCTION_CODE, dtype=np.int32)
+        if len(self.protein_keys):
+            found = (self.protein_keys[positions] == keys) & \
+                    np.array([len(protein_name.encode('utf8')) <= self.protein_keys.dtype.itemsize
+                              for protein_name in protein_names], dtype=np.bool_)
+            function_codes[found] = self.function_codes[positions[found]]
+        return function_codes
+
+
+def get_protein_keys(query_ids: pd.Series) -> pd.Series:
+    """Vectorized form of ``'_'.join(k.split('_')[3:5])`` used to match hmmscan queries to GFF features."""
+    return query_ids.str.split('_').str[3:5].str.join('_')
+
+
+def write_protein_function_index(protein_names: Iterable[ProteinId], protein_functions: Iterable[ProteinName],
+                                 index_parent_dir: PathToDir) -> PathToDir:
+    """Write an index into a new temporary directory of ``index_parent_dir`` and return the directory."""
+    keys = np.array([protein_name.encode('utf8') for protein_name in protein_names], dtype=np.bytes_)
+    functions, function_codes = np.unique(np.array(list(protein_functions), dtype=str), return_inverse=True)
+
+    order = np.argsort(keys, kind='stable')
+    keys, function_codes = keys[order], function_codes[order]
+    is_last = np.append(keys[1:] != keys[:-1], True) if len(keys) else np.zeros(0, dtype=np.bool_)
+    keys, function_codes = keys[is_last], function_codes[is_last]
+
+    tmp_dir = tempfile.mkdtemp(dir=index_parent_dir, prefix='.protein_function_index_')
+    np.save(f'{tmp_dir}/{KEYS_FILE_NAME}', keys)
+    np.save(f'{tmp_dir}/{FUNCTION_CODES_FILE_NAME}', function_codes.astype(np.int32))
+    with open(f'{tmp_dir}/{FUNCTIONS_FILE_NAME}', 'w', encoding='utf8') as functions_file:
+        functions_file.writelines(f'{function}\n' for function in functions)
+    return tmp_dir
+
+
+@contextmanager
+def lock_index_dir(index_dir: PathToDir) -> Iterator[None]:
+    """Hold an exclusive lock on ``<index_dir>.lock``, taken by every process that replaces the index."""
+    with open(f'{index_dir}.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def replace_index_dir(tmp_dir: PathToDir, index_dir: PathToDir) -> None:
+    # the old index is moved aside before it is deleted, so workers that open the index without the lock
+    # see either a complete index or none
+    old_index_dir = f'{tmp_dir}_old'
+    if os.path.isdir(index_dir):
+        os.replace(index_dir, old_index_dir)
+    os.replace(tmp_dir, index_dir)
+    shutil.rmtree(old_index_dir, ignore_errors=True)
+
+
+def build_protein_function_index(protein_names: Iterable[ProteinId], protein_functions: Iterable[ProteinName],
+                                 index_dir: PathToDir) -> ProteinFunctionIndex:
+    """Write an index for the given proteins and open it; a repeated protein keeps its last function, as
+    ``dict(zip())`` does."""
+    index_parent_dir = Path(index_dir).parent
+    index_parent_dir.mkdir(parents=True, exist_ok=True)
+    tmp_dir = write_protein_function_index(protein_names, protein_functions, str(index_parent_dir))
+    with lock_index_dir(index_dir):
+        replace_index_dir(tmp_dir, index_dir)
+        return ProteinFunctionIndex(index_dir)
+
+
+def get_index_dir_name(protein_names_file_name: PathToFile) -> PathToDir:
+    return split_compression_suffix(protein_names_file_name)[0][:-4] + '_index'
+
+
+def open_protein_function_index(protein_names_file_name: PathToFile) -> ProteinFunctionIndex:
+    """Open the index next to a ``_with_names_unique.txt`` table, building it first if it is missing or stale."""
+    index_dir = get_index_dir_name(protein_names_file_name)
+    keys_file_name = f'{index_dir}/{KEYS_FILE_NAME}'
+    # checked under the lock, so an index another process has just rebuilt is opened instead of built again
+    with lock_index_dir(index_dir):
+        if not os.path.exists(keys_file_name) or \
+                os.path.getmtime(keys_file_name) < os.path.getmtime(protein_names_file_name):
+            with open_file(protein_names_file_name) as protein_names_file:
+                df = pd.read_csv(protein_names_file, index_col=None, sep='\t', usecols=['#HMM_family', 'Query_ID'])
+            tmp_dir = write_protein_function_index(get_protein_keys(df['Query_ID']), df['#HMM_family'],
+                                                   os.path.dirname(index_dir) or '.')
+            replace_index_dir(tmp_dir, index_dir)
+        return ProteinFunctionIndex(index_dir)
@@ -0,0 +1,87 @@
+from collections.abc import Iterable, Sequence
+import glob
+import os
+from pathlib import Path
+import tempfile
+
+import pandas as pd
+
+from build_manifest import get_file_sha256
+
+try:
+    import pyarrow  # noqa: F401
+except ImportError:
+    pyarrow = None  # type: ignore[assignment]
+
+
+PathToFile = str
+PathToDir = str
+
+SNAPSHOT_DIR_NAME = '.spreadsheet_snapshots'
+SNAPSHOT_HASH_LENGTH = 16
+
+
+def get_snapshot_file_name(spreadsheet_file_name: PathToFile, spreadsheet_hash: str) -> PathToFile:
+    spreadsheet_path = Path(spreadsheet_file_name)
+    return f'{spreadsheet_path.parent}/{SNAPSHOT_DIR_NAME}/' \
+           f'{spreadsheet_path.name}.{spreadsheet_hash[:SNAPSHOT_HASH_LENGTH]}.parquet'
+
+
+def get_storable_df(df: pd.DataFrame) -> pd.DataFrame:
+    """Store object columns that mix text and numbers (common in hand-edited sheets) as text, which Parquet needs."""
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        values = df[column].dropna()
+        if not values.map(lambda value: isinstance(value, str)).all():
+            df[column] = df[column].map(lambda value: value if pd.isna(value) else str(value))
+    return df
+
+
+def write_spreadsheet_snapshot(spreadsheet_file_name: PathToFile, snapshot_file_name: PathToFile) -> None:
+    """Convert the first sheet to Parquet and drop the snapshots of earlier versions of the spreadsheet."""
+    df = get_storable_df(pd.read_excel(spreadsheet_file_name, index_col=None))
+    snapshot_path = Path(snapshot_file_name)
+    snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+    # a temporary file of its own, so processes that snapshot the same spreadsheet do not write into each other's
+    tmp_file, tmp_file_name = tempfile.mkstemp(dir=snapshot_path.parent, prefix=f'.{snapshot_path.name}.',
+                                               suffix='.tmp')
+    os.close(tmp_file)
+    try:
+        df.to_parquet(tmp_file_name, index=False, engine='pyarrow')
+        os.replace(tmp_file_name, snapshot_file_name)
+    finally:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+    for old_snapshot_file_name in glob.glob(f'{glob.escape(snapshot_file_name.rsplit(".", 2)[0])}.*.parquet'):
+        if old_snapshot_file_name != snapshot_file_name:
+            try:
+                os.remove(old_snapshot_file_name)
+            except FileNotFoundError:  # already removed by another process
+                pass
+
+
+def set_categorical_columns(df: pd.DataFrame, categorical_columns: Iterable[str]) -> pd.DataFrame:
+    for column in categorical_columns:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    return df
+
+
+def read_spreadsheet(spreadsheet_file_name: PathToFile, columns: Sequence[str] | None = None,
+                     categorical_columns: Iterable[str] = (), fill_value: str | None = None) -> pd.DataFrame:
+    """Read the first sheet of a spreadsheet through a Parquet snapshot keyed by the spreadsheet's content hash.
+
+    The first call converts the spreadsheet; later calls read only ``columns`` from the snapshot. Missing cells are
+    replaced by ``fill_value`` before ``categorical_columns`` become categoricals. Without pyarrow the spreadsheet
+    is read directly every time.
+    """
+    if pyarrow is None:
+        df = pd.read_excel(spreadsheet_file_name, index_col=None, usecols=columns)
+    else:
+        snapshot_file_name = get_snapshot_file_name(spreadsheet_file_name, get_file_sha256(spreadsheet_file_name))
+        if not os.path.exists(snapshot_file_name):
+            write_spreadsheet_snapshot(spreadsheet_file_name, snapshot_file_name)
+        df = pd.read_parquet(snapshot_file_name, columns=columns, engine='pyarrow')
+    if fill_value is not None:
+        df = df.fillna(fill_value)
+    return set_categorical_columns(df, categorical_columns)
@@ -0,0 +1,187 @@
+from collections.abc import Callable, Iterable, Sequence, Sized
+import cProfile
+import functools
+import inspect
+import json
+import os
+from pathlib import Path
+import resource
+import time
+from typing import Any, TypeVar
+
+from compressed_io import open_file
+
+
+PathToFile = str
+FileSelector = Sequence[str] | Callable[..., Iterable[PathToFile]]
+Function = TypeVar('Function', bound=Callable[..., Any])
+
+PROFILE_LOG_ENV = 'CRASSVIRALES_PROFILE_LOG'
+PROFILE_DIR_ENV = 'CRASSVIRALES_PROFILE_DIR'
+PROFILE_RECORDS_ENV = 'CRASSVIRALES_PROFILE_RECORDS'
+LINE_COUNT_BLOCK_SIZE = 2 ** 20
+# binary outputs have no lines to count
+BINARY_FILE_SUFFIXES = ('.parquet', '.npy')
+
+_stage_depth = 0
+
+
+def get_peak_rss_mib() -> float:
+    """Peak RSS since the last ``reset_peak_rss``, or since the process started where that is not supported."""
+    try:
+        with open('/proc/self/status', encoding='utf8') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def reset_peak_rss() -> None:
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='utf8') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def get_io_counters() -> tuple[int, int]:
+    """Bytes this process passed through read and write calls, page cache included."""
+    try:
+        with open('/proc/self/io', encoding='utf8') as io_file:
+            counters = dict(line.split(': ') for line in io_file.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError):
+        return 0, 0
+
+
+def count_lines(file_name: PathToFile) -> int:
+    # records are lines of the decompressed data
+    with open_file(file_name, 'rb') as input_file:
+        return sum(block.count(b'\n') for block in iter(lambda: input_file.read(LINE_COUNT_BLOCK_SIZE), b''))
+
+
+def get_files_size(file_names: Iterable[PathToFile]) -> int:
+    """Total size of the existing files and of the files directly inside the existing directories."""
+    total_size = 0
+    for file_name in file_names:
+        if os.path.isdir(file_name):
+            with os.scandir(file_name) as dir_entries:
+                total_size += sum(dir_entry.stat().st_size for dir_entry in dir_entries if dir_entry.is_file())
+        elif os.path.isfile(file_name):
+            total_size += os.path.getsize(file_name)
+    return total_size
+
+
+def get_files_records(file_names: Iterable[PathToFile]) -> int:
+    """Lines of the existing text files plus files of the existing directories; reads every text file in full."""
+    total_records = 0
+    for file_name in file_names:
+        if os.path.isdir(file_name):
+            total_records += sum(len(dir_file_names) for _, _, dir_file_names in os.walk(file_name))
+        elif os.path.isfile(file_name) and not file_name.endswith(BINARY_FILE_SUFFIXES):
+            total_records += count_lines(file_name)
+    return total_records
+
+
+def select_files(selector: FileSelector | None, arguments: inspect.BoundArguments) -> list[PathToFile]:
+    if selector is None:
+        return []
+    if callable(selector):
+        return list(selector(*arguments.args, **arguments.kwargs))
+    file_names = []
+    for argument_name in selector:
+        value = arguments.arguments.get(argument_name)
+        if isinstance(value, str):
+            file_names.append(value)
+        elif value is not None:
+            file_names.extend(value)
+    return file_names
+
+
+def write_profile_record(record: dict[str, Any]) -> None:
+    profile_log_file_name = os.environ[PROFILE_LOG_ENV]
+    Path(profile_log_file_name).parent.mkdir(parents=True, exist_ok=True)
+    # one short append per record, so records of concurrent worker processes do not interleave
+    with open(profile_log_file_name, 'a', encoding='utf8') as profile_log:
+        profile_log.write(json.dumps(record) + '\n')
+
+
+def profiled(stage_name: str | None = None, inputs: FileSelector | None = None,
+             outputs: FileSelector | None = None) -> Callable[[Function], Function]:
+    """Record wall and CPU time, peak RSS, records and bytes of every call as a JSON line.
+
+    Nothing is measured unless ``CRASSVIRALES_PROFILE_LOG`` names the log file. ``inputs`` and ``outputs`` are
+    argument names holding paths, or functions of the call's arguments that return paths; only their sizes are
+    recorded, so profiling adds no reads of its own. A returned collection counts as records out. With
+    ``CRASSVIRALES_PROFILE_RECORDS`` set, the records of the inputs and outputs (lines of text files, files of
+    directories) are counted as well, at the cost of reading them again. With ``CRASSVIRALES_PROFILE_DIR`` set,
+    each outermost profiled call also dumps a cProfile file there.
+    Peak RSS of a nested stage includes its enclosing stage, as it is only reset for the outermost one.
+    """
+    def decorator(function: Function) -> Function:
+        signature = inspect.signature(function)
+        name = stage_name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            global _stage_depth
+            if PROFILE_LOG_ENV not in os.environ:
+                return function(*args, **kwargs)
+
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            input_file_names = select_files(inputs, arguments)
+            count_records = bool(os.environ.get(PROFILE_RECORDS_ENV))
+            # counted before the stage, so its own reads are not measured
+            records_in = get_files_records(input_file_names) if count_records else None
+            profile_dir_name = os.environ.get(PROFILE_DIR_ENV) if _stage_depth == 0 else None
+            profiler = cProfile.Profile() if profile_dir_name else None
+            if _stage_depth == 0:
+                reset_peak_rss()
+
+            start_time = time.time()
+            start_wall, start_cpu, start_children = time.perf_counter(), time.process_time(), os.times()
+            start_read, start_written = get_io_counters()
+            status = 'error'
+            result = None
+            _stage_depth += 1
+            try:
+                if profiler is not None:
+                    profiler.enable()
+                result = function(*args, **kwargs)
+                status = 'ok'
+                return result
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                _stage_depth -= 1
+                end_children = os.times()
+                end_read, end_written = get_io_counters()
+                record = {'stage': name, 'function': f'{function.__module__}.{function.__qualname__}',
+                          'pid': os.getpid(), 'start_time': round(start_time, 3), 'status': status,
+                          'wall_seconds': round(time.perf_counter() - start_wall, 6),
+                          'cpu_seconds': round(time.process_time() - start_cpu, 6),
+                          'children_cpu_seconds': round(end_children.children_user + end_children.children_system -
+                                                        start_children.children_user -
+                                                        start_children.children_system, 6),
+                          'peak_rss_mib': round(get_peak_rss_mib(), 1),
+                          'bytes_read': end_read - start_read, 'bytes_written': end_written - start_written,
+                          'bytes_in': get_files_size(input_file_names)}
+                if records_in is not None:
+                    record['records_in'] = records_in
+                if outputs is not None:
+                    output_file_names = select_files(outputs, arguments)
+                    record['bytes_out'] = get_files_size(output_file_names)
+                    if count_records:
+                        record['records_out'] = get_files_records(output_file_names)
+                if 'records_out' not in record and isinstance(result, Sized) and not isinstance(result, str):
+                    record['records_out'] = len(result)
+                write_profile_record(record)
+                if profiler is not None and profile_dir_name:
+                    Path(profile_dir_name).mkdir(parents=True, exist_ok=True)
+                    profiler.dump_stats(f'{profile_dir_name}/{name}.{os.getpid()}.{int(start_time * 1000)}.prof')
+
+        return wrapper  # type: ignore[return-value]
+    return decorator